@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+Benchmarks vickitrix's tweet-to-order hot path.
+
+Measures throughput and latency percentiles of
+
+    match: Trader.match() on statuses, sweeping number of rules and
+        keywords per rule;
+    place: filling in templates and placing one order with Trader.place();
+    stream: statuses pushed through TradeListener.on_success() at a fixed
+        rate until the fake exchange receives their orders, sweeping tweet
+        rate;
+    ingest: raw stream bytes split into messages, prefiltered, decoded,
+        and queued by TradeListener, mostly for authors no rule follows,
+        sweeping read size and whether raw messages are prefiltered;
+    processes: raw statuses decoded and matched against many keyword rules
+        by TradeListener, sweeping number of match worker processes (0
+        matches in the benchmark's own process); and
+    load: loading and validating a rules file with load_rules(), sweeping
+        number of rules and file format (Python or JSON).
+
+GDAX clients and the Twitter stream are local stand-ins, so nothing here
+touches the network. Results are written as one JSON object per line, so
+runs can be compared to catch regressions:
+
+    python benchmarks/hot_path.py --output before.jsonl
+"""
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    # Python 2
+    from time import time as clock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vickitrix
+from vickitrix import dsl
+from vickitrix.balances import BalanceCache
+from vickitrix.eventlog import EventLog
+from vickitrix.listener import TradeListener
+from vickitrix.stream import split_messages
+from vickitrix.trader import Trader
+
+class FakeExchange(object):
+    """ Stands in for gdax.AuthenticatedClient and gdax.PublicClient. """
+
+    def __init__(self):
+        self.placed = {}
+        self._ids = itertools.count(1)
+
+    def get_accounts(self):
+        return [{'currency' : currency, 'available' : '1000000'}
+                for currency in ['USD', 'ETH', 'BTC', 'LTC']]
+
+    def get_product_order_book(self, product_id, level=1):
+        return {'bids' : [['300.00', '1', 1]], 'asks' : [['300.01', '1', 1]]}
+
+    def _place(self, order):
+        # Orders from the stream benchmark carry a sequence number in size
+        self.placed[order.get('size')] = clock()
+        return {'id' : str(next(self._ids)), 'status' : 'pending'}
+
+    def buy(self, **kwargs):
+        return self._place(kwargs)
+
+    def sell(self, **kwargs):
+        return self._place(kwargs)
+
+class FakeStream(object):
+    """ Stands in for Twython's stream, calling a listener's on_success()
+        with statuses at a fixed rate. """
+
+    def __init__(self, listener, rate):
+        self.listener = listener
+        self.rate = rate
+
+    def play(self, statuses):
+        """ Delivers statuses.
+
+            statuses: list of status dictionaries
+
+            Return value: dictionary mapping status ID to delivery time
+        """
+        delivered = {}
+        start = clock()
+        for i, status in enumerate(statuses):
+            due = start + float(i) / self.rate
+            remaining = due - clock()
+            while remaining > 0:
+                time.sleep(min(remaining, 0.001))
+                remaining = due - clock()
+            delivered[status['id']] = clock()
+            self.listener.on_success(status)
+        return delivered
+
+def _words(count, rng):
+    return [''.join(rng.choice(string.ascii_lowercase)
+                    for _ in range(rng.randint(4, 9)))
+            for _ in range(count)]
+
+def make_rules(rule_count, keyword_count, rng, vocabulary):
+    """ Makes rules with random handles and keywords. """
+    rules = []
+    for i in range(rule_count):
+        rules.append({
+                'handles' : ['handle{}'.format(i % 50)],
+                'keywords' : rng.sample(vocabulary, keyword_count),
+                'condition' : '"zzz" not in {tweet}',
+                'orders' : [{
+                        'side' : 'buy' if i % 2 else 'sell',
+                        'type' : 'limit',
+                        'product_id' : 'ETH-USD',
+                        'price' : '{inside_ask}',
+                        'size' : '{available[ETH]} * 0.0001'
+                    }]
+            })
+    return rules
+
+def make_statuses(count, rng, vocabulary, words=20):
+    """ Makes statuses from random handles with random words. """
+    return [{
+            'id' : i,
+            'id_str' : str(i),
+            'text' : ' '.join(rng.choice(vocabulary) for _ in range(words)),
+            'user' : {'screen_name' : 'handle{}'.format(rng.randint(0, 99)),
+                      'id_str' : str(rng.randint(0, 99))},
+            'in_reply_to_status_id' : None
+        } for i in range(1, count + 1)]
+
+def summarize(name, latencies, elapsed, **params):
+    """ Builds a result record from latencies in seconds. """
+    latencies = sorted(latencies)
+    def percentile(fraction):
+        if not latencies:
+            return None
+        return latencies[min(int(fraction * len(latencies)),
+                             len(latencies) - 1)] * 1e6
+    result = {'benchmark' : name}
+    result.update(params)
+    result.update({
+            'count' : len(latencies),
+            'throughput_per_s' : len(latencies) / elapsed if elapsed else None,
+            'p50_us' : percentile(0.5),
+            'p99_us' : percentile(0.99),
+            'max_us' : percentile(1.0)
+        })
+    return result
+
+def compile_for(rules):
+    """ Fills in defaults the way load_rules() does and compiles. """
+    for rule in rules:
+        rule.setdefault('handles', [])
+        rule.setdefault('keywords', [])
+        rule.setdefault('condition', 'True')
+    return vickitrix.compile_rules(rules)
+
+def make_trader(rules, exchange):
+    return Trader(compile_for(rules), exchange,
+                  BalanceCache(exchange, max_staleness=None,
+                               refresh_interval=None),
+                  exchange, sleep_time=0, order_threads=0)
+
+def bench_match(rule_count, keyword_count, status_count, rng):
+    vocabulary = _words(2000, rng)
+    exchange = FakeExchange()
+    trader = make_trader(
+            make_rules(rule_count, keyword_count, rng, vocabulary), exchange
+        )
+    statuses = make_statuses(status_count, rng, vocabulary)
+    latencies = []
+    matched = 0
+    start = clock()
+    for status in statuses:
+        before = clock()
+        matched += len(trader.match(status))
+        latencies.append(clock() - before)
+    return summarize('match', latencies, clock() - start,
+                     rules=rule_count, keywords_per_rule=keyword_count,
+                     matched=matched)
+
+def bench_place(order_count, rng):
+    vocabulary = _words(10, rng)
+    exchange = FakeExchange()
+    trader = make_trader(make_rules(1, 1, rng, vocabulary), exchange)
+    compiled_order = trader.rule_index.rules[0]['orders'][0]
+    status = make_statuses(1, rng, vocabulary)[0]
+    latencies = []
+    start = clock()
+    for _ in range(order_count):
+        before = clock()
+        trader.place(status, compiled_order)
+        latencies.append(clock() - before)
+    return summarize('place', latencies, clock() - start)
+
+def bench_stream(rate, status_count, rng):
+    exchange = FakeExchange()
+    # Every status matches; size carries the status ID back to the exchange
+    rules = [{
+            'handles' : ['handle'],
+            'condition' : 'True',
+            'orders' : [{
+                    'side' : 'buy',
+                    'type' : 'limit',
+                    'product_id' : 'ETH-USD',
+                    'price' : '{inside_ask}',
+                    'size' : 'int({tweet}.rpartition("#")[2])'
+                }]
+        }]
+    listener = TradeListener(
+            compile_for(rules), exchange, 'app key', 'app secret',
+            'oauth token', 'oauth token secret', sleep_time=0,
+            max_staleness=None, refresh_interval=None, books=None,
+            queue_size=status_count, public_client=exchange,
+            event_log=EventLog(console=False), track_fills=False
+        )
+    statuses = [{
+            'id' : i,
+            'id_str' : str(i),
+            'text' : 'status #{}'.format(i),
+            'user' : {'screen_name' : 'handle', 'id_str' : '1'},
+            'in_reply_to_status_id' : None
+        } for i in range(1, status_count + 1)]
+    start = clock()
+    delivered = FakeStream(listener, rate).play(statuses)
+    listener.pipeline.stop()
+    elapsed = clock() - start
+    latencies = [exchange.placed[str(status_id)] - delivered_at
+                 for status_id, delivered_at in delivered.items()
+                 if str(status_id) in exchange.placed]
+    result = summarize('stream', latencies, elapsed, rate_per_s=rate)
+    result.update(dict(('pipeline_' + key, value) for key, value
+                       in listener.pipeline.stats().items()))
+    return result
+
+def bench_ingest(status_count, chunk_size, prefilter, rng):
+    exchange = FakeExchange()
+    rules = [{
+            'handles' : ['handle'],
+            'keywords' : ['zzz'],
+            'condition' : 'False',
+            'orders' : [{
+                    'side' : 'buy',
+                    'type' : 'market',
+                    'product_id' : 'ETH-USD',
+                    'funds' : '1'
+                }]
+        }]
+    listener = TradeListener(
+            compile_for(rules), exchange, 'app key', 'app secret',
+            'oauth token', 'oauth token secret', chunk_size=chunk_size,
+            max_staleness=None, refresh_interval=None,
+            queue_size=status_count, public_client=exchange,
+            event_log=EventLog(console=False), track_fills=False
+        )
+    listener.use_rules(listener.trader.rule_index.rules, {'handle' : '1'})
+    if not prefilter:
+        listener.author_patterns = None
+    vocabulary = _words(2000, rng)
+    messages = []
+    # As on a keyword stream, most statuses are by authors no rule follows;
+    # keys are in Twitter's order, which starts with "created_at"
+    for i in range(1, status_count + 1):
+        user_id = '1' if i % 10 == 0 else str(rng.randint(2, 10 ** 9))
+        messages.append(json.dumps(OrderedDict([
+                ('created_at', 'Mon Jan 01 00:00:00 +0000 2018'),
+                ('id', i), ('id_str', str(i)),
+                ('text', ' '.join(rng.choice(vocabulary) for _ in range(20))),
+                ('user', OrderedDict([
+                        ('id', int(user_id)), ('id_str', user_id),
+                        ('screen_name', 'user' + user_id),
+                        ('description', ' '.join(rng.sample(vocabulary, 10)))
+                    ])),
+                ('in_reply_to_status_id', None),
+                ('entities', {'hashtags' : [], 'urls' : []})
+            ]), separators=(',', ':')).encode('utf-8') + b'\r\n')
+    raw = b''.join(messages)
+    chunks = [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+    start = clock()
+    for message in split_messages(chunks):
+        if message and listener.admits(message):
+            listener._dispatch(None, message)
+    elapsed = clock() - start
+    listener.pipeline.stop()
+    result = {'benchmark' : 'ingest', 'chunk_size' : chunk_size,
+              'prefilter' : prefilter, 'count' : status_count,
+              'throughput_per_s' : status_count / elapsed}
+    result.update(dict(('pipeline_' + key, value) for key, value
+                       in listener.pipeline.stats().items()))
+    return result
+
+def bench_processes(rule_count, processes, status_count, rng):
+    vocabulary = _words(2000, rng)
+    exchange = FakeExchange()
+    rules = make_rules(rule_count, 5, rng, vocabulary)
+    for rule in rules:
+        # Matching is measured, not trading
+        rule['condition'] = 'False'
+    listener = TradeListener(
+            compile_for(rules), exchange, 'app key', 'app secret',
+            'oauth token', 'oauth token secret', max_staleness=None,
+            refresh_interval=None, queue_size=status_count,
+            public_client=exchange, event_log=EventLog(console=False),
+            track_fills=False, match_processes=processes
+        )
+    listener.use_rules(listener.trader.rule_index.rules,
+                       dict(('handle{}'.format(i), str(i))
+                            for i in range(50)))
+    # Every status is by a followed author, so none is turned away raw
+    messages = [json.dumps(OrderedDict(
+                    [('created_at', 'Mon Jan 01 00:00:00 +0000 2018')]
+                    + sorted(status.items())
+                ), separators=(',', ':')).encode('utf-8')
+                for status in make_statuses(status_count, rng, vocabulary,
+                                            words=40)]
+    start = clock()
+    for message in messages:
+        if listener.admits(message):
+            listener._dispatch(None, message)
+    if listener.match_pool is not None:
+        # Waits for workers to match everything they were handed
+        listener.match_pool.stop()
+    listener.pipeline.stop()
+    elapsed = clock() - start
+    result = {'benchmark' : 'processes', 'rules' : rule_count,
+              'processes' : processes, 'count' : status_count,
+              'throughput_per_s' : status_count / elapsed}
+    result.update(dict(('pipeline_' + key, value) for key, value
+                       in listener.pipeline.stats().items()))
+    return result
+
+def bench_load(rule_count, repeats, rng, rules_format='py'):
+    vocabulary = _words(2000, rng)
+    rules = make_rules(rule_count, 5, rng, vocabulary)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        rules_file = os.path.join(temp_dir, 'rules.' + rules_format)
+        with open(rules_file, 'w') as rules_stream:
+            if rules_format == 'json':
+                json.dump({'rules' : dsl.convert_rules(rules)}, rules_stream,
+                          indent=1)
+            else:
+                print('rules = ' + json.dumps(rules, indent=1),
+                      file=rules_stream)
+        latencies = []
+        start = clock()
+        for _ in range(repeats):
+            before = clock()
+            vickitrix.load_rules(rules_file)
+            latencies.append(clock() - before)
+        return summarize('load', latencies, clock() - start,
+                         rules=rule_count, format=rules_format)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true',
+            help='run a smaller sweep')
+    parser.add_argument('--output', '-o', type=str, default=None,
+            help='file to which to write results; default is stdout')
+    parser.add_argument('--seed', type=int, default=0,
+            help='random seed')
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    if args.quick:
+        rule_counts, keyword_counts, rates = [10, 100], [1, 10], [100, 1000]
+        status_count, load_repeats, process_counts = 1000, 3, [0, 2]
+    else:
+        rule_counts, keyword_counts = [10, 100, 1000], [1, 5, 20]
+        rates, status_count, load_repeats = [100, 1000, 5000], 5000, 10
+        process_counts = [0, 1, 2, 4, 8]
+    output_stream = (open(args.output, 'w') if args.output
+                     else sys.stdout)
+    def report(result):
+        print(json.dumps(result, sort_keys=True), file=output_stream)
+        output_stream.flush()
+    try:
+        for rule_count in rule_counts:
+            for keyword_count in keyword_counts:
+                report(bench_match(rule_count, keyword_count, status_count,
+                                   rng))
+        report(bench_place(status_count, rng))
+        for rate in rates:
+            report(bench_stream(rate, min(status_count, rate * 2), rng))
+        for chunk_size in [1, 65536]:
+            for prefilter in [False, True]:
+                report(bench_ingest(status_count * 10, chunk_size, prefilter,
+                                    rng))
+        for processes in process_counts:
+            report(bench_processes(rule_counts[-1], processes,
+                                   status_count * 5, rng))
+        for rule_count in rule_counts:
+            for rules_format in ['py', 'json']:
+                report(bench_load(rule_count, load_repeats, rng,
+                                  rules_format))
+    finally:
+        if output_stream is not sys.stdout:
+            output_stream.close()
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ setup(name='vickitrix',
       package_data={'vickitrix': ['*.py', './rules/*']},
       zip_safe=True,
       install_requires=[
-      		'twython', 'gdax', 'pycrypto'
+      		'twython', 'gdax', 'pycrypto', 'pyyaml'
       	],
       entry_points={
         'console_scripts': [
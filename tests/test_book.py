@@ -0,0 +1,85 @@
+"""
+tests.test_book
+
+Replays a recorded GDAX feed into order books.
+"""
+import os
+import unittest
+
+from vickitrix import book
+from vickitrix.book import OrderBooks, WebsocketFeed, read_feed
+
+# Snapshot and level-2 updates for ETH-USD, with heartbeats, as the GDAX
+# websocket feed sends them
+_feed_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'data', 'gdax_feed.jsonl')
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        # Each test sets the time the books see
+        self.now = 1000.0
+        self._monotonic = book.monotonic
+        book.monotonic = lambda: self.now
+        self.books = OrderBooks(['ETH-USD', 'BTC-USD'], max_staleness=5)
+
+    def tearDown(self):
+        book.monotonic = self._monotonic
+
+    def test_read_feed(self):
+        messages = list(read_feed(_feed_file))
+        self.assertEqual(len(messages), 8)
+        self.assertEqual(messages[1]['type'], 'snapshot')
+
+    def test_inside(self):
+        self.books.replay(read_feed(_feed_file))
+        self.assertEqual(self.books.inside('ETH-USD'), (301.5, 301.7))
+        levels = self.books.books['ETH-USD']
+        self.assertEqual(list(levels.bids.prices), [300.0, 301.25, 301.5])
+        self.assertEqual(levels.bids.sizes[301.5], 1.5)
+        self.assertEqual(list(levels.asks.prices), [301.7, 302.0, 303.1])
+
+    def test_inside_as_updates_arrive(self):
+        messages = list(read_feed(_feed_file))
+        self.books.replay(messages[:2])
+        self.assertEqual(self.books.inside('ETH-USD'), (301.5, 301.75))
+        self.books.replay(messages[2:5])
+        self.assertEqual(self.books.inside('ETH-USD'), (301.6, 301.7))
+
+    def test_unsynced_products(self):
+        self.books.replay(read_feed(_feed_file))
+        # Heartbeats alone don't make a book
+        self.assertIsNone(self.books.inside('BTC-USD'))
+        # Updates for products without books are ignored
+        self.assertIsNone(self.books.inside('LTC-USD'))
+        self.assertNotIn('LTC-USD', self.books.books)
+
+    def test_staleness(self):
+        self.books.replay(read_feed(_feed_file))
+        self.now += 5
+        self.assertEqual(self.books.inside('ETH-USD'), (301.5, 301.7))
+        self.now += 0.5
+        self.assertIsNone(self.books.inside('ETH-USD'))
+        # A heartbeat is enough to vouch for the book again
+        self.books.apply({'type' : 'heartbeat', 'product_id' : 'ETH-USD'})
+        self.assertEqual(self.books.inside('ETH-USD'), (301.5, 301.7))
+
+    def test_invalidate(self):
+        messages = list(read_feed(_feed_file))
+        self.books.replay(messages)
+        self.books.invalidate()
+        self.assertIsNone(self.books.inside('ETH-USD'))
+        # Neither heartbeats nor updates resync a book; only a snapshot
+        self.books.replay(messages[5:])
+        self.assertIsNone(self.books.inside('ETH-USD'))
+        self.books.replay(messages[1:2])
+        self.assertEqual(self.books.inside('ETH-USD'), (301.5, 301.75))
+
+class TestWebsocketFeed(unittest.TestCase):
+
+    def test_listen_is_abstract(self):
+        with self.assertRaises(NotImplementedError):
+            WebsocketFeed(reconnect_wait=0)._run()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+tests.test_dsl
+
+Checks parsing, type-checking, and compiling of rules' expressions.
+"""
+import unittest
+
+from vickitrix.dsl import (ExpressionError, compile_expression,
+                           compile_rules, convert_template)
+
+_variables = {'tweet' : 'string', 'inside_bid' : 'number',
+              'inside_ask' : 'number'}
+_currencies = set(['USD', 'ETH', 'BTC'])
+
+def evaluate(expression, result_type='number', tweet='',
+             available=None, inside_bid=0.0, inside_ask=0.0):
+    """ Compiles an expression and evaluates it.
+
+        expression: expression string
+        result_type: type the expression must have
+        tweet, available, inside_bid, inside_ask: values of variables
+
+        Return value: value of expression
+    """
+    function, _ = compile_expression(expression, _variables, _currencies,
+                                     result_type)
+    return function(tweet, available if available is not None else {},
+                    inside_bid, inside_ask)
+
+class TestPrecedence(unittest.TestCase):
+
+    def test_arithmetic(self):
+        self.assertEqual(evaluate('1 + 2 * 3'), 7)
+        self.assertEqual(evaluate('(1 + 2) * 3'), 9)
+        self.assertEqual(evaluate('10 - 4 - 3'), 3)
+        self.assertEqual(evaluate('2 * -3 + 1'), -5)
+
+    def test_division_is_true_division(self):
+        self.assertEqual(evaluate('1 / 2'), 0.5)
+        self.assertEqual(evaluate('8 / 4 / 2'), 1)
+
+    def test_boolean(self):
+        # "and" binds tighter than "or", and "not" tighter than both
+        self.assertTrue(evaluate('true or false and false', 'bool'))
+        self.assertFalse(evaluate('(true or false) and false', 'bool'))
+        self.assertTrue(evaluate('not false and true', 'bool'))
+        self.assertFalse(evaluate('not (false or true)', 'bool'))
+
+    def test_comparison_binds_tighter_than_and(self):
+        self.assertTrue(evaluate('1 + 1 == 2 and 3 > 2 * 1', 'bool'))
+        self.assertTrue(evaluate('inside_bid < inside_ask or false', 'bool',
+                                 inside_bid=1.0, inside_ask=2.0))
+
+    def test_available(self):
+        self.assertEqual(evaluate('available[USD] * 0.5',
+                                  available={'USD' : 100.0}), 50)
+        self.assertEqual(evaluate('available.eth + 1',
+                                  available={'ETH' : 2.0}), 3)
+        # A currency with no account has nothing available
+        self.assertEqual(evaluate('available[BTC]'), 0)
+
+class TestMembership(unittest.TestCase):
+
+    def test_in(self):
+        self.assertTrue(evaluate('"long" in tweet', 'bool',
+                                 tweet='going long ETH'))
+        self.assertFalse(evaluate('"short" in tweet', 'bool',
+                                  tweet='going long ETH'))
+
+    def test_not_in(self):
+        self.assertTrue(evaluate('"short" not in tweet', 'bool',
+                                 tweet='going long ETH'))
+        self.assertFalse(evaluate('"long" not in tweet', 'bool',
+                                  tweet='going long ETH'))
+
+    def test_in_with_functions(self):
+        self.assertTrue(evaluate('"ethusd" in lower(tweet)', 'bool',
+                                 tweet='Long ETHUSD'))
+        self.assertTrue(evaluate(
+                '"LONG" in upper(tweet) and "SHORT" not in upper(tweet)',
+                'bool', tweet='long'
+            ))
+
+    def test_in_needs_strings(self):
+        with self.assertRaises(ExpressionError):
+            evaluate('1 in tweet', 'bool')
+
+class TestStrings(unittest.TestCase):
+
+    def test_quotes(self):
+        self.assertTrue(evaluate('\'it\\\'s\' in tweet', 'bool',
+                                 tweet="it's up"))
+        self.assertTrue(evaluate('"say \\"buy\\"" in tweet', 'bool',
+                                 tweet='say "buy" now'))
+
+    def test_nothing_breaks_out_of_a_string(self):
+        for expression in [
+                '"\\" + __import__(\'os\').getcwd() + \\"" in tweet',
+                '\'\\\' or __import__("os") or \\\'\' in tweet',
+                '"\\\\" in tweet',
+                '"\\n" in tweet'
+            ]:
+            # Each is a single string literal, whatever it holds
+            self.assertFalse(evaluate(expression, 'bool', tweet='x'),
+                             expression)
+
+    def test_backslash_is_literal(self):
+        self.assertTrue(evaluate('"a\\\\b" in tweet', 'bool',
+                                 tweet='a\\b'))
+
+    def test_unterminated_string(self):
+        with self.assertRaises(ExpressionError) as caught:
+            evaluate('"long in tweet', 'bool')
+        self.assertEqual(caught.exception.position, 0)
+
+    def test_names_are_not_python(self):
+        for expression in ['__import__("os")', 'tweet.upper()',
+                           'open("x")']:
+            with self.assertRaises(ExpressionError):
+                evaluate(expression, 'string')
+
+class TestErrors(unittest.TestCase):
+
+    def test_unknown_currency(self):
+        with self.assertRaises(ExpressionError) as caught:
+            evaluate('1 + available[XRP]')
+        self.assertIn('XRP', str(caught.exception))
+        self.assertEqual(caught.exception.position, 4)
+
+    def test_unknown_variable(self):
+        with self.assertRaises(ExpressionError) as caught:
+            evaluate('"x" in tweet and price > 2', 'bool')
+        self.assertIn('price', str(caught.exception))
+        self.assertEqual(caught.exception.position, 17)
+
+    def test_type_mismatch(self):
+        with self.assertRaises(ExpressionError) as caught:
+            evaluate('tweet + 1')
+        self.assertEqual(caught.exception.position, 6)
+
+    def test_wrong_result_type(self):
+        with self.assertRaises(ExpressionError):
+            evaluate('1 + 1', 'bool')
+
+    def test_unexpected_character(self):
+        with self.assertRaises(ExpressionError) as caught:
+            evaluate('1 + 2 ; 3')
+        self.assertEqual(caught.exception.position, 6)
+
+    def test_rule_with_unknown_currency(self):
+        with self.assertRaises(RuntimeError) as caught:
+            compile_rules([{'handles' : ['someone'],
+                            'orders' : [{'side' : 'buy', 'type' : 'market',
+                                         'product_id' : 'ETH-USD',
+                                         'funds' : 'available[XRP]'}]}])
+        message = str(caught.exception)
+        self.assertIn('funds of order #1 of rule #1', message)
+        # The caret is under the currency's position
+        self.assertIn('    available[XRP]', message)
+        self.assertIn('\n    ^', message.replace('\r\n', '\n'))
+
+    def test_rule_with_unknown_product(self):
+        rule = {'handles' : ['someone'],
+                'orders' : [{'side' : 'buy', 'type' : 'market',
+                             'product_id' : 'XRP-USD', 'funds' : 10}]}
+        with self.assertRaises(RuntimeError) as caught:
+            compile_rules([rule])
+        self.assertIn('XRP-USD', str(caught.exception))
+        # Products a rules file adds are allowed
+        compiled = compile_rules([rule], products=['XRP-USD'])
+        self.assertEqual(compiled[0]['orders'][0]['money'][0][0], 'funds')
+
+    def test_rule_with_client_oid(self):
+        with self.assertRaises(RuntimeError) as caught:
+            compile_rules([{'handles' : ['someone'],
+                            'orders' : [{'side' : 'buy', 'type' : 'market',
+                                         'product_id' : 'ETH-USD',
+                                         'funds' : 10,
+                                         'client_oid' : 'fixed'}]}])
+        self.assertIn('client_oid', str(caught.exception))
+
+class TestConvertTemplate(unittest.TestCase):
+
+    def round_trip(self, template, **values):
+        """ Evaluates a converted template the way a Python rules file
+            would have, and compares. """
+        expected = eval(template.format(**values))
+        self.assertEqual(evaluate(convert_template(template),
+                                  'bool' if isinstance(expected, bool)
+                                  else 'number', **values), expected)
+
+    def test_available(self):
+        self.assertEqual(convert_template('{available[USD]} * 0.5'),
+                         'available[USD] * 0.5')
+        self.assertEqual(convert_template('{available["ETH"]}'),
+                         'available[ETH]')
+        self.assertEqual(convert_template("{available['BTC']} / 2"),
+                         'available[BTC] / 2')
+        self.round_trip('{available[USD]} * 0.5',
+                        available={'USD' : 100.0})
+        self.round_trip('min({available[ETH]}, 2) + {inside_bid}',
+                        available={'ETH' : 3.0}, inside_bid=10.0)
+
+    def test_condition(self):
+        # As in the Python rules files vickitrix used to ship
+        converted = convert_template(
+                '"ETHUSD" in {tweet} and "long" in {tweet}'
+            )
+        self.assertEqual(converted, '"ETHUSD" in tweet and "long" in tweet')
+        self.assertTrue(evaluate(converted, 'bool',
+                                 tweet='Going long ETHUSD'))
+        self.assertFalse(evaluate(converted, 'bool',
+                                  tweet='Going short ETHUSD'))
+        self.assertEqual(convert_template('{inside_ask} > 1 or False'),
+                         'inside_ask > 1 or false')
+        self.round_trip('{inside_ask} > 1 or False', inside_ask=2.0)
+
+    def test_not_a_string(self):
+        self.assertEqual(convert_template(0.5), 0.5)
+        self.assertIs(convert_template(True), True)
+
+if __name__ == '__main__':
+    unittest.main()
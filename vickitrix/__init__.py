@@ -5,12 +5,23 @@ vickitrix
 Checks tweets using http://www.tweepy.org/ and
 uses rules specified in file to make market trades on GDAX using
 https://github.com/danpaquin/GDAX-Python. Default rules are stored in 
-rules/vicki.py and follow the tweets of @vickicryptobot.
+rules/vicki.yaml and follow the tweets of @vickicryptobot.
 """
 from __future__ import print_function
 
 import sys
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+# When vickitrix began loading, and what was loaded already, for
+# --profile-startup
+_load_started = monotonic()
+_preloaded_modules = set(sys.modules)
+
 # For 2-3 compatibility
 try:
     input = raw_input
@@ -18,38 +29,10 @@ except NameError:
     pass
 
 _help_intro = """vickitrix allows users to base GDAX trades on tweets."""
-_key_derivation_iterations = 5000
-
-try:
-    import gdax
-except ImportError as e:
-    e.message = (
-         'vickitrix requires GDAX-Python. Install it with "pip install gdax".'
-        )
-    raise
-
-try:
-    from twython import TwythonStreamer, Twython, TwythonError
-except ImportError as e:
-    e.message = (
-            'vickitrix requires Twython. Install it with '
-            '"pip install twython".'
-        )
-    raise
-
-try:
-    from Crypto.Cipher import AES
-    from Crypto.Protocol import KDF
-    from Crypto import Random
-except ImportError as e:
-    e.message = (
-        'vickitrix requires PyCrypto. Install it with '
-        '"pip install pycrypto".'
-    )
-    raise
 
 import os
 import errno
+import threading
 import time
 import argparse
 import getpass
@@ -59,60 +42,120 @@ import json
 # In case user wants to use regular expressions on conditions/funds
 import re
 
+from . import dsl
+from .book import gdax_feed_url
+from .dedup import rule_fingerprint
+from .display import print_to_screen, timestamp, prettify_dict, print_dough
+from .startup import StartupProfile
+
 def help_formatter(prog):
     """ So formatter_class's max_help_position can be changed. """
     return argparse.HelpFormatter(prog, max_help_position=40)
 
-def print_to_screen(message, newline=True, carriage_return=False):
-    """ Prints message to stdout as well as stderr if stderr is redirected.
-
-        message: message to print
-        newline: True iff newline should be printed
-        carriage_return: True iff carriage return should be printed; also
-            clears line with ANSI escape code
+class _TemplateField(object):
+    """ Stands in for a rule template field during compilation.
 
-        No return value.
+        str.format() on a rule's condition or money expression normally
+        substitutes current values; formatting with instances of this class
+        instead substitutes variable names, so "{available[USD]}*0.5" becomes
+        the Python source "available['USD']*0.5", which can be compiled once.
     """
-    full_message = ('\x1b[K' + message + ('\r' if carriage_return else '')
-                        + (os.linesep if newline else ''))
-    try:
-        sys.stderr.write(full_message)
-        if sys.stderr.isatty():
-            sys.stderr.flush()
-        else:
-            try:
-                # So the user sees it too
-                sys.stdout.write(full_message)
-                sys.stdout.flush()
-            except UnicodeEncodeError:
-                sys.stdout.write(
-                                unicodedata.normalize(
-                                        'NFKD', full_message
-                                    ).encode('ascii', 'ignore')
-                            )
-                sys.stdout.flush()
-    except UnicodeEncodeError:
-        sys.stderr.write(
-                        unicodedata.normalize(
-                                'NFKD', full_message
-                            ).encode('ascii', 'ignore')
-                    )
-        sys.stderr.flush()
+    def __init__(self, name, used):
+        self.name = name
+        self.used = used
+
+    def __getitem__(self, key):
+        return _TemplateField('{}[{!r}]'.format(self.name, key), self.used)
+
+    def __format__(self, format_spec):
+        self.used.add(self.name.partition('[')[0])
+        return self.name
+
+_template_fields = ['tweet', 'available', 'inside_bid', 'inside_ask']
 
-def timestamp():
-    """ Returns timestamp string. """
-    return time.strftime('%A, %b %d, %Y at %I:%M:%S %p %Z || ',
-                         time.localtime(time.time()))
+def compile_template(template, description='<rule>'):
+    """ Compiles a rule condition or money expression into a function.
 
-def prettify_dict(rule):
-    """ Prettifies printout of dictionary as string.
+        template: string with {tweet}, {available[<currency>]}, {inside_bid},
+            and/or {inside_ask} fields, as written in a rules file
+        description: filename-like description of the template's origin,
+            shown in tracebacks
 
-        rule: rule
+        Return value: tuple (function, set of template fields used), where
+            function takes arguments tweet, available, inside_bid, and
+            inside_ask and returns the value of the expression
+    """
+    used = set()
+    source = template.format(**dict(
+            (field, _TemplateField(field, used)) for field in _template_fields
+        ))
+    return eval(compile(
+            ''.join(['lambda ', ', '.join(_template_fields), ': (', source,
+                     '\n)']),
+            description, 'eval'
+        ), globals()), used
+
+def compile_rules(rules, rules_file='<rules>'):
+    """ Compiles conditions and money expressions of validated rules.
 
-        Return value: rule string
+        rules: list of rules that have passed validation, so every rule has
+            "handles", "keywords", "condition", and "orders"
+        rules_file: name of file from which rules were loaded
+
+        Return value: list of compiled rules, each a dictionary with keys
+            "handles" and "keywords" (as in the rule); "condition", a function
+            of tweet, available, inside_bid, and inside_ask; "orders", a list
+            of dictionaries with keys "static" (order parameters that aren't
+            templates), "money" (list of tuples (parameter, function)),
+            "needs_book" (True iff a template uses the inside bid or ask),
+            and "source" (tuple (rule_fingerprint() of rule, index of
+            order in rule), from which client_oids are derived);
+            "execution", "parallel" or "sequential"; and "rule", the original
+            rule
     """
-    return json.dumps(rule, sort_keys=False,
-                        indent=4, separators=(',', ': '))
+    compiled_rules = []
+    for i, rule in enumerate(rules):
+        try:
+            condition, _ = compile_template(
+                    rule['condition'],
+                    '<{}: rule #{} condition>'.format(rules_file, i+1)
+                )
+            fingerprint = rule_fingerprint(rule)
+            compiled_orders = []
+            for j, order in enumerate(rule['orders']):
+                compiled_order = {'static' : {}, 'money' : [],
+                                  'needs_book' : False,
+                                  'source' : (fingerprint, j)}
+                for key, value in order.items():
+                    if key not in ['size', 'funds', 'price']:
+                        compiled_order['static'][key] = value
+                        continue
+                    function, used = compile_template(
+                            value,
+                            '<{}: rule #{} order #{} {}>'.format(
+                                    rules_file, i+1, j+1, key
+                                )
+                        )
+                    compiled_order['money'].append((key, function))
+                    if 'inside_bid' in used or 'inside_ask' in used:
+                        compiled_order['needs_book'] = True
+                compiled_orders.append(compiled_order)
+        except Exception:
+            raise RuntimeError(''.join([
+                    ('The following rule from the file "{}" could not be '
+                     'compiled; check the format and try again:').format(
+                            rules_file
+                        ), os.linesep, prettify_dict(rule)
+                ]))
+        compiled_rules.append({
+                'handles' : rule['handles'],
+                'keywords' : rule['keywords'],
+                'condition' : condition,
+                'orders' : compiled_orders,
+                'execution' : rule.get('execution', 'parallel'),
+                'rule' : rule
+            })
+    return compiled_rules
 
 def get_dough(gdax_client, status_update=False):
     """ Retrieve dough in user accounts
@@ -126,116 +169,210 @@ def get_dough(gdax_client, status_update=False):
     for account in gdax_client.get_accounts():
         dough[account['currency']] = account['available']
     if status_update:
-        print_to_screen(''.join([timestamp(), 'Available to trade: ',
-                        ', '.join(map(' '.join,
-                                        [el[::-1] for el in dough.items()]))]))
+        print_dough(dough)
     return dough
 
-class TradeListener(TwythonStreamer):
-    """ Trades on GDAX based on tweets. """
-
-    def __init__(self, rules, gdax_client,
-                 app_key, app_secret, oauth_token, oauth_token_secret,
-                 timeout=300, retry_count=None, retry_in=10, client_args=None,
-                 handlers=None, chunk_size=1, sleep_time=0.5):
-        super(TradeListener, self).__init__(
-                app_key, app_secret, oauth_token, oauth_token_secret,
-                timeout=300, retry_count=None, retry_in=10, client_args=None,
-                handlers=None, chunk_size=1
+def load_rules(rules_file):
+    """ Loads, checks, and compiles rules.
+
+        rules_file: YAML or JSON rules file (see vickitrix.dsl), or Python
+            file that sets the variable "rules" to a list of dictionaries
+
+        Return value: list of compiled rules from compile_rules()
+    """
+    if os.path.splitext(rules_file)[1].lower() in ['.yaml', '.yml', '.json']:
+        return dsl.load_rules(rules_file)
+    from imp import load_source
+    try:
+        rules = load_source('rules', rules_file).rules
+    except IOError as e:
+        e.message = 'Cannot find or access rules file "{}".'.format(
+                                                                rules_file
+                                                            )
+        raise
+    import copy
+    # Add missing keys so listener doesn't fail
+    new_rules = copy.copy(rules)
+    order_vocab = set(['client_oid', 'type', 'side', 'product_id', 'stp',
+                       'price', 'size', 'time_in_force', 'cancel_after',
+                       'post_only', 'funds', 'overdraft_enabled',
+                       'funding_amount'])
+    for i, rule in enumerate(rules):
+        # Check 'condition'
+        try:
+            eval(rule['condition'].format(
+                    tweet='"The rain in Spain stays mainly in the plain."',
+                    available={
+                        'ETH' : .01,
+                        'USD' : .01,
+                        'LTC' : .01,
+                        'BTC' : .01
+                    }
+                ))
+        except KeyError:
+            # 'condition' isn't required, so make default True
+            new_rules[i]['condition'] = 'True'
+        except:
+            raise RuntimeError(''.join([
+                    ('"condition" from the following rule in the file '
+                     '"{}" could not be '
+                     'evaluated; check the format '
+                     'and try again: ').format(rules_file),
+                    os.linesep, prettify_dict(rule)
+                ])
             )
-        self.rules = rules
-        self.gdax_client = gdax_client
-        self.sleep_time = sleep_time
-        self.available = get_dough(self.gdax_client, status_update=False)
-        self.public_client = gdax.PublicClient() # for product order book
-
-    def on_success(self, status):
-        for rule in self.rules:
-            if ((not rule['handles'])
-                 or ('user' in status
-                     and status['user']['screen_name'].lower()
-                 in rule['handles'])) and ((not rule['keywords'])
-                 or any([keyword in status['text'].lower()
-                            for keyword in rule['keywords']])) and eval(
-                        rule['condition'].format(
-                            tweet='status["text"]',
-                            available=self.available
-                    )):
-                if (('retweeted_status' in status 
-                     and status['retweeted_status'])
-                     or status['in_reply_to_status_id']
-                     or status['in_reply_to_status_id_str']
-                     or status['in_reply_to_user_id']
-                     or status['in_reply_to_user_id_str']
-                     or status['in_reply_to_screen_name']):
-                    # This is an RT or reply; don't do anything
-                    return
-                # Condition satisfied! Perform action
-                print_to_screen(
-                        ''.join(
-                            [timestamp(), 'TWEET MATCHED || @',
-                             status['user']['screen_name'] , ': ',
-                             status['text']]
-                        )
-                    )
-                for order in rule['orders']:
-                    self.available = get_dough(self.gdax_client,
-                                                    status_update=True)
-                    order_book = self.public_client.get_product_order_book(
-                            order['product_id']
-                        )
-                    inside_bid, inside_ask = (
-                            order_book['bids'][0][0],
-                            order_book['asks'][0][0]
-                        )
-                    not_enough = False
-                    for money in ['size', 'funds', 'price']:
-                        try:
-                            '''If the hundredths rounds down to zero,
-                            ain't enough'''
-                            order[money] = str(eval(
-                                    order[money].format(
-                                            tweet='status.text',
-                                            available=self.available,
-                                            inside_bid=inside_bid,
-                                            inside_ask=inside_ask
-                                        )
-                                ))
-                            not_enough = (
-                                    int(float(order[money]) * 100) == 0
-                                )
-                        except KeyError:
-                            pass
-                    print_to_screen(''.join(
-                                [timestamp(), 'PLACING ORDER', os.linesep] +
-                                [prettify_dict(order)]
-                            ))
-                    if not_enough:
-                        print_to_screen(
-                                timestamp() +
-                                'One of {"price", "funds", "size"} is zero! ' +
-                                'Order not placed.'
-                            )
-                        return
-                    if order['side'] == 'buy':
-                        self.gdax_client.buy(**order)
-                    else:
-                        assert order['side'] == 'sell'
-                        self.gdax_client.sell(**order)
-                    print_to_screen(timestamp() + 'Order placed.')
-                    time.sleep(self.sleep_time)
-                get_dough(self.gdax_client, status_update=True)
-
-    def on_error(self, status_code, status):
-        if status_code == 420:
-            # Rate limit error; bail and wait to reconnect
-            self.disconnect()
+        # Check 'execution'
+        if rule.get('execution', 'parallel') not in [
+                'parallel', 'sequential'
+            ]:
+            raise RuntimeError(''.join([
+                    ('A rule\'s "execution" must be one of {{"parallel", '
+                     '"sequential"}}, which this rule from the file "{}" '
+                     'doesn\'t satisfy:').format(rules_file),
+                    os.linesep, prettify_dict(rule)
+                ])
+            )
+        # Check handles or keywords
+        if 'handles' not in rule and 'keywords' not in rule:
+            raise RuntimeError(''.join([
+                    ('A rule must have at least one of {{"handles", '
+                     '"keywords"}}, but this rule from the file "{}" '
+                     'doesn\'t:').format(rules_file),
+                    os.linesep, prettify_dict(rule)
+                ])
+            )
+        if 'handles' not in rule:
+            new_rules[i]['handles'] = []
+        if 'keywords' not in rule:
+            new_rules[i]['keywords'] = []
+        new_rules[i]['handles'] = [
+                handle.lower() for handle in new_rules[i]['handles']
+            ]
+        new_rules[i]['keywords'] = [
+                keyword.lower() for keyword in new_rules[i]['keywords']
+            ]
+        '''Validate order; follow https://docs.gdax.com/#orders for 
+        filling in default values.'''
+        if 'orders' not in rule or not isinstance(rule['orders'], list):
+            raise RuntimeError(''.join([
+                    ('Every rule must have an "orders" list, but '
+                     'this rule from the file "{}" doesn\'t:').format(
+                    rules_file), os.linesep, prettify_dict(rule)
+                ])
+            )
+        for j, order in enumerate(rule['orders']):
+            if not isinstance(order, dict):
+                raise RuntimeError(''.join([
+                    ('Every order must be a dictionary, but order #{} '
+                     'from this rule in the file "{}" isn\'t:').format(
+                    j+1, rules_file), os.linesep, prettify_dict(rule)]))
+            unrecognized_keys = [
+                    key for key in order if key not in order_vocab
+                ]
+            if unrecognized_keys:
+                raise RuntimeError(''.join([
+                    'In the file "{}", the "order" key(s) '.format(
+                        rules_file),
+                    os.linesep, '[',
+                    ', '.join(unrecognized_keys), ']', os.linesep,
+                    ('are invalid yet present in order #{} of '
+                     'the following rule:').format(j+1),
+                    os.linesep, prettify_dict(rule)
+                ]))
+            try:
+                if order['type'] not in [
+                        'limit', 'market', 'stop'
+                    ]:
+                    raise RuntimeError(''.join([
+                        ('An order\'s "type" must be one of {{"limit", '
+                         '"market", "stop"}}, which order #{} in this '
+                         'rule from the file "{}" doesn\'t '
+                         'satisfy:').format(j+1, rules_file),
+                        os.linesep, prettify_dict(rule)
+                    ]))
+            except KeyError:
+                # GDAX default is limit
+                new_rules[i]['orders'][j]['type'] = 'limit'
+            if 'side' not in order:
+                raise RuntimeError(''.join([
+                        ('An order must have a "side", but order #{} in '
+                         'this rule from the file "{}" doesn\'t:').format(
+                         j+1, rules_file), os.linesep, prettify_dict(rule)
+                    ])
+                )
+            if order['side'] not in ['buy', 'sell']:
+                    raise RuntimeError(''.join([
+                        ('An order\'s "side" must be one of {{"buy", '
+                         '"sell"}}, which order #{} in this rule '
+                         'from the file "{}" doesn\'t satisfy:').format(
+                         j+1, rules_file), os.linesep, prettify_dict(rule)
+                    ])
+                )
+            if 'product_id' not in order:
+                raise RuntimeError(''.join([
+                        ('An order must have a "product_id", but in the '
+                         'file "{}", order #{} from this rule '
+                         'doesn\'t:').format(rules_file, j+1),
+                        os.linesep, prettify_dict(rule)
+                    ]))
+            if new_rules[i]['orders'][j]['type'] == 'limit':
+                for item in ['price', 'size']:
+                    if item not in order:
+                        raise RuntimeError(''.join([
+                            ('If an order\'s "type" is "limit", the order '
+                             'must specify a "{}", but in the file "{}",'
+                             'order #{} from this rule doesn\'t:').format(
+                             item, rules_file, j+1),
+                             os.linesep, prettify_dict(rule)
+                        ]))
+            elif new_rules[i]['orders'][j]['type'] in ['market', 'stop']:
+                if 'size' not in order and 'funds' not in order:
+                    raise RuntimeError(''.join([
+                            ('If an order\'s "type" is "{}", the order '
+                             'must have at least one of {{"size", '
+                             '"funds"}}, but in file "{}", order #{} '
+                             'of this rule doesn\'t:').format(
+                                    new_rules[i]['orders'][j]['type'],
+                                    rules_file, j+1
+                                ), os.linesep, prettify_dict(rule)]))
+            for stack in ['size', 'funds', 'price']:
+                try:
+                    eval(order[stack].format(
+                        tweet=('"The rain in Spain stays mainly '
+                               'in the plain."'),
+                        available={
+                            'ETH' : .01,
+                            'USD' : .01,
+                            'LTC' : .01,
+                            'BTC' : .01
+                        }, inside_bid=200, inside_ask=200))
+                except KeyError:
+                    pass
+                except Exception as e:
+                    raise RuntimeError(''.join([
+                            ('"{}" from order #{} in the following '
+                             'rule from the file "{}" could not be '
+                             'evaluated; check the format '
+                             'and try again:').format(
+                                    stack, j+1, rules_file
+                                ), os.linesep, prettify_dict(rule)]))
+    # Compile conditions and money expressions once, not per tweet
+    return compile_rules(new_rules, rules_file)
 
 def go():
     """ Entry point """
+    # Startup covers loading vickitrix; each subcommand imports only what
+    # it needs
+    startup = StartupProfile(_load_started, _preloaded_modules)
+    startup.mark('import')
     # Print file's docstring if -h is invoked
     parser = argparse.ArgumentParser(description=_help_intro, 
                 formatter_class=help_formatter)
+    parser.add_argument('--profile-startup', action='store_true',
+            help=('print to stderr how long each stage of startup took and '
+                  'which modules it loaded, once the subcommand is ready '
+                  'to do its work')
+        )
     subparsers = parser.add_subparsers(help=(
                 'subcommands; add "-h" or "--help" '
                 'after a subcommand for its parameters'),
@@ -249,7 +386,7 @@ def go():
                                         os.path.join(
                                             os.path.expanduser('~'),
                                             '.vickitrix',
-                                            'config')
+                                            'profiles.json')
                                     )
                             )
                         )
@@ -262,343 +399,683 @@ def go():
             default='default',
             help='which profile to use for trading'
         )
+    trade_parser.add_argument('--account', '-a', type=str, required=False,
+            action='append', default=None, metavar='PROFILE[=RULES]',
+            help=('trade for this profile\'s GDAX account with this rules '
+                  'file (default: --rules); repeat to trade for several '
+                  'accounts from one Twitter stream, which is read with the '
+                  'first account\'s Twitter credentials until it takes '
+                  'more than one connection')
+        )
+    trade_parser.add_argument('--stream-profile', type=str, required=False,
+            action='append', default=None, metavar='PROFILE',
+            help=('also connect to Twitter with this profile\'s Twitter '
+                  'credentials when rules follow or track more than '
+                  'one connection can; repeat for more connections. '
+                  'Profiles passed to --account are used first')
+        )
+    trade_parser.add_argument('--max-follow', type=int, required=False,
+            default=5000,
+            help='most users one connection to Twitter can follow'
+        )
+    trade_parser.add_argument('--max-track', type=int, required=False,
+            default=400,
+            help='most keywords one connection to Twitter can track'
+        )
+    trade_parser.add_argument('--agent-socket', type=str, required=False,
+            default=None,
+            help=('Unix socket of a "vickitrix agent" holding the '
+                  'profile\'s key; default is ~/.vickitrix/agent.sock')
+        )
+    trade_parser.add_argument('--no-agent', action='store_true',
+            help=('always prompt for the profile\'s password rather than '
+                  'asking a running agent for its key')
+        )
     trade_parser.add_argument('--rules', '-r', type=str, required=False,
             default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                    'rules', 'vicki.py'),
-            help=('rules file; this is Python that sets the variable "rules" '
-                  'to a list of dictionaries')
+                                    'rules', 'vicki.yaml'),
+            help=('rules file in YAML (.yaml or .yml) or JSON (.json); '
+                  'Python rules files (.py) that set the variable "rules" '
+                  'to a list of dictionaries still work')
         )
     trade_parser.add_argument('--interval', '-i', type=float, required=False,
-            default=905,
-            help=('how long to wait (in s) before reattempting to connect '
-                  'after getting rate-limited')
+            default=960,
+            help=('longest wait (in s) before reconnecting after Twitter '
+                  'rate-limits connections; waits start at 60 s and double')
+        )
+    trade_parser.add_argument('--stall-timeout', type=float,
+            required=False, default=90,
+            help=('reconnect to Twitter when the stream has sent nothing, '
+                  'not even a keep-alive, for this long (in s)')
         )
     trade_parser.add_argument('--sleep', '-s', type=float, required=False,
             default=0.5,
-            help='how long to wait (in s) after an order has been placed'
+            help=('how long to wait (in s) after an order has been placed; '
+                  'used only with --no-fill-tracking')
+        )
+    trade_parser.add_argument('--fill-timeout', type=float, required=False,
+            default=10,
+            help=('most time (in s) an order waits for the order before it '
+                  'in the same rule to be done (filled or canceled)')
+        )
+    trade_parser.add_argument('--no-fill-tracking', action='store_true',
+            help=('don\'t follow orders until they fill; sleep after each '
+                  'order instead, and check balances with GDAX')
+        )
+    trade_parser.add_argument('--balance-refresh', type=float,
+            required=False, default=15,
+            help=('how often (in s) to check amounts available to trade with '
+                  'GDAX in the background; 0 disables periodic checks')
+        )
+    trade_parser.add_argument('--balance-staleness', type=float,
+            required=False, default=60,
+            help=('maximum age (in s) of cached amounts available to trade '
+                  'used for an order; older amounts are checked with GDAX '
+                  'first')
+        )
+    trade_parser.add_argument('--book-feed', type=str, required=False,
+            default=gdax_feed_url,
+            help=('GDAX websocket feed from which to keep order books for '
+                  'products whose orders use the inside bid or ask, and '
+                  'from which to hear of fills; pass "" to request the '
+                  'order book for every order and poll orders for fills '
+                  'instead')
+        )
+    trade_parser.add_argument('--queue-size', type=int, required=False,
+            default=1000,
+            help=('maximum number of tweets waiting to be matched against '
+                  'rules, and of matched tweets waiting for orders to be '
+                  'placed')
+        )
+    trade_parser.add_argument('--executors', type=int, required=False,
+            default=4,
+            help=('number of threads placing orders; orders for different '
+                  'products are placed concurrently')
+        )
+    trade_parser.add_argument('--order-threads', type=int, required=False,
+            default=4,
+            help=('maximum number of orders from one rule placed at once; '
+                  'a rule\'s orders for different products are placed '
+                  'concurrently unless its "execution" is "sequential"')
+        )
+    trade_parser.add_argument('--match-processes', type=int,
+            required=False, default=0,
+            help=('decode statuses and match them against rules\' handles '
+                  'and keywords in this many worker processes, so busy '
+                  'streams can use several cores; 0 does it in this '
+                  'process')
+        )
+    trade_parser.add_argument('--http-pool-size', type=int, required=False,
+            default=4,
+            help='number of keep-alive connections to GDAX to keep open'
+        )
+    trade_parser.add_argument('--http-timeout', type=float, required=False,
+            default=10,
+            help='timeout (in s) for requests to GDAX'
+        )
+    trade_parser.add_argument('--http-keepalive', type=float,
+            required=False, default=30,
+            help=('how often (in s) to make a lightweight request on each '
+                  'connection to GDAX so it stays open between trades; '
+                  '0 disables keep-alive requests')
+        )
+    trade_parser.add_argument('--gdax-rate', type=float, required=False,
+            default=5,
+            help=('most requests per second to make to GDAX\'s private '
+                  'endpoints for each account, in bursts of up to twice '
+                  'that; orders go ahead of other waiting requests. 0 '
+                  'disables rate limiting')
+        )
+    trade_parser.add_argument('--gdax-public-rate', type=float,
+            required=False, default=3,
+            help=('most requests per second to make to GDAX\'s public '
+                  'endpoints, like order books, in bursts of up to twice '
+                  'that; 0 disables rate limiting')
+        )
+    trade_parser.add_argument('--metrics-port', type=int, required=False,
+            default=None,
+            help=('serve counters and per-stage latency histograms in the '
+                  'Prometheus text format on this port of localhost')
+        )
+    trade_parser.add_argument('--statsd', type=str, required=False,
+            default=None,
+            help=('send counters and per-stage latencies to a StatsD '
+                  'server at this HOST:PORT over UDP')
+        )
+    trade_parser.add_argument('--seen-capacity', type=int, required=False,
+            default=100000,
+            help=('number of status IDs remembered in ~/.vickitrix/seen.json '
+                  'so statuses Twitter delivers again, even after a '
+                  'restart, aren\'t traded on twice; 0 remembers none')
+        )
+    trade_parser.add_argument('--order-retries', type=int, required=False,
+            default=3,
+            help=('most times to resend an order GDAX may not have gotten, '
+                  'after checking by its client_oid that it wasn\'t placed')
+        )
+    trade_parser.add_argument('--user-cache-ttl', type=float,
+            required=False, default=86400,
+            help=('how long (in s) user IDs of handles looked up on '
+                  'Twitter are cached in ~/.vickitrix/users.json; 0 caches '
+                  'them forever')
+        )
+    trade_parser.add_argument('--reload-interval', type=float,
+            required=False, default=2,
+            help=('how often (in s) to check the rules file for changes, '
+                  'which take effect without restarting; 0 disables reloads')
+        )
+    trade_parser.add_argument('--log', type=str, required=False,
+            default=None,
+            help=('file to which to write matched tweets, orders, and '
+                  'errors as JSON lines')
+        )
+    trade_parser.add_argument('--log-max-bytes', type=int, required=False,
+            default=10 * 1024 * 1024,
+            help='size (in bytes) past which the log file is rotated'
+        )
+    trade_parser.add_argument('--log-backups', type=int, required=False,
+            default=5,
+            help='number of rotated log files to keep'
+        )
+    trade_parser.add_argument('--quiet', '-q', action='store_true',
+            help='don\'t print matched tweets and orders'
+        )
+    trade_parser.add_argument('--record', type=str, required=False,
+            default=None, metavar='DIR',
+            help=('record every message from the Twitter stream, the '
+                  'inside bid and ask used for each order, and every order '
+                  'and response in compressed segments in this directory; '
+                  'see "vickitrix extract"')
+        )
+    trade_parser.add_argument('--record-segment-size', type=float,
+            required=False, default=64,
+            help=('size (in MB, uncompressed) past which a new recording '
+                  'segment is started; segments are also started hourly')
+        )
+    backtest_parser = subparsers.add_parser(
+                            'backtest',
+                            help=('replays recorded tweets and market data '
+                                  'through rules on a simulated exchange')
+                        )
+    backtest_parser.add_argument('--rules', '-r', type=str, required=False,
+            default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    'rules', 'vicki.yaml'),
+            help=('rules file in YAML (.yaml or .yml) or JSON (.json); '
+                  'Python rules files (.py) that set the variable "rules" '
+                  'to a list of dictionaries still work')
+        )
+    backtest_parser.add_argument('--tweets', '-t', type=str, required=True,
+            help=('file with one recorded status (as JSON from Twitter) per '
+                  'line, in the order posted; may be gzipped')
         )
-    args = parser.parse_args()
+    backtest_parser.add_argument('--market', '-m', type=str, required=True,
+            help=('file with one market record per line in time order, each '
+                  'a JSON object with "product_id", "time", and either "bid" '
+                  'and "ask", "best_bid" and "best_ask", or "bids" and '
+                  '"asks"; may be gzipped')
+        )
+    backtest_parser.add_argument('--balances', '-b', type=str,
+            required=False, default='USD:1000',
+            help=('starting balances as comma-separated <currency>:<amount> '
+                  'pairs')
+        )
+    backtest_parser.add_argument('--fee', type=float, required=False,
+            default=0.003,
+            help='taker fee as a fraction of an order\'s value'
+        )
+    backtest_parser.add_argument('--fills', type=str, required=False,
+            default=None,
+            help='file to which to write fills as JSON lines'
+        )
+    backtest_parser.add_argument('--verbose', action='store_true',
+            help='print every matched tweet and order'
+        )
+    agent_parser = subparsers.add_parser(
+                            'agent',
+                            help=('holds keys of unlocked profiles in memory '
+                                  'so "vickitrix trade" can restart without '
+                                  'a password')
+                        )
+    agent_parser.add_argument('--profile', '-p', type=str, required=False,
+            action='append',
+            help=('profile to unlock now; may be given more than once. '
+                  'Other profiles are held once "vickitrix trade" is given '
+                  'their passwords')
+        )
+    agent_parser.add_argument('--socket', type=str, required=False,
+            default=None,
+            help=('Unix socket on which to listen; default is '
+                  '~/.vickitrix/agent.sock')
+        )
+    validate_parser = subparsers.add_parser(
+                            'validate',
+                            help=('checks a rules file without trading and '
+                                  'optionally converts it to YAML or JSON')
+                        )
+    validate_parser.add_argument('--rules', '-r', type=str, required=True,
+            help='rules file in YAML, JSON, or Python'
+        )
+    validate_parser.add_argument('--convert', '-c', type=str,
+            required=False, default=None,
+            help=('YAML (.yaml or .yml) or JSON (.json) file to which to '
+                  'write the rules in the declarative format; use this to '
+                  'move off Python rules files')
+        )
+    extract_parser = subparsers.add_parser(
+                            'extract',
+                            help=('writes part of a recording made with '
+                                  '"vickitrix trade --record" to files '
+                                  '"vickitrix backtest" reads')
+                        )
+    extract_parser.add_argument('--recording', '-d', type=str,
+            required=True,
+            help='directory passed to "vickitrix trade --record"'
+        )
+    extract_parser.add_argument('--start', type=str, required=False,
+            default=None,
+            help=('earliest time to extract, in seconds since the epoch or '
+                  'as an ISO 8601 UTC time like "2018-01-01T12:00:00Z"; '
+                  'default is the start of the recording')
+        )
+    extract_parser.add_argument('--end', type=str, required=False,
+            default=None,
+            help=('latest time to extract, formatted as for --start; '
+                  'default is the end of the recording')
+        )
+    extract_parser.add_argument('--tweets', '-t', type=str, required=False,
+            default=None,
+            help=('file to which to write statuses, one per line, for '
+                  '"vickitrix backtest --tweets"; gzipped if it ends with '
+                  '".gz"')
+        )
+    extract_parser.add_argument('--market', '-m', type=str, required=False,
+            default=None,
+            help=('file to which to write inside bids and asks used for '
+                  'orders, for "vickitrix backtest --market"; gzipped if '
+                  'it ends with ".gz"')
+        )
+    extract_parser.add_argument('--orders', '-o', type=str, required=False,
+            default=None,
+            help=('file to which to write orders and GDAX\'s responses as '
+                  'JSON lines; gzipped if it ends with ".gz"')
+        )
+    try:
+        args = parser.parse_args()
+    except SystemExit:
+        # As after --help
+        if '--profile-startup' in sys.argv:
+            startup.mark('arguments')
+            startup.report()
+        raise
+    startup.mark('arguments')
     key_dir = os.path.join(os.path.expanduser('~'), '.vickitrix')
+    profiles_file = os.path.join(key_dir, 'profiles.json')
+    # Written by earlier versions; profiles in it are still read
+    config_file = os.path.join(key_dir, 'config')
     if args.subparser_name == 'configure':
+        from .profiles import ProfileStore, credential_names, is_secret
+        startup.mark('imports')
+        if args.profile_startup:
+            startup.report()
         try:
             os.makedirs(key_dir)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
         # Grab and write all necessary credentials
-        config_file = os.path.join(key_dir, 'config')
+        store = ProfileStore(profiles_file, legacy_config=config_file)
         print('Enter a name for a new profile (default): ', end='')
         profile_name = input()
         if not profile_name: profile_name = 'default'
-        salt = Random.new().read(AES.block_size)
-        key = KDF.PBKDF2(getpass.getpass((
+        password = getpass.getpass((
                 'Enter a password for this profile. The password will be used '
                 'to generate a key so all GDAX/Twitter passcodes/secrets '
                 'written to {} are further encoded with AES256. '
                 'You will have to enter a profile\'s password every time you '
-                'run "vickitrix trade": '
-            ).format(config_file)), salt,
-                dkLen=32, count=_key_derivation_iterations)
-        previous_lines_to_write = []
-        if os.path.exists(config_file):
-            '''Have to check if the profile exists already. If it does, replace
-            it. Assume the config file is under vickitrix's control and thus 
-            has no errors; if the user chooses to mess it up, that's on
-            them.'''
-            with open(config_file, 'rU') as config_stream:
-                line = config_stream.readline().rstrip('\n')
-                while line:
-                    if line[0] == '[' and line[-1] == ']':
-                        if profile_name == line[1:-1]:
-                            # Skip this profile
-                            for _ in range(8): config_stream.readline()
-                            line = config_stream.readline().rstrip('\n')
-                            continue
-                        previous_lines_to_write.append(line)
-                        for _ in range(8):
-                            previous_lines_to_write.append(
-                                        config_stream.readline().rstrip('\n')
-                                    )
-                    line = config_stream.readline().rstrip('\n')
-        with open(config_file, 'w') as config_stream:
-            print(''.join(['[', profile_name, ']']), file=config_stream)
-        # Now change permissions
-        try:
-            os.chmod(config_file, 0o600)
-        except OSError as e:
-            if e.errno == errno.EPERM:
-                print >>sys.stderr, (
-                        ('Warning: could not change permissions of '
-                         '"{}" so it\'s readable/writable by only the '
-                         'current user. If there are other users of this '
-                         'system, they may be able to read your credentials '
-                         'file.').format(
-                                config_file
-                            )
-                    )
-                raise
-        with open(config_file, 'a') as config_stream:
-            print(''.join(['Salt: ', base64.b64encode(salt).decode()]),
-                    file=config_stream)
-            for token in ['GDAX key', 'GDAX secret', 'GDAX passphrase',
-                            'Twitter consumer key', 'Twitter consumer secret',
-                            'Twitter access token key',
-                            'Twitter access token secret']:
-                if 'key' in token:
-                    print(''.join(['Enter ', token, ': ']), end='')
-                    '''Write it in plaintext if it's a public key; then the 
-                    user can open the config file and know which keys are in 
-                    use.'''
-                    print(''.join([token, ': ', input()]),
-                            file=config_stream)
-                else:
-                    # A warning to developers in a variable name
-                    unencoded_and_not_to_be_written_to_disk = getpass.getpass(
-                                        ''.join(['Enter ', token, ': '])
-                                    )
-                    iv = Random.new().read(AES.block_size)
-                    cipher = AES.new(key, AES.MODE_CFB, iv)
-                    print(''.join([
-                            token,
-                            ' (AES256-encrypted using profile password): ',
-                            base64.b64encode(iv + cipher.encrypt(
-                                unencoded_and_not_to_be_written_to_disk
-                            )).decode()]), file=config_stream)
-            for line in previous_lines_to_write:
-                print(line, file=config_stream)
+                'run "vickitrix trade" without "vickitrix agent" running: '
+            ).format(profiles_file))
+        credentials = {}
+        for token in credential_names:
+            if not is_secret(token):
+                '''Stored in plaintext since it's a public key; then the
+                user can open the profiles file and know which keys are in
+                use.'''
+                print(''.join(['Enter ', token, ': ']), end='')
+                credentials[token] = input()
+            else:
+                credentials[token] = getpass.getpass(
+                                    ''.join(['Enter ', token, ': '])
+                                )
+        store.put(profile_name, password, credentials)
+        # Written readable/writable by only the current user
+        store.save()
         print(('Configured profile "{}". Encrypted credentials have been '
                'stored in "{}". '
                'Now use the "trade" subcommand to '
                'trigger trades with new tweets.').format(
                         profile_name,
-                        config_file
+                        profiles_file
                     ))
-    elif args.subparser_name == 'trade':
-        # Set and check rules
-        from imp import load_source
+    elif args.subparser_name == 'agent':
+        from .profiles import (ProfileStore, KeyAgent, profile_key,
+                               default_agent_socket)
+        startup.mark('imports')
+        if args.profile_startup:
+            startup.report()
+        store = ProfileStore(profiles_file, legacy_config=config_file)
+        agent = KeyAgent(args.socket or default_agent_socket(key_dir))
+        for profile_name in args.profile or []:
+            profile = store.get(profile_name)
+            agent.add(profile_name, profile['salt'], profile_key(
+                    profile, getpass.getpass(
+                        'Enter password for profile "{}": '.format(
+                                                        profile_name
+                                                    )
+                    )
+                ))
+        print_to_screen(
+                ('Holding keys for "vickitrix trade" at "{}"; hit CTRL+C to '
+                 'quit...').format(agent.socket_path)
+            )
         try:
-            rules = load_source('rules', args.rules).rules
-        except IOError as e:
-            e.message = 'Cannot find or access rules file "{}".'.format(
-                                                                    args.rules
-                                                                )
-            raise
-        import copy
-        # Add missing keys so listener doesn't fail
-        new_rules = copy.copy(rules)
-        order_vocab = set(['client_oid', 'type', 'side', 'product_id', 'stp',
-                           'price', 'size', 'time_in_force', 'cancel_after',
-                           'post_only', 'funds', 'overdraft_enabled',
-                           'funding_amount'])
+            agent.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.subparser_name == 'validate':
+        try:
+            rules = load_rules(args.rules)
+            if args.convert:
+                converted = dsl.convert_rules(
+                        [rule['rule'] for rule in rules]
+                    )
+                # Check that every expression made it through
+                dsl.compile_rules(converted, args.convert)
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
+        startup.mark('rules')
+        if args.profile_startup:
+            startup.report()
         for i, rule in enumerate(rules):
-            # Check 'condition'
-            try:
-                eval(rule['condition'].format(
-                        tweet='"The rain in Spain stays mainly in the plain."',
-                        available={
-                            'ETH' : .01,
-                            'USD' : .01,
-                            'LTC' : .01,
-                            'BTC' : .01
-                        }
+            print('Rule #{}: {} order(s) on {}; handles: {}; '
+                  'keywords: {}'.format(
+                        i+1, len(rule['orders']),
+                        ', '.join(sorted(set(
+                                order['static']['product_id']
+                                for order in rule['orders']
+                            ))),
+                        ', '.join(rule['handles']) or '(any)',
+                        ', '.join(rule['keywords']) or '(any)'
                     ))
-            except KeyError:
-                # 'condition' isn't required, so make default True
-                new_rules[i]['condition'] = 'True'
-            except:
-                raise RuntimeError(''.join([
-                        ('"condition" from the following rule in the file '
-                         '"{}" could not be '
-                         'evaluated; check the format '
-                         'and try again: ').format(args.rules),
-                        os.linesep, prettify_dict(rule)
-                    ])
-                )
-            # Check handles or keywords
-            if 'handles' not in rule and 'keywords' not in rule:
-                raise RuntimeError(''.join([
-                        ('A rule must have at least one of {{"handles", '
-                         '"keywords"}}, but this rule from the file "{}" '
-                         'doesn\'t:').format(args.rules),
-                        os.linesep, prettify_dict(rule)
-                    ])
+        print('The rules file "{}" is valid.'.format(args.rules))
+        if args.convert:
+            with open(args.convert, 'w') as convert_stream:
+                if args.convert.endswith('.json'):
+                    json.dump({'rules' : converted}, convert_stream,
+                              indent=4, sort_keys=True)
+                else:
+                    if dsl.yaml is None:
+                        raise RuntimeError(
+                            'PyYAML is required to write YAML rules files.'
+                        )
+                    dsl.yaml.safe_dump({'rules' : converted}, convert_stream,
+                                       default_flow_style=False)
+            print('Wrote converted rules to "{}".'.format(args.convert))
+    elif args.subparser_name == 'extract':
+        import gzip
+        from .backtest import parse_time
+        from .recorder import read_recording
+        startup.mark('imports')
+        if args.profile_startup:
+            startup.report()
+        # Record type to extract mapped to file path
+        paths = dict((record_type, path) for record_type, path in [
+                ('message', args.tweets), ('quote', args.market),
+                ('order', args.orders)
+            ] if path)
+        if not paths:
+            raise RuntimeError(
+                    'Pass at least one of --tweets, --market, and --orders.'
                 )
-            if 'handles' not in rule:
-                new_rules[i]['handles'] = []
-            if 'keywords' not in rule:
-                new_rules[i]['keywords'] = []
-            new_rules[i]['handles'] = [
-                    handle.lower() for handle in new_rules[i]['handles']
-                ]
-            new_rules[i]['keywords'] = [
-                    keyword.lower() for keyword in new_rules[i]['keywords']
-                ]
-            '''Validate order; follow https://docs.gdax.com/#orders for 
-            filling in default values.'''
-            if 'orders' not in rule or not isinstance(rule['orders'], list):
-                raise RuntimeError(''.join([
-                        ('Every rule must have an "orders" list, but '
-                         'this rule from the file "{}" doesn\'t:').format(
-                        args.rules), os.linesep, prettify_dict(rule)
-                    ])
+        streams = dict(
+                (record_type, gzip.open(path, 'wt') if path.endswith('.gz')
+                              else open(path, 'w'))
+                for record_type, path in paths.items()
+            )
+        counts = dict((record_type, 0) for record_type in streams)
+        try:
+            for record in read_recording(
+                    args.recording,
+                    start=(parse_time(args.start)
+                           if args.start is not None else None),
+                    end=parse_time(args.end) if args.end is not None else None,
+                    types=list(streams)
+                ):
+                if record['type'] == 'message':
+                    if 'text' not in record['message']:
+                        # A notice, not a status
+                        continue
+                    line = record['message']
+                elif record['type'] == 'quote':
+                    if record['bid'] is None or record['ask'] is None:
+                        continue
+                    line = dict((key, record[key]) for key in
+                                ['product_id', 'time', 'bid', 'ask'])
+                else:
+                    line = record
+                streams[record['type']].write(json.dumps(line) + '\n')
+                counts[record['type']] += 1
+        finally:
+            for extract_stream in streams.values():
+                extract_stream.close()
+        for record_type, noun in [('message', 'statuses'),
+                                  ('quote', 'inside bids and asks'),
+                                  ('order', 'orders')]:
+            if record_type in paths:
+                print('Wrote {} {} to "{}".'.format(
+                        counts[record_type], noun, paths[record_type]
+                    ))
+    elif args.subparser_name == 'backtest':
+        from .backtest import read_records, SimulatedExchange, backtest
+        startup.mark('imports')
+        rules = load_rules(args.rules)
+        startup.mark('rules')
+        if args.profile_startup:
+            startup.report()
+        balances = {}
+        for pair in args.balances.split(','):
+            currency, _, amount = pair.partition(':')
+            balances[currency.strip().upper()] = float(amount)
+        fills_stream = open(args.fills, 'w') if args.fills else None
+        try:
+            summary = backtest(
+                    rules, read_records(args.tweets),
+                    read_records(args.market),
+                    SimulatedExchange(balances, fee=args.fee,
+                                      fills_stream=fills_stream),
+                    verbose=args.verbose
                 )
-            for j, order in enumerate(rule['orders']):
-                if not isinstance(order, dict):
-                    raise RuntimeError(''.join([
-                        ('Every order must be a dictionary, but order #{} '
-                         'from this rule in the file "{}" isn\'t:').format(
-                        j+1, args.rules), os.linesep, prettify_dict(rule)]))
-                unrecognized_keys = [
-                        key for key in order if key not in order_vocab
-                    ]
-                if unrecognized_keys:
-                    raise RuntimeError(''.join([
-                        'In the file "{}", the "order" key(s) '.format(
-                            args.rules),
-                        os.linesep, '[',
-                        ', '.join(unrecognized_keys), ']', os.linesep,
-                        ('are invalid yet present in order #{} of '
-                         'the following rule:').format(j+1),
-                        os.linesep, prettify_dict(rule)
-                    ]))
-                try:
-                    if order['type'] not in [
-                            'limit', 'market', 'stop'
-                        ]:
-                        raise RuntimeError(''.join([
-                            ('An order\'s "type" must be one of {{"limit", '
-                             '"market", "stop"}}, which order #{} in this '
-                             'rule from the file "{}" doesn\'t '
-                             'satisfy:').format(j+1, args.rules),
-                            os.linesep, prettify_dict(rule)
-                        ]))
-                except KeyError:
-                    # GDAX default is limit
-                    new_rules[i]['orders'][j]['type'] = 'limit'
-                if 'side' not in order:
-                    raise RuntimeError(''.join([
-                            ('An order must have a "side", but order #{} in '
-                             'this rule from the file "{}" doesn\'t:').format(
-                             j+1, args.rules), os.linesep, prettify_dict(rule)
-                        ])
-                    )
-                if order['side'] not in ['buy', 'sell']:
-                        raise RuntimeError(''.join([
-                            ('An order\'s "side" must be one of {{"buy", '
-                             '"sell"}}, which order #{} in this rule '
-                             'from the file "{}" doesn\'t satisfy:').format(
-                             j+1, args.rules), os.linesep, prettify_dict(rule)
-                        ])
+        finally:
+            if fills_stream is not None:
+                fills_stream.close()
+        print(prettify_dict(summary))
+    elif args.subparser_name == 'trade':
+        # First, so a missing GDAX or Twitter client is explained
+        from .listener import TradeListener
+        from twython import Twython
+        from .book import OrderBooks, OrderBookFeed
+        from .dedup import SeenStatuses
+        from .eventlog import EventLog
+        from .metrics import Metrics, PrometheusSink, StatsdSink
+        from .profiles import (ProfileStore, profile_key, check_key,
+                               decrypt_profile, default_agent_socket,
+                               agent_get_key, agent_put_key)
+        from .ratelimit import RateLimiter, ScheduledClient
+        from .recorder import Recorder
+        from .reloader import RulesWatcher
+        from .sessions import (PooledSession, PooledPublicClient,
+                               PooledAuthenticatedClient, ConnectionWarmer)
+        from .streams import StreamManager
+        from .users import UserIdCache, resolve_handles
+        startup.mark('imports')
+        if args.account:
+            # Tuples (profile name, rules file)
+            accounts = [(account.partition('=')[0],
+                         account.partition('=')[2] or args.rules)
+                        for account in args.account]
+            if len(set(name for name, _ in accounts)) < len(accounts):
+                raise RuntimeError(
+                        'Each profile can be passed to --account only once.'
                     )
-                if 'product_id' not in order:
-                    raise RuntimeError(''.join([
-                            ('An order must have a "product_id", but in the '
-                             'file "{}", order #{} from this rule '
-                             'doesn\'t:').format(args.rules, j+1),
-                            os.linesep, prettify_dict(rule)
-                        ]))
-                if new_rules[i]['orders'][j]['type'] == 'limit':
-                    for item in ['price', 'size']:
-                        if item not in order:
-                            raise RuntimeError(''.join([
-                                ('If an order\'s "type" is "limit", the order '
-                                 'must specify a "{}", but in the file "{}",'
-                                 'order #{} from this rule doesn\'t:').format(
-                                 item, args.rules, j+1),
-                                 os.linesep, prettify_dict(rule)
-                            ]))
-                elif new_rules[i]['orders'][j]['type'] in ['market', 'stop']:
-                    if 'size' not in order and 'funds' not in order:
-                        raise RuntimeError(''.join([
-                                ('If an order\'s "type" is "{}", the order '
-                                 'must have at least one of {{"size", '
-                                 '"funds"}}, but in file "{}", order #{} '
-                                 'of this rule doesn\'t:').format(
-                                        new_rules[i]['orders'][j]['type'],
-                                        args.rules, j+1
-                                    ), os.linesep, prettify_dict(rule)]))
-                for stack in ['size', 'funds', 'price']:
-                    try:
-                        eval(order[stack].format(
-                            tweet=('"The rain in Spain stays mainly '
-                                   'in the plain."'),
-                            available={
-                                'ETH' : .01,
-                                'USD' : .01,
-                                'LTC' : .01,
-                                'BTC' : .01
-                            }, inside_bid=200, inside_ask=200))
-                    except KeyError:
-                        pass
-                    except Exception as e:
-                        raise RuntimeError(''.join([
-                                ('"{}" from order #{} in the following '
-                                 'rule from the file "{}" could not be '
-                                 'evaluated; check the format '
-                                 'and try again:').format(
-                                        stack, j+1, args.rules
-                                    ), os.linesep, prettify_dict(rule)]))
-        rules = new_rules
-        # Use _last_ entry in config file with profile name
-        key = None
-        try:
-            with open(os.path.join(key_dir, 'config'), 'rU') as config_stream:
-                line = config_stream.readline().rstrip('\n')
-                while line:
-                    profile_name = line[1:-1]
-                    if profile_name == args.profile:
-                        salt = base64.b64decode(
-                                config_stream.readline().rstrip(
-                                        '\n').partition(': ')[2]
-                            )
-                        if key is None:
-                            key = KDF.PBKDF2(getpass.getpass(
-                                    'Enter password for profile "{}": '.format(
-                                                                profile_name
-                                                            )
-                                ), salt,
-                                dkLen=32, count=_key_derivation_iterations
-                            )
-                        keys_and_secrets = []
-                        for _ in range(7):
-                            item, _, encoded = config_stream.readline().rstrip(
-                                                    '\n').partition(': ')
-                            if 'key' in item:
-                                # Not actually encoded; remove leading space
-                                keys_and_secrets.append(encoded)
-                                continue
-                            encoded = base64.b64decode(encoded)
-                            cipher = AES.new(
-                                    key, AES.MODE_CFB,
-                                    encoded[:AES.block_size]
-                                )
-                            keys_and_secrets.append(
-                                    cipher.decrypt(
-                                            encoded
-                                        )[AES.block_size:]
-                                )
-                    else:
-                        # Skip profile
-                        for _ in range(8): config_stream.readline()
-                    line = config_stream.readline().rstrip('\n')
-        except IOError as e:
-            e.message = (
-                    'Cannot find vickitrix config file. Use '
-                    '"vickitrix configure" to configure vickitrix '
-                    'before trading.'
+        else:
+            accounts = [(args.profile, args.rules)]
+        account_rules = [load_rules(rules_file)
+                         for _, rules_file in accounts]
+        startup.mark('rules')
+        store = ProfileStore(profiles_file, legacy_config=config_file)
+        if not store.profiles:
+            raise RuntimeError(
+                    'No profiles are configured. Use "vickitrix configure" '
+                    'to configure vickitrix before trading.'
                 )
-            raise
+        agent_socket = None
+        if not args.no_agent:
+            agent_socket = args.agent_socket or default_agent_socket(key_dir)
+        def unlock(name):
+            """ Decrypts a profile's credentials, with its key from the
+                agent if it has it.
+
+                name: profile name
+
+                Return value: list of decrypted credentials
+            """
+            profile = store.get(name)
+            key = None
+            if agent_socket is not None:
+                key = agent_get_key(agent_socket, name, profile)
+            if key is None:
+                key = profile_key(profile, getpass.getpass(
+                        'Enter password for profile "{}": '.format(name)
+                    ))
+                if agent_socket is not None and agent_put_key(
+                        agent_socket, name, profile, key
+                    ):
+                    print_to_screen(
+                            'Key for profile "{}" handed to agent.'.format(
+                                                                        name
+                                                                    )
+                        )
+            else:
+                check_key(profile, key)
+                print_to_screen('Key for profile "{}" from agent.'.format(
+                                                                        name
+                                                                    ))
+            return decrypt_profile(profile, key)
+        account_credentials = [unlock(name) for name, _ in accounts]
+        # Every profile's Twitter credentials can hold a connection open
+        stream_credentials = []
+        for credentials in account_credentials + [
+                unlock(name) for name in args.stream_profile or []
+                if name not in [account for account, _ in accounts]
+            ]:
+            if credentials[3:7] not in stream_credentials:
+                stream_credentials.append(credentials[3:7])
+        startup.mark('credentials')
+        # Handles are looked up with the first account's Twitter credentials
+        keys_and_secrets = account_credentials[0]
+        rules = [rule for rules in account_rules for rule in rules]
         try:
             # Instantiate GDAX and Twitter clients
-            gdax_client = gdax.AuthenticatedClient(
-                                    *keys_and_secrets[:3]
-                                )
+            # All GDAX requests share a pool of keep-alive connections
+            session = PooledSession(pool_size=args.http_pool_size,
+                                    timeout=args.http_timeout)
+            gdax_clients = [
+                    PooledAuthenticatedClient(*credentials[:3],
+                                              session=session)
+                    for credentials in account_credentials
+                ]
+            metrics = Metrics()
             # Are they working?
-            get_dough(gdax_client, status_update=True)
+            for gdax_client in gdax_clients:
+                get_dough(gdax_client, status_update=True)
+            public_client = PooledPublicClient(session)
+            if args.gdax_rate and args.gdax_public_rate:
+                # Orders go ahead of balance, book, and keep-alive requests
+                public_limiter = RateLimiter(args.gdax_public_rate,
+                                             metrics=metrics, name='public')
+                public_client = ScheduledClient(public_client,
+                                                public_limiter)
+                gdax_clients = [
+                        ScheduledClient(
+                                gdax_client,
+                                RateLimiter(args.gdax_rate, metrics=metrics,
+                                            name=name),
+                                public_limiter
+                            ) for gdax_client, (name, _) in zip(gdax_clients,
+                                                                accounts)
+                    ]
             twitter_client = Twython(*keys_and_secrets[3:7])
+            # Keep books only for products whose orders need them
+            book_products = set([
+                    order['static']['product_id']
+                    for rule in rules for order in rule['orders']
+                    if order['needs_book']
+                ])
+            if args.metrics_port is not None:
+                prometheus_sink = PrometheusSink(metrics, args.metrics_port)
+                metrics.add_sink(prometheus_sink)
+                prometheus_sink.start()
+            if args.statsd:
+                statsd_host, _, statsd_port = args.statsd.rpartition(':')
+                metrics.add_sink(StatsdSink(statsd_host or '127.0.0.1',
+                                            int(statsd_port)))
+            books = None
+            if book_products and args.book_feed:
+                books = OrderBooks(book_products)
+                OrderBookFeed(books, url=args.book_feed).start()
+            seen = None
+            if args.seen_capacity:
+                seen = SeenStatuses(os.path.join(key_dir, 'seen.json'),
+                                    capacity=args.seen_capacity)
+                seen.start()
+            recorder = None
+            if args.record:
+                recorder = Recorder(
+                        args.record,
+                        segment_bytes=int(
+                                args.record_segment_size * 1024 * 1024
+                            ),
+                        metrics=metrics
+                    )
+                recorder.start()
+            event_log = EventLog(path=args.log, console=not args.quiet,
+                                 max_bytes=args.log_max_bytes,
+                                 backups=args.log_backups)
             trade_listener = TradeListener(
-                    *([rules, gdax_client] + keys_and_secrets[3:7]),
-                    sleep_time=args.sleep
+                    *([account_rules[0], gdax_clients[0]]
+                      + keys_and_secrets[3:7]),
+                    stall_timeout=args.stall_timeout,
+                    rate_limit_cap=args.interval,
+                    sleep_time=args.sleep,
+                    max_staleness=args.balance_staleness,
+                    refresh_interval=args.balance_refresh,
+                    books=books,
+                    queue_size=args.queue_size,
+                    executors=args.executors,
+                    order_threads=args.order_threads,
+                    public_client=public_client,
+                    metrics=metrics,
+                    event_log=event_log,
+                    seen=seen,
+                    order_retries=args.order_retries,
+                    track_fills=not args.no_fill_tracking,
+                    fill_timeout=args.fill_timeout,
+                    user_feed=args.book_feed or None,
+                    recorder=recorder,
+                    match_processes=args.match_processes,
+                    accounts=(list(zip([name for name, _ in accounts],
+                                       account_rules, gdax_clients))
+                              if args.account else None)
                 )
         except Exception as e:
             from traceback import format_exc
@@ -614,36 +1091,120 @@ def go():
                 ))
             exit(1)
         print_to_screen('Twitter/GDAX credentials verified.')
+        startup.mark('clients')
+        ConnectionWarmer(gdax_clients[0], interval=args.http_keepalive).start()
         # Get all handles to monitor
-        handles, keywords = set(), set()
-        for rule in rules:
-            handles.update(rule['handles'])
-            keywords.update(rule['keywords'])
-        handles_to_user_ids = {}
-        for handle in handles:
-            try:
-                handles_to_user_ids[handle] = twitter_client.show_user(
-                                                            screen_name=handle
-                                                        )['id_str']
-            except TwythonError as e:
-                if 'User not found' in e.message:
-                    print(
-                        'Handle {} not found; skipping rule...'.format(handle)
-                    )
-                else:
-                    raise
+        user_id_cache = UserIdCache(os.path.join(key_dir, 'users.json'),
+                                    ttl=args.user_cache_ttl or None)
+        handles_to_user_ids = resolve_handles(
+                twitter_client,
+                set(handle for rule in rules for handle in rule['handles']),
+                cache=user_id_cache
+            )
         if not handles_to_user_ids:
             raise RuntimeError('No followable Twitter handles found in rules!')
-        while True:
-            print_to_screen('Listening for tweets; hit CTRL+C to quit...')
-            trade_listener.statuses.filter(
-                    follow=handles_to_user_ids.values(),
-                    track=list(keywords)
-                )
-            print_to_screen(
-                    timestamp()
-                    + 'Rate limit error. Restarting in {} s...'.format(
-                                                                args.interval
-                                                            )
+        startup.mark('handles')
+        router = trade_listener.trader
+        if args.account:
+            rules = router.combined_rules()
+        # Followed users and tracked keywords are shared out among as many
+        # connections as they take
+        streams = StreamManager(trade_listener, stream_credentials,
+                                max_follow=args.max_follow,
+                                max_track=args.max_track,
+                                stall_timeout=args.stall_timeout,
+                                rate_limit_cap=args.interval)
+        trade_listener.streams = streams
+        trade_listener.use_rules(rules, handles_to_user_ids)
+        # Watchers of different accounts' rules files swap in rules in turn
+        reload_lock = threading.Lock()
+        def reload_rules(new_rules, name=None):
+            """ Looks up new handles and swaps in reloaded rules.
+
+                new_rules: list of compiled rules
+                name: profile name of account whose rules they are, or None
+                    if there's only one account
+
+                No return value.
+            """
+            with reload_lock:
+                # Another account's reload may be adding to it
+                known = dict(handles_to_user_ids)
+            new_handles_to_user_ids = resolve_handles(
+                    twitter_client,
+                    set(handle for rule in new_rules
+                        for handle in rule['handles']),
+                    cache=user_id_cache, known=known
                 )
-            time.sleep(args.interval)
+            with reload_lock:
+                if name is not None:
+                    new_rules = router.combined_rules(name, new_rules)
+                # As at startup, some account's rules must follow someone
+                if not any(handle in handles_to_user_ids
+                           or handle in new_handles_to_user_ids
+                           for rule in new_rules
+                           for handle in rule['handles']):
+                    raise RuntimeError(
+                            'No followable Twitter handles found in rules!'
+                        )
+                handles_to_user_ids.update(new_handles_to_user_ids)
+                trade_listener.use_rules(new_rules, handles_to_user_ids)
+        if args.reload_interval:
+            for name, rules_file in accounts:
+                RulesWatcher(
+                        rules_file, load_rules,
+                        (lambda new_rules, name=name:
+                            reload_rules(new_rules, name))
+                        if args.account else reload_rules,
+                        interval=args.reload_interval,
+                        event_log=router.event_log
+                    ).start()
+        if args.profile_startup:
+            startup.report()
+        try:
+            print_to_screen('Listening for tweets; hit CTRL+C to quit...')
+            # Reconnects on its own, reissuing filters as rules change
+            streams.run()
+        finally:
+            streams.stop()
+            if recorder is not None:
+                # What led up to a crash is what's most worth keeping
+                recorder.close()
+            if seen is not None:
+                # Or a restart could trade on statuses seen since the last
+                # save
+                seen.close()
+            # Last, so what everything else logged on the way out is
+            # written
+            event_log.close()
+
+def __getattr__(name):
+    """ Loads TradeListener only once it's asked for, since it needs the
+        GDAX and Twitter clients. """
+    if name == 'TradeListener':
+        from .listener import TradeListener
+        return TradeListener
+    raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name)
+        )
+
+if sys.version_info < (3, 7):
+    # Modules' own __getattr__ is new in Python 3.7; before, it takes a
+    # module type whose attribute lookup falls back on it
+    import types
+
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+    _module = sys.modules[__name__]
+    try:
+        _module.__class__ = _LazyModule
+    except TypeError:
+        # Python 2 can't change a module's type, so the module is swapped
+        # for a copy; the original is kept, or its globals would be
+        # cleared
+        _lazy_module = _LazyModule(__name__, __doc__)
+        _lazy_module.__dict__.update(_module.__dict__)
+        _lazy_module._module = _module
+        sys.modules[__name__] = _lazy_module
@@ -1,4 +1,10 @@
 #!/usr/bin/env python
 if __name__ == '__main__':
-    from __init__ import *
+    if not __package__:
+        # Run as "python vickitrix"; make the package itself importable
+        import os
+        import sys
+        sys.path.insert(0, os.path.dirname(os.path.dirname(
+                                            os.path.abspath(__file__))))
+    from vickitrix import go
     go()
@@ -0,0 +1,187 @@
+"""
+vickitrix.accounts
+
+Trades the same stream for several GDAX accounts at once.
+
+Every account has its own rules, Trader, and balance cache, but statuses
+come from one Twitter connection and are matched against every account's
+rules in one pass over one index, so stream connections and matching cost
+the same however many accounts there are. Rules that match are handed to
+their account's own execution workers, so a slow or throttled account
+doesn't hold up orders for the others.
+"""
+import threading
+from traceback import format_exc
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from .eventlog import EventLog
+from .matching import RuleIndex
+from .metrics import Metrics
+
+_stop = object()
+
+class AccountRouter(object):
+    """ Matches statuses once for several accounts and fans matched rules
+        out to per-account workers.
+
+        Stands in for a Trader in Pipeline and TradeListener.
+    """
+
+    def __init__(self, traders, executors=1, queue_size=1000,
+                 event_log=None, metrics=None):
+        """
+            traders: list of instances of Trader, one per account, each
+                with a distinct name
+            executors: number of threads placing orders for each account
+            queue_size: maximum number of matched statuses waiting for an
+                account's executors
+            event_log: instance of EventLog for errors, or None to log
+                nothing
+            metrics: instance of Metrics, or None for a private registry
+        """
+        self.traders = dict((trader.name, trader) for trader in traders)
+        self.names = [trader.name for trader in traders]
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.user_ids = {}
+        self._rules = dict((trader.name, trader.rule_index.rules)
+                           for trader in traders)
+        self.rule_index = RuleIndex(self.combined_rules())
+        self._queues = {}
+        self._threads = []
+        for name in self.names:
+            self._queues[name] = queue.Queue(maxsize=queue_size)
+            self.metrics.gauge('account_queue_depth',
+                               self._queues[name].qsize, account=name)
+            for _ in range(executors):
+                thread = threading.Thread(target=self._execute, args=(name,))
+                thread.daemon = True
+                self._threads.append(thread)
+
+    def combined_rules(self, name=None, rules=None):
+        """ Gets every account's rules in one list, each rule tagged with
+            its account under the key "account".
+
+            name: account whose rules are to be replaced, or None
+            rules: list of compiled rules replacing name's, or None; they
+                take effect only once passed to set_rules()
+
+            Return value: list of tagged compiled rules, grouped by account
+        """
+        combined = []
+        for account in self.names:
+            combined.extend(dict(rule, account=account)
+                            for rule in (rules if account == name
+                                         else self._rules[account]))
+        return combined
+
+    def add_user_ids(self, handles_to_user_ids):
+        """ See Trader.add_user_ids(). """
+        self.user_ids.update(handles_to_user_ids)
+        self.rule_index.add_user_ids(handles_to_user_ids)
+        for trader in self.traders.values():
+            trader.add_user_ids(handles_to_user_ids)
+
+    def set_rules(self, rules):
+        """ Swaps in a new rule set.
+
+            rules: list of tagged compiled rules from combined_rules()
+
+            No return value.
+        """
+        by_account = dict((name, []) for name in self.names)
+        for rule in rules:
+            by_account[rule['account']].append(rule)
+        for name, account_rules in by_account.items():
+            self.traders[name].set_rules(account_rules)
+        self._rules = by_account
+        rule_index = RuleIndex(rules)
+        rule_index.add_user_ids(self.user_ids)
+        self.rule_index = rule_index
+
+    def match(self, status, trace=None, candidates=None):
+        """ Finds every account's rules whose handles, keywords, and
+            conditions apply.
+
+            status: status dictionary from Twitter
+            trace: Trace for status, or None
+            candidates: list of tagged compiled rules whose handles and
+                keywords are already known to apply, or None to look them up
+
+            Return value: list of tagged compiled rules
+        """
+        if candidates is None:
+            candidates = self.rule_index.match(status)
+        if trace is not None:
+            trace.mark('match')
+        if not candidates:
+            return candidates
+        matched, group = [], []
+        # Candidates are grouped by account, so each account's conditions
+        # are evaluated against that account's balances
+        for rule in candidates + [None]:
+            if group and (rule is None
+                          or rule['account'] != group[0]['account']):
+                matched.extend(
+                        self.traders[group[0]['account']].check(status, group)
+                    )
+                group = []
+            if rule is not None:
+                group.append(rule)
+        if trace is not None:
+            trace.mark('condition')
+        return matched
+
+    def execute(self, status, rules, trace=None):
+        """ Queues matched rules for their accounts' executors.
+
+            status: status dictionary from Twitter
+            rules: list of tagged compiled rules from match()
+            trace: Trace for status, or None
+
+            No return value.
+        """
+        by_account = {}
+        for rule in rules:
+            by_account.setdefault(rule['account'], []).append(rule)
+        for name, account_rules in by_account.items():
+            # Blocks when this account's executors are behind
+            self._queues[name].put((status, account_rules, trace))
+
+    def _execute(self, name):
+        trader, jobs = self.traders[name], self._queues[name]
+        while True:
+            job = jobs.get()
+            if job is _stop:
+                return
+            try:
+                trader.execute(*job)
+            except Exception:
+                self.metrics.increment('account_errors', account=name)
+                self.event_log.log('error', account=name,
+                                   traceback=format_exc())
+
+    def start(self):
+        """ Starts every account's executors. """
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, wait=True):
+        """ Stops executors once queued orders are placed.
+
+            wait: True iff this should block until executors are done
+
+            No return value.
+        """
+        for name in self.names:
+            for _ in range(len(self._threads) // len(self.names)):
+                self._queues[name].put(_stop)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,379 @@
+"""
+vickitrix.backtest
+
+Replays recorded statuses and market data through rules, placing orders
+on a simulated exchange, so a rules file can be tried without trading.
+Both inputs are read a line at a time, so they can be arbitrarily large.
+"""
+from __future__ import print_function
+
+import calendar
+import gzip
+import itertools
+import json
+import time
+
+from .balances import BalanceCache, split_product
+from .eventlog import EventLog
+from .trader import Trader
+
+def read_records(records_file):
+    """ Reads JSON records, one per line, from a (possibly gzipped) file.
+
+        records_file: path to file; gzipped if it ends with ".gz"
+
+        Yield value: decoded record
+    """
+    if records_file.endswith('.gz'):
+        records_stream = gzip.open(records_file, 'rt')
+    else:
+        records_stream = open(records_file)
+    with records_stream:
+        for line in records_stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def parse_time(value):
+    """ Converts a recorded time to seconds since the epoch.
+
+        value: number of seconds (or milliseconds) since the epoch, a
+            string holding one, an ISO 8601 UTC time like GDAX's
+            "2017-09-01T12:00:00.000000Z", or a Twitter "created_at" time
+            like "Wed Aug 27 13:08:45 +0000 2008"
+
+        Return value: float
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        # Twitter's timestamp_ms is in milliseconds
+        return seconds / 1000 if seconds > 1e11 else seconds
+    if 'T' in value:
+        whole, _, fraction = value.rstrip('Z').partition('.')
+        return calendar.timegm(
+                time.strptime(whole, '%Y-%m-%dT%H:%M:%S')
+            ) + (float('.' + fraction) if fraction else 0)
+    return calendar.timegm(time.strptime(value, '%a %b %d %H:%M:%S +0000 %Y'))
+
+def status_time(status):
+    """ Gets the time a status was posted.
+
+        status: status dictionary from Twitter
+
+        Return value: seconds since the epoch, or None if unknown
+    """
+    for key in ['timestamp_ms', 'created_at']:
+        if key in status:
+            return parse_time(status[key])
+    return None
+
+def market_quote(record):
+    """ Gets inside bid and ask from a recorded market record.
+
+        record: dictionary with "product_id" and "time" and either "bid"
+            and "ask"; "best_bid" and "best_ask", as in a GDAX ticker
+            message; or "bids" and "asks" lists, as in a GDAX order book
+
+        Return value: tuple (product ID, time, inside bid, inside ask)
+    """
+    if 'bids' in record:
+        bid, ask = record['bids'][0][0], record['asks'][0][0]
+    elif 'best_bid' in record:
+        bid, ask = record['best_bid'], record['best_ask']
+    else:
+        bid, ask = record['bid'], record['ask']
+    return (record['product_id'], parse_time(record['time']),
+            float(bid), float(ask))
+
+class SimulatedExchange(object):
+    """ Stands in for gdax.AuthenticatedClient and gdax.PublicClient.
+
+        Market orders fill immediately at the inside ask (buys) or bid
+        (sells) and pay the taker fee. Limit orders that cross the book
+        fill the same way; others rest, holding funds, and fill at their
+        price without a fee once the market reaches it. Stop orders rest
+        until the market reaches their price and then fill like market
+        orders.
+    """
+
+    def __init__(self, balances, fee=0.003, fills_stream=None):
+        """
+            balances: dictionary mapping currency to starting balance
+            fee: taker fee as a fraction of an order's value
+            fills_stream: file to which fills are written as JSON lines as
+                they happen, or None
+        """
+        self.balances = dict(
+                (currency, float(amount))
+                for currency, amount in balances.items()
+            )
+        self.holds = {}
+        self.fee = fee
+        self.quotes = {}
+        self.time = None
+        self.orders = {}
+        self.fills = 0
+        self.rejected = 0
+        self.fills_stream = fills_stream
+        self._open = []
+        self._ids = itertools.count(1)
+
+    def _change(self, currencies, currency, amount):
+        currencies[currency] = currencies.get(currency, 0) + amount
+
+    def _available(self, currency):
+        return self.balances.get(currency, 0) - self.holds.get(currency, 0)
+
+    def update(self, product_id, bid, ask, time=None):
+        """ Sets the inside bid and ask and fills orders they reach.
+
+            product_id: GDAX product ID
+            bid: inside bid
+            ask: inside ask
+            time: seconds since the epoch
+
+            No return value.
+        """
+        self.quotes[product_id] = (bid, ask)
+        if time is not None:
+            self.time = time
+        still_open = []
+        for order in self._open:
+            if order['product_id'] != product_id or not self._trigger(order):
+                still_open.append(order)
+        self._open = still_open
+
+    def _trigger(self, order):
+        """ Fills a resting order if the market reached it.
+
+            order: resting order
+
+            Return value: True iff order was filled
+        """
+        bid, ask = self.quotes[order['product_id']]
+        price = float(order['price'])
+        buy = order['side'] == 'buy'
+        if order['type'] == 'limit':
+            if not (ask <= price if buy else bid >= price):
+                return False
+            self._release(order)
+            self._fill(order, float(order['size']), price, 0)
+            return True
+        if not (ask >= price if buy else bid <= price):
+            return False
+        self._release(order)
+        self._fill_market(order)
+        return True
+
+    def _release(self, order):
+        self._change(self.holds, order['hold_currency'], -order['hold'])
+        order['hold'] = 0
+
+    def _fill(self, order, size, price, fee_rate):
+        """ Fills order completely. """
+        base, quote = split_product(order['product_id'])
+        value = size * price
+        fee = value * fee_rate
+        if order['side'] == 'buy':
+            self._change(self.balances, base, size)
+            self._change(self.balances, quote, -(value + fee))
+        else:
+            self._change(self.balances, base, -size)
+            self._change(self.balances, quote, value - fee)
+        order.update({
+                'status' : 'done',
+                'done_reason' : 'filled',
+                'filled_size' : str(size),
+                'executed_value' : str(value),
+                'fill_fees' : str(fee),
+                'done_at' : self.time
+            })
+        self.fills += 1
+        if self.fills_stream is not None:
+            print(json.dumps({
+                    'time' : self.time,
+                    'order_id' : order['id'],
+                    'product_id' : order['product_id'],
+                    'side' : order['side'],
+                    'size' : size,
+                    'price' : price,
+                    'fee' : fee
+                }), file=self.fills_stream)
+
+    def _fill_market(self, order):
+        """ Fills order at the inside bid or ask, paying the taker fee. """
+        bid, ask = self.quotes[order['product_id']]
+        if order['side'] == 'buy':
+            if 'funds' in order:
+                size = float(order['funds']) / (1 + self.fee) / ask
+            else:
+                size = float(order['size'])
+            self._fill(order, size, ask, self.fee)
+        else:
+            if 'size' in order:
+                size = float(order['size'])
+            else:
+                size = float(order['funds']) / bid
+            self._fill(order, size, bid, self.fee)
+
+    def _reject(self, message):
+        self.rejected += 1
+        return {'message' : message}
+
+    def _place(self, order):
+        product_id = order.get('product_id')
+        if product_id not in self.quotes:
+            return self._reject('No market data for product')
+        base, quote = split_product(product_id)
+        bid, ask = self.quotes[product_id]
+        order_type = order.get('type', 'limit')
+        buy = order['side'] == 'buy'
+        # Amount of the currency spent that the order could need
+        if buy:
+            currency = quote
+            if 'funds' in order:
+                needed = float(order['funds'])
+            else:
+                price = ask if order_type == 'market' else float(
+                        order['price']
+                    )
+                needed = float(order['size']) * price * (1 + self.fee)
+        else:
+            currency = base
+            if 'size' in order:
+                needed = float(order['size'])
+            else:
+                needed = float(order['funds']) / bid
+        if needed <= 0:
+            return self._reject('Invalid order size')
+        if needed > self._available(currency) + 1e-12:
+            return self._reject('Insufficient funds')
+        order = dict(order)
+        order.update({
+                'id' : 'simulated-{}'.format(next(self._ids)),
+                'type' : order_type,
+                'status' : 'pending',
+                'created_at' : self.time,
+                'filled_size' : '0',
+                'executed_value' : '0',
+                'fill_fees' : '0',
+                'hold_currency' : currency,
+                'hold' : 0
+            })
+        self.orders[order['id']] = order
+        if order_type == 'market' or (
+                order_type == 'limit' and (
+                    ask <= float(order['price']) if buy
+                    else bid >= float(order['price'])
+                )
+            ):
+            self._fill_market(order)
+        elif order_type == 'stop' and self._trigger(order):
+            pass
+        else:
+            order['status'] = 'open'
+            order['hold'] = needed
+            self._change(self.holds, currency, needed)
+            self._open.append(order)
+        return self.get_order(order['id'])
+
+    def buy(self, **kwargs):
+        kwargs['side'] = 'buy'
+        return self._place(kwargs)
+
+    def sell(self, **kwargs):
+        kwargs['side'] = 'sell'
+        return self._place(kwargs)
+
+    def get_order(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None:
+            return {'message' : 'NotFound'}
+        return dict((key, value) for key, value in order.items()
+                    if key not in ['hold', 'hold_currency'])
+
+    def get_accounts(self):
+        return [{'currency' : currency,
+                 'balance' : repr(balance),
+                 'hold' : repr(self.holds.get(currency, 0)),
+                 'available' : repr(self._available(currency))}
+                for currency, balance in self.balances.items()]
+
+    def get_product_order_book(self, product_id, level=1):
+        bid, ask = self.quotes[product_id]
+        return {'bids' : [[repr(bid), '1', 1]], 'asks' : [[repr(ask), '1', 1]]}
+
+    def value(self, currency='USD'):
+        """ Values balances at inside bids.
+
+            currency: quote currency in which to value balances
+
+            Return value: total value, leaving out currencies with no
+                market data for a product quoted in currency
+        """
+        total = 0
+        for balance_currency, balance in self.balances.items():
+            if balance_currency == currency:
+                total += balance
+            elif '-'.join([balance_currency, currency]) in self.quotes:
+                total += balance * self.quotes[
+                        '-'.join([balance_currency, currency])
+                    ][0]
+        return total
+
+def backtest(rules, statuses, market, exchange, verbose=False):
+    """ Replays statuses through rules against a simulated exchange.
+
+        rules: list of compiled rules from compile_rules()
+        statuses: iterable of status dictionaries in the order posted
+        market: iterable of market records (see market_quote()) in time
+            order
+        exchange: instance of SimulatedExchange
+        verbose: True iff matches and orders should be printed
+
+        Return value: dictionary summarizing the backtest
+    """
+    event_log = EventLog(console=verbose)
+    event_log.start()
+    # Balances are read straight from the simulator, which is free
+    trader = Trader(rules, exchange,
+                    BalanceCache(exchange, max_staleness=0,
+                                 refresh_interval=None),
+                    exchange, sleep_time=0, order_threads=0,
+                    event_log=event_log)
+    market = (market_quote(record) for record in market)
+    next_quote = [next(market, None)]
+    def advance(until):
+        """ Applies market records up to time until (or all if None). """
+        quote = next_quote[0]
+        while quote is not None and (until is None or quote[1] <= until):
+            exchange.update(quote[0], quote[2], quote[3], quote[1])
+            quote = next(market, None)
+        next_quote[0] = quote
+    statuses_seen, matched_statuses = 0, 0
+    for status in statuses:
+        statuses_seen += 1
+        status_at = status_time(status)
+        advance(status_at)
+        if status_at is not None:
+            exchange.time = status_at
+        matched = trader.match(status)
+        if matched:
+            matched_statuses += 1
+            trader.execute(status, matched)
+    # Let resting orders fill with the rest of the market data
+    advance(None)
+    event_log.close()
+    return {
+            'statuses' : statuses_seen,
+            'matched statuses' : matched_statuses,
+            'orders placed' : len(exchange.orders),
+            'orders rejected' : exchange.rejected,
+            'fills' : exchange.fills,
+            'open orders' : len(exchange._open),
+            'balances' : exchange.balances,
+            'value (USD)' : exchange.value('USD')
+        }
@@ -0,0 +1,306 @@
+"""
+vickitrix.balances
+
+Keeps amounts available to trade in memory so orders don't wait on a
+GDAX account query. Amounts are adjusted locally as orders are placed and
+filled and reconciled with GDAX periodically, on demand, or whenever they
+are older than a configurable bound.
+"""
+import threading
+from traceback import format_exc
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+from .eventlog import EventLog
+from .metrics import Metrics
+
+def split_product(product_id):
+    """ Splits a GDAX product ID into its currencies.
+
+        product_id: product ID like "ETH-USD"
+
+        Return value: tuple (base currency, quote currency)
+    """
+    base, _, quote = product_id.partition('-')
+    return base, quote
+
+class BalanceCache(object):
+    """ Amounts available to trade, kept current without blocking orders. """
+
+    def __init__(self, gdax_client, max_staleness=60, refresh_interval=15,
+                 metrics=None, event_log=None, name=None):
+        """
+            gdax_client: instance of gdax.AuthenticatedClient
+            max_staleness: maximum age (in s) of amounts returned by
+                available(); older amounts are reconciled before returning,
+                so 0 always reconciles and None never does
+            refresh_interval: how often (in s) to reconcile in the
+                background once start() is called; None or 0 disables
+                periodic reconciliation
+            metrics: instance of Metrics in which to count failed
+                reconciliations, or None for a private registry
+            event_log: instance of EventLog to which failed
+                reconciliations are logged, or None to log nothing
+            name: name of account, added to metrics, or None
+        """
+        self.gdax_client = gdax_client
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self._labels = {'account' : name} if name is not None else {}
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self._available = {}
+        # Amounts held by open orders, keyed by order ID
+        self._holds = {}
+        # Incremented by every local change, so a reconciliation that
+        # raced an order doesn't clobber its hold
+        self._version = 0
+        self._updated = None
+        self._reconcile_at = None
+        self._next_periodic = None
+        self.reconcile()
+
+    def _settled(self, order_id):
+        """ Looks up how much of an open order GDAX has filled.
+
+            order_id: GDAX order ID
+
+            Return value: tuple (size filled, True iff the order is done);
+                (infinity, True) if GDAX can't say, so no more of the
+                order is credited until the next reconciliation
+        """
+        try:
+            report = self.gdax_client.get_order(order_id)
+        except Exception:
+            report = None
+        if not isinstance(report, dict) or 'id' not in report:
+            return float('inf'), True
+        return (float(report.get('filled_size') or 0),
+                report.get('status') in ['done', 'settled'])
+
+    def reconcile(self):
+        """ Replaces local amounts with those reported by GDAX.
+
+            GDAX's amounts already count what open orders have filled, so
+            each hold records how much that is, and later fills credit
+            only the rest.
+
+            Return value: dictionary mapping currency to amount available
+                as reported by GDAX, with amounts as strings
+        """
+        with self._lock:
+            version = self._version
+            order_ids = list(self._holds)
+        dough = {}
+        for account in self.gdax_client.get_accounts():
+            dough[account['currency']] = account['available']
+        # Looked up after amounts, so a fill in between is credited late
+        # rather than twice
+        settled = dict((order_id, self._settled(order_id))
+                       for order_id in order_ids)
+        with self._lock:
+            if version == self._version:
+                self._available = dict(
+                        (currency, float(amount))
+                        for currency, amount in dough.items()
+                    )
+                for order_id, (filled, done) in settled.items():
+                    hold = self._holds.get(order_id)
+                    if hold is not None:
+                        hold['settled'] = filled
+                        hold['released'] = done
+                self._updated = monotonic()
+            else:
+                # An order was placed mid-query; try again shortly
+                self._request(0)
+        return dough
+
+    def age(self):
+        """ Returns time (in s) since amounts were last reconciled. """
+        return monotonic() - self._updated
+
+    def available(self):
+        """ Gets amounts available to trade.
+
+            Return value: dictionary mapping currency to amount as float
+        """
+        if self.max_staleness is not None and (
+                self.age() >= self.max_staleness
+            ):
+            self.reconcile()
+        with self._lock:
+            return dict(self._available)
+
+    def _adjust(self, currency, amount):
+        """ Adds amount to currency available; call with lock held. """
+        self._available[currency] = self._available.get(currency, 0) + amount
+        self._version += 1
+
+    def apply_order(self, order, response=None, inside_bid=None,
+                    inside_ask=None):
+        """ Holds the amount an order that was just placed could spend.
+
+            order: dictionary of order parameters passed to GDAX
+            response: GDAX's response to the order; if it doesn't describe
+                an accepted order, nothing is held
+            inside_bid: inside bid used to estimate what a market sell
+                specified by funds will spend, if known
+            inside_ask: inside ask used to estimate what a market buy
+                specified by size will spend, if known
+
+            No return value.
+        """
+        if response is not None and (
+                not isinstance(response, dict) or 'id' not in response
+            ):
+            # Rejected; nothing held
+            return
+        base, quote = split_product(order['product_id'])
+        if order['side'] == 'buy':
+            currency = quote
+            if 'funds' in order:
+                amount = float(order['funds'])
+            elif 'price' in order:
+                amount = float(order['price']) * float(order['size'])
+            elif inside_ask is not None:
+                amount = float(inside_ask) * float(order['size'])
+            else:
+                amount = None
+        else:
+            currency = base
+            if 'size' in order:
+                amount = float(order['size'])
+            elif inside_bid:
+                amount = float(order['funds']) / float(inside_bid)
+            else:
+                amount = None
+        with self._lock:
+            if amount is None:
+                # Can't estimate; ask GDAX
+                self._request(0)
+                return
+            self._adjust(currency, -amount)
+            if response is not None:
+                self._holds[response['id']] = {
+                        'product_id' : order['product_id'],
+                        'side' : order['side'],
+                        'currency' : currency,
+                        'held' : amount,
+                        # Size filled as reported by fills
+                        'filled' : 0.0,
+                        # Size filled that GDAX's amounts already count
+                        'settled' : 0.0,
+                        # Whether GDAX's amounts already count what's left
+                        # of the hold as released
+                        'released' : False
+                    }
+
+    def apply_fill(self, order_id, size, price, fee=0):
+        """ Credits proceeds of a fill and spends from the order's hold.
+
+            order_id: ID of order that was (partially) filled
+            size: size of fill in base currency
+            price: price of fill in quote currency
+            fee: fee charged in quote currency
+
+            No return value.
+        """
+        with self._lock:
+            hold = self._holds.get(order_id)
+            if hold is None:
+                # Not an order we placed; wait for the next reconciliation
+                return
+            size, price, fee = float(size), float(price), float(fee)
+            base, quote = split_product(hold['product_id'])
+            # Only the part of the fill GDAX's amounts don't count yet
+            fresh = max(min(size, hold['filled'] + size - hold['settled']),
+                        0.0)
+            hold['filled'] += size
+            if hold['side'] == 'buy':
+                hold['held'] -= size * price + fee
+                if fresh:
+                    self._adjust(base, fresh)
+            else:
+                hold['held'] -= size
+                if fresh:
+                    self._adjust(quote, (size * price - fee) * fresh / size)
+
+    def apply_done(self, order_id):
+        """ Releases whatever an order that's done still holds.
+
+            order_id: ID of filled or canceled order
+
+            No return value.
+        """
+        with self._lock:
+            hold = self._holds.pop(order_id, None)
+            # Below zero if fees went past what was held
+            if hold is not None and hold['held'] and not hold['released']:
+                self._adjust(hold['currency'], hold['held'])
+
+    def _request(self, delay):
+        """ Schedules background reconciliation; call with lock held. """
+        reconcile_at = monotonic() + delay
+        if self._reconcile_at is None or reconcile_at < self._reconcile_at:
+            self._reconcile_at = reconcile_at
+        self._wakeup.set()
+
+    def request_reconcile(self, delay=0):
+        """ Asks the background thread to reconcile without blocking.
+
+            delay: how long (in s) to wait before reconciling, for example
+                to give orders time to fill
+
+            No return value.
+        """
+        with self._lock:
+            self._request(delay)
+
+    def _run(self):
+        """ Background loop reconciling periodically and on request. """
+        while not self._stopped:
+            with self._lock:
+                deadlines = [deadline for deadline in (self._reconcile_at,
+                                                       self._next_periodic)
+                             if deadline is not None]
+                deadline = min(deadlines) if deadlines else None
+                now = monotonic()
+                due = deadline is not None and deadline <= now
+                if due:
+                    self._reconcile_at = None
+                else:
+                    self._wakeup.clear()
+            if not due:
+                self._wakeup.wait(None if deadline is None else deadline - now)
+                continue
+            try:
+                self.reconcile()
+            except Exception:
+                # Keep local amounts; they'll be reconciled on the next try
+                self.metrics.increment('balance_reconcile_errors',
+                                       **self._labels)
+                self.event_log.log('error', traceback=format_exc())
+            if self.refresh_interval:
+                self._next_periodic = monotonic() + self.refresh_interval
+
+    def start(self):
+        """ Starts background reconciliation. """
+        if self.refresh_interval:
+            self._next_periodic = monotonic() + self.refresh_interval
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops background reconciliation. """
+        self._stopped = True
+        self._wakeup.set()
@@ -0,0 +1,321 @@
+"""
+vickitrix.book
+
+Keeps level-2 order books for GDAX products in memory from the websocket
+feed, so the inside bid and ask are available to orders without a
+request to GDAX.
+"""
+import json
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+gdax_feed_url = 'wss://ws-feed.gdax.com'
+
+class _Side(object):
+    """ Price levels on one side of a book, sorted by price.
+
+        Prices are kept in a compact array of doubles in ascending order,
+        with sizes in a dictionary keyed by price.
+    """
+
+    def __init__(self):
+        self.prices = array('d')
+        self.sizes = {}
+
+    def clear(self):
+        self.prices = array('d')
+        self.sizes = {}
+
+    def update(self, price, size):
+        """ Sets size at a price level, removing the level if size is 0.
+
+            price: price as float
+            size: size as float
+
+            No return value.
+        """
+        if size:
+            if price not in self.sizes:
+                insort(self.prices, price)
+            self.sizes[price] = size
+        elif price in self.sizes:
+            del self.sizes[price]
+            del self.prices[bisect_left(self.prices, price)]
+
+    def lowest(self):
+        return self.prices[0] if self.prices else None
+
+    def highest(self):
+        return self.prices[-1] if self.prices else None
+
+class Level2Book(object):
+    """ Aggregated order book for a single product. """
+
+    def __init__(self, product_id):
+        self.product_id = product_id
+        self.bids = _Side()
+        self.asks = _Side()
+        # Tuple (inside bid, inside ask), replaced whole after every update
+        # so readers on other threads see a consistent pair without locking
+        self.inside = None
+        # monotonic() time of the last message for the product, heartbeats
+        # included, or None
+        self.last_message = None
+        # False until a snapshot, and again after clear()
+        self.synced = False
+
+    def clear(self):
+        """ Empties book until the next snapshot. """
+        self.synced = False
+        self.inside = None
+        self.bids.clear()
+        self.asks.clear()
+
+    def _update_inside(self):
+        bid, ask = self.bids.highest(), self.asks.lowest()
+        self.inside = None if bid is None or ask is None else (bid, ask)
+
+    def snapshot(self, bids, asks):
+        """ Replaces book with a snapshot.
+
+            bids: list of [price, size] pairs, as strings
+            asks: list of [price, size] pairs, as strings
+
+            No return value.
+        """
+        self.bids.clear()
+        self.asks.clear()
+        for side, levels in ((self.bids, bids), (self.asks, asks)):
+            for price, size in levels:
+                side.update(float(price), float(size))
+        self.synced = True
+        self._update_inside()
+
+    def update(self, changes):
+        """ Applies changes from an l2update message.
+
+            changes: list of [side, price, size], as strings, where side is
+                "buy" or "sell"
+
+            No return value; changes are ignored until a snapshot.
+        """
+        if not self.synced:
+            return
+        for side, price, size in changes:
+            (self.bids if side == 'buy' else self.asks).update(
+                    float(price), float(size)
+                )
+        self._update_inside()
+
+class OrderBooks(object):
+    """ Order books for several products, updated from feed messages. """
+
+    def __init__(self, product_ids, max_staleness=5):
+        """
+            product_ids: iterable of GDAX product IDs like "ETH-USD"
+            max_staleness: time (in s) without so much as a heartbeat for
+                a product after which its book is no longer synced; the
+                feed sends one every second
+        """
+        self.books = dict(
+                (product_id, Level2Book(product_id))
+                for product_id in product_ids
+            )
+        self.max_staleness = max_staleness
+
+    def inside(self, product_id):
+        """ Gets inside bid and ask for a product.
+
+            product_id: GDAX product ID
+
+            Return value: tuple (inside bid, inside ask) as floats, or None
+                if the book isn't synced or the feed has gone quiet
+        """
+        book = self.books.get(product_id)
+        if book is None:
+            return None
+        last_message = book.last_message
+        if last_message is None or (
+                monotonic() - last_message > self.max_staleness
+            ):
+            # A stalled feed would otherwise leave a frozen bid and ask
+            return None
+        return book.inside
+
+    def invalidate(self):
+        """ Marks every book unsynced, for example after a disconnect;
+            updates don't resync a book, only a snapshot. """
+        for book in self.books.values():
+            book.clear()
+
+    def apply(self, message):
+        """ Applies a message from the GDAX websocket feed.
+
+            message: decoded message
+
+            No return value.
+        """
+        book = self.books.get(message.get('product_id'))
+        if book is None:
+            return
+        book.last_message = monotonic()
+        message_type = message.get('type')
+        if message_type == 'l2update':
+            book.update(message['changes'])
+        elif message_type == 'snapshot':
+            book.snapshot(message['bids'], message['asks'])
+
+    def replay(self, messages):
+        """ Applies a sequence of feed messages, such as a recorded feed.
+
+            messages: iterable of decoded messages
+
+            No return value.
+        """
+        for message in messages:
+            self.apply(message)
+
+def read_feed(feed_file):
+    """ Reads messages recorded from the GDAX websocket feed.
+
+        feed_file: file with one JSON message per line
+
+        Yield value: decoded message
+    """
+    with open(feed_file) as feed_stream:
+        for line in feed_stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+class WebsocketFeed(object):
+    """ Background connection to the GDAX websocket feed that reconnects
+        with backoff. Abstract: subclasses implement _listen(). """
+
+    def __init__(self, url=gdax_feed_url, reconnect_wait=1,
+                 max_reconnect_wait=60, recv_timeout=10):
+        """
+            url: websocket feed URL
+            reconnect_wait: initial time (in s) to wait before reconnecting
+                after the connection drops; doubles with each failure
+            max_reconnect_wait: maximum time (in s) to wait to reconnect
+            recv_timeout: time (in s) to wait to connect, or for a message,
+                before reconnecting; heartbeats arrive every second
+        """
+        self.url = url
+        self.reconnect_wait = reconnect_wait
+        self.max_reconnect_wait = max_reconnect_wait
+        self.recv_timeout = recv_timeout
+        self._stopped = threading.Event()
+        self._connection = None
+        self._thread = None
+
+    def _connect(self, subscription):
+        """ Connects and subscribes.
+
+            subscription: subscribe message
+
+            No return value.
+        """
+        from websocket import create_connection
+        self._connection = create_connection(self.url,
+                                             timeout=self.recv_timeout)
+        self._connection.send(json.dumps(subscription))
+
+    def _messages(self):
+        """ Yields messages until the feed is stopped. """
+        while not self._stopped.is_set():
+            message = json.loads(self._connection.recv())
+            if message.get('type') == 'error':
+                raise RuntimeError(
+                        'GDAX feed error: {}'.format(message.get('message'))
+                    )
+            yield message
+
+    def _listen(self):
+        """ Connects, subscribes, and handles messages until disconnect.
+
+            Abstract; each subclass subscribes to its own channels and
+            handles their messages, closing the connection when done.
+
+            No return value.
+        """
+        raise NotImplementedError
+
+    def _run(self):
+        if type(self)._listen == WebsocketFeed._listen:
+            # Reconnecting would only raise the same thing forever
+            raise NotImplementedError(
+                    '{} doesn\'t implement _listen().'.format(
+                            type(self).__name__
+                        )
+                )
+        wait = self.reconnect_wait
+        while not self._stopped.is_set():
+            started = time.time()
+            try:
+                self._listen()
+            except Exception:
+                if self._stopped.is_set():
+                    break
+            if time.time() - started > self.max_reconnect_wait:
+                # Connection was up a while; this is a fresh failure
+                wait = self.reconnect_wait
+            self._stopped.wait(wait)
+            wait = min(wait * 2, self.max_reconnect_wait)
+
+    def start(self):
+        """ Starts listening in a background thread. """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops background thread and closes connection. """
+        self._stopped.set()
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+
+class OrderBookFeed(WebsocketFeed):
+    """ Background connection to the GDAX websocket feed keeping order
+        books current. """
+
+    def __init__(self, books, url=gdax_feed_url, reconnect_wait=1,
+                 max_reconnect_wait=60, recv_timeout=10):
+        """
+            books: instance of OrderBooks to update
+            url, reconnect_wait, max_reconnect_wait, recv_timeout: see
+                WebsocketFeed
+        """
+        super(OrderBookFeed, self).__init__(
+                url=url, reconnect_wait=reconnect_wait,
+                max_reconnect_wait=max_reconnect_wait,
+                recv_timeout=recv_timeout
+            )
+        self.books = books
+
+    def _listen(self):
+        """ Connects, subscribes, and applies messages until disconnect. """
+        try:
+            self._connect({
+                    'type' : 'subscribe',
+                    'product_ids' : sorted(self.books.books),
+                    'channels' : ['level2', 'heartbeat']
+                })
+            for message in self._messages():
+                self.books.apply(message)
+        finally:
+            self.books.invalidate()
+            if self._connection is not None:
+                self._connection.close()
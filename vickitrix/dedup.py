@@ -0,0 +1,155 @@
+"""
+vickitrix.dedup
+
+Keeps a status from being traded on twice.
+
+Twitter can deliver a status again after a reconnect, and vickitrix can
+be restarted mid-stream, so the IDs of statuses already handed to rules
+are kept in a bounded set that forgets the oldest first and is saved to
+disk in the background. Every order also gets a client_oid derived from
+the status, rule, and order it came from, so an order whose submission
+failed ambiguously can be looked up on GDAX by that ID and resent only if
+it isn't there.
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+# Namespace of client_oids; never change it, or restarts would resend
+_client_oid_namespace = uuid.uuid5(uuid.NAMESPACE_URL,
+                                   'http://github.com/nellore/vickitrix')
+
+def rule_fingerprint(rule):
+    """ Identifies a rule by its contents, so it keeps its identity when
+        rules around it are added, removed, or reordered.
+
+        rule: rule dictionary as read from a rules file
+
+        Return value: hex digest
+    """
+    return hashlib.sha1(json.dumps(rule, sort_keys=True,
+                                   default=str).encode('utf-8')).hexdigest()
+
+def client_oid(status_id, fingerprint, order_index):
+    """ Gets the client_oid of an order placed for a status.
+
+        status_id: ID string of status
+        fingerprint: rule_fingerprint() of rule the order is from
+        order_index: index of order among the rule's orders
+
+        Return value: UUID string, the same every time for the same
+            arguments
+    """
+    return str(uuid.uuid5(_client_oid_namespace, ':'.join([
+            str(status_id), fingerprint, str(order_index)
+        ])))
+
+class SeenStatuses(object):
+    """ Bounded set of status IDs, oldest forgotten first, persisted as
+        JSON. """
+
+    def __init__(self, path=None, capacity=100000, save_interval=5):
+        """
+            path: file in which IDs are kept, or None to keep them only in
+                memory
+            capacity: most IDs remembered
+            save_interval: how often (in s) the background thread saves
+                IDs seen since the last save
+        """
+        self.path = path
+        self.capacity = capacity
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        # Keys are IDs as ints, which take less memory than strings
+        self._ids = OrderedDict()
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._thread = None
+        if path is not None:
+            try:
+                with open(path) as seen_stream:
+                    ids = json.load(seen_stream)
+            except (IOError, OSError, ValueError):
+                # Missing or corrupt; start over
+                ids = []
+            for status_id in ids[-capacity:]:
+                self._ids[status_id] = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, status_id):
+        return int(status_id) in self._ids
+
+    def add(self, status_id):
+        """ Remembers a status ID unless it's already remembered.
+
+            status_id: ID string of status
+
+            Return value: True iff status_id wasn't remembered already
+        """
+        status_id = int(status_id)
+        with self._lock:
+            if status_id in self._ids:
+                return False
+            self._ids[status_id] = None
+            if len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+            self._dirty = True
+        return True
+
+    def discard(self, status_id):
+        """ Forgets a status ID, as when its status wasn't handled after
+            all.
+
+            No return value.
+        """
+        status_id = int(status_id)
+        with self._lock:
+            if status_id in self._ids:
+                del self._ids[status_id]
+                self._dirty = True
+
+    def save(self):
+        """ Writes remembered IDs, replacing the file only once it's
+            complete.
+
+            No return value.
+        """
+        with self._lock:
+            if not self._dirty or self.path is None:
+                return
+            ids = list(self._ids)
+            self._dirty = False
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as seen_stream:
+            json.dump(ids, seen_stream, separators=(',', ':'))
+        os.rename(temp_path, self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.save_interval):
+            try:
+                self.save()
+            except (IOError, OSError):
+                # Try again next time
+                with self._lock:
+                    self._dirty = True
+
+    def start(self):
+        """ Starts saving in the background. """
+        if self.path is None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Stops saving in the background and saves one last time. """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
@@ -0,0 +1,74 @@
+"""
+vickitrix.display
+
+Console output shared by vickitrix's subcommands.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import unicodedata
+
+def print_to_screen(message, newline=True, carriage_return=False):
+    """ Prints message to stdout as well as stderr if stderr is redirected.
+
+        message: message to print
+        newline: True iff newline should be printed
+        carriage_return: True iff carriage return should be printed; also
+            clears line with ANSI escape code
+
+        No return value.
+    """
+    full_message = ('\x1b[K' + message + ('\r' if carriage_return else '')
+                        + (os.linesep if newline else ''))
+    try:
+        sys.stderr.write(full_message)
+        if sys.stderr.isatty():
+            sys.stderr.flush()
+        else:
+            try:
+                # So the user sees it too
+                sys.stdout.write(full_message)
+                sys.stdout.flush()
+            except UnicodeEncodeError:
+                sys.stdout.write(
+                                unicodedata.normalize(
+                                        'NFKD', full_message
+                                    ).encode('ascii', 'ignore')
+                            )
+                sys.stdout.flush()
+    except UnicodeEncodeError:
+        sys.stderr.write(
+                        unicodedata.normalize(
+                                'NFKD', full_message
+                            ).encode('ascii', 'ignore')
+                    )
+        sys.stderr.flush()
+
+def timestamp():
+    """ Returns timestamp string. """
+    return time.strftime('%A, %b %d, %Y at %I:%M:%S %p %Z || ',
+                         time.localtime(time.time()))
+
+def prettify_dict(rule):
+    """ Prettifies printout of dictionary as string.
+
+        rule: rule
+
+        Return value: rule string
+    """
+    return json.dumps(rule, sort_keys=False,
+                        indent=4, separators=(',', ': '))
+
+def print_dough(dough):
+    """ Prints amounts available to trade.
+
+        dough: dictionary mapping currency to amount
+
+        No return value.
+    """
+    print_to_screen(''.join([timestamp(), 'Available to trade: ',
+                    ', '.join(['{} {}'.format(amount, currency)
+                                for currency, amount in dough.items()])]))
@@ -0,0 +1,734 @@
+"""
+vickitrix.dsl
+
+Declarative rules files in YAML or JSON, with a small expression language
+for conditions and order amounts:
+
+    rules:
+      - handles: [vickibotethusd]
+        condition: '"ETHUSD" in tweet and "long" in tweet'
+        orders:
+          - side: buy
+            type: market
+            product_id: ETH-USD
+            funds: available[USD] * 0.5
+
+An expression is parsed once into a syntax tree, type-checked against the
+fields, currencies, and products it may refer to, and compiled into a
+Python function, so mistakes are caught when rules are loaded rather than
+when a tweet arrives, and nothing is formatted or parsed per tweet.
+
+Expressions have numbers, strings in single or double quotes, true and
+false; the variables tweet (text of the status), available[<currency>]
+(amount available to trade), and, in order amounts only, inside_bid and
+inside_ask; the operators or, and, not, ==, !=, <, <=, >, >=, in, not in,
++, -, *, and /; and the functions min, max, abs, round, lower, and upper.
+"""
+import json
+import os
+import re
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# What reading a rules file raises when it isn't valid JSON or YAML
+if yaml is None:
+    _parse_errors = (ValueError,)
+else:
+    _parse_errors = (ValueError, yaml.YAMLError)
+
+from .balances import split_product
+from .dedup import rule_fingerprint
+from .display import prettify_dict
+
+try:
+    _string_types = basestring
+except NameError:
+    # Python 3
+    _string_types = str
+
+# Products GDAX lists; a rules file may add to these with "products"
+known_products = ['BTC-USD', 'BTC-EUR', 'BTC-GBP', 'ETH-USD', 'ETH-EUR',
+                  'ETH-BTC', 'LTC-USD', 'LTC-EUR', 'LTC-BTC', 'BCH-USD',
+                  'BCH-EUR', 'BCH-BTC']
+
+rule_fields = ['handles', 'keywords', 'condition', 'orders', 'execution']
+
+# Order parameters from https://docs.gdax.com/#orders and allowed values;
+# client_oid is always derived from the status, rule, and order
+order_fields = {
+        'type' : ['limit', 'market', 'stop'],
+        'side' : ['buy', 'sell'],
+        'product_id' : None,
+        'stp' : ['dc', 'co', 'cn', 'cb'],
+        'price' : None,
+        'size' : None,
+        'time_in_force' : ['GTC', 'GTT', 'IOC', 'FOK'],
+        'cancel_after' : ['min', 'hour', 'day'],
+        'post_only' : [True, False],
+        'funds' : None,
+        'overdraft_enabled' : [True, False],
+        'funding_amount' : None
+    }
+
+money_fields = ['size', 'funds', 'price']
+
+_token_pattern = re.compile(r'''
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<operator>==|!=|<=|>=|[-+*/()<>\[\],.])
+    )''', re.VERBOSE)
+
+_keywords = set(['and', 'or', 'not', 'in', 'true', 'false'])
+
+# Name: (argument types, True iff last argument repeats, result type)
+_functions = {
+        'min' : (['number', 'number'], True, 'number'),
+        'max' : (['number', 'number'], True, 'number'),
+        'abs' : (['number'], False, 'number'),
+        'round' : (['number', 'number'], False, 'number'),
+        'lower' : (['string'], False, 'string'),
+        'upper' : (['string'], False, 'string')
+    }
+
+_comparisons = ['==', '!=', '<', '<=', '>', '>=', 'in', 'not in']
+
+class ExpressionError(ValueError):
+    """ Raised when an expression can't be parsed or type-checked. """
+
+    def __init__(self, message, position):
+        super(ExpressionError, self).__init__(message)
+        self.position = position
+
+def tokenize(expression):
+    """ Splits an expression into tokens.
+
+        expression: expression string
+
+        Return value: list of tuples (kind, value, position), where kind is
+            one of "number", "string", "name", "keyword", "operator", and
+            "end"
+    """
+    tokens, position = [], 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _token_pattern.match(expression, position)
+        if match is None:
+            stripped = len(expression) - len(expression[position:].lstrip())
+            raise ExpressionError('unexpected character', stripped)
+        kind = match.lastgroup
+        value = match.group(kind)
+        start = match.start(kind)
+        if kind == 'number':
+            value = float(value)
+        elif kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'name' and value in _keywords:
+            kind = 'keyword'
+        tokens.append((kind, value, start))
+        position = match.end()
+    tokens.append(('end', None, len(expression)))
+    return tokens
+
+class _Parser(object):
+    """ Recursive-descent parser building a syntax tree of tuples:
+
+            ('number', value), ('string', value), ('bool', value),
+            ('variable', name), ('available', currency),
+            ('unary', operator, operand), ('binary', operator, left, right),
+            and ('call', function name, arguments),
+
+        each followed by the node's position in the expression.
+    """
+
+    def __init__(self, expression):
+        self.tokens = tokenize(expression)
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index]
+
+    def take(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.index += 1
+            return token
+        return None
+
+    def expect(self, kind, value, description):
+        token = self.accept(kind, value)
+        if token is None:
+            raise ExpressionError('expected ' + description, self.peek()[2])
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        token = self.peek()
+        if token[0] != 'end':
+            raise ExpressionError('unexpected "{}"'.format(token[1]),
+                                  token[2])
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while True:
+            token = self.accept('keyword', 'or')
+            if token is None:
+                return node
+            node = ('binary', 'or', node, self.parse_and(), token[2])
+
+    def parse_and(self):
+        node = self.parse_not()
+        while True:
+            token = self.accept('keyword', 'and')
+            if token is None:
+                return node
+            node = ('binary', 'and', node, self.parse_not(), token[2])
+
+    def parse_not(self):
+        token = self.accept('keyword', 'not')
+        if token is not None:
+            return ('unary', 'not', self.parse_not(), token[2])
+        return self.parse_comparison()
+
+    def comparison_operator(self):
+        token = self.peek()
+        if token[0] == 'operator' and token[1] in _comparisons:
+            self.take()
+            return token[1], token[2]
+        if token[0] == 'keyword' and token[1] == 'in':
+            self.take()
+            return 'in', token[2]
+        if (token[0] == 'keyword' and token[1] == 'not'
+                and self.tokens[self.index + 1][:2] == ('keyword', 'in')):
+            self.index += 2
+            return 'not in', token[2]
+        return None, None
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        operator, position = self.comparison_operator()
+        if operator is None:
+            return node
+        node = ('binary', operator, node, self.parse_sum(), position)
+        operator, position = self.comparison_operator()
+        if operator is not None:
+            raise ExpressionError(
+                    'comparisons can\'t be chained; use "and"', position
+                )
+        return node
+
+    def parse_sum(self):
+        node = self.parse_term()
+        while True:
+            token = self.accept('operator', '+') or self.accept(
+                    'operator', '-'
+                )
+            if token is None:
+                return node
+            node = ('binary', token[1], node, self.parse_term(), token[2])
+
+    def parse_term(self):
+        node = self.parse_unary()
+        while True:
+            token = self.accept('operator', '*') or self.accept(
+                    'operator', '/'
+                )
+            if token is None:
+                return node
+            node = ('binary', token[1], node, self.parse_unary(), token[2])
+
+    def parse_unary(self):
+        token = self.accept('operator', '-')
+        if token is not None:
+            return ('unary', '-', self.parse_unary(), token[2])
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind, value, position = self.take()
+        if kind == 'number':
+            return ('number', value, position)
+        if kind == 'string':
+            return ('string', value, position)
+        if kind == 'keyword' and value in ['true', 'false']:
+            return ('bool', value == 'true', position)
+        if kind == 'operator' and value == '(':
+            node = self.parse_or()
+            self.expect('operator', ')', '")"')
+            return node
+        if kind != 'name':
+            raise ExpressionError(
+                    'unexpected end of expression' if kind == 'end'
+                    else 'unexpected "{}"'.format(value), position
+                )
+        if self.accept('operator', '('):
+            arguments = []
+            if not self.accept('operator', ')'):
+                arguments.append(self.parse_or())
+                while self.accept('operator', ','):
+                    arguments.append(self.parse_or())
+                self.expect('operator', ')', '")" or ","')
+            return ('call', value, arguments, position)
+        if value == 'available':
+            if self.accept('operator', '['):
+                currency = self.take()
+                if currency[0] not in ['name', 'string']:
+                    raise ExpressionError('expected a currency', currency[2])
+                self.expect('operator', ']', '"]"')
+            else:
+                self.expect('operator', '.', '"[" or "." after "available"')
+                currency = self.expect('name', None, 'a currency')
+            return ('available', currency[1].upper(), position)
+        return ('variable', value, position)
+
+def parse(expression):
+    """ Parses an expression into a syntax tree.
+
+        expression: expression string
+
+        Return value: syntax tree; see _Parser
+    """
+    return _Parser(expression).parse()
+
+def check(node, variables, currencies, used=None):
+    """ Type-checks a syntax tree.
+
+        node: syntax tree from parse()
+        variables: dictionary mapping names of variables an expression may
+            use to their types
+        currencies: set of currencies that may be used with "available"
+        used: set to which names of variables the expression uses are
+            added, or None
+
+        Return value: type of expression: "number", "string", or "bool"
+    """
+    if used is None:
+        used = set()
+    kind, position = node[0], node[-1]
+    if kind in ['number', 'string', 'bool']:
+        return kind
+    if kind == 'variable':
+        if node[1] not in variables:
+            raise ExpressionError(
+                    'unknown variable "{}"; use one of {}'.format(
+                            node[1], ', '.join(sorted(variables))
+                        ), position
+                )
+        used.add(node[1])
+        return variables[node[1]]
+    if kind == 'available':
+        if node[1] not in currencies:
+            raise ExpressionError(
+                    'unknown currency "{}"; use one of {}'.format(
+                            node[1], ', '.join(sorted(currencies))
+                        ), position
+                )
+        used.add('available')
+        return 'number'
+    if kind == 'unary':
+        operand = check(node[2], variables, currencies, used)
+        expected = 'bool' if node[1] == 'not' else 'number'
+        if operand != expected:
+            raise ExpressionError('"{}" needs a {}, not a {}'.format(
+                    node[1], expected, operand
+                ), position)
+        return expected
+    if kind == 'call':
+        if node[1] not in _functions:
+            raise ExpressionError(
+                    'unknown function "{}"; use one of {}'.format(
+                            node[1], ', '.join(sorted(_functions))
+                        ), position
+                )
+        expected, repeats, result = _functions[node[1]]
+        arguments = node[2]
+        if len(arguments) < len(expected) or (
+                len(arguments) > len(expected) and not repeats
+            ):
+            raise ExpressionError('{}() takes {}{} argument(s)'.format(
+                    node[1], len(expected), ' or more' if repeats else ''
+                ), position)
+        for i, argument in enumerate(arguments):
+            argument_type = check(argument, variables, currencies, used)
+            wanted = expected[min(i, len(expected) - 1)]
+            if argument_type != wanted:
+                raise ExpressionError('{}() needs a {}, not a {}'.format(
+                        node[1], wanted, argument_type
+                    ), argument[-1])
+        return result
+    assert kind == 'binary'
+    operator = node[1]
+    left = check(node[2], variables, currencies, used)
+    right = check(node[3], variables, currencies, used)
+    if operator in ['and', 'or']:
+        wanted = ('bool', 'bool')
+    elif operator in ['in', 'not in']:
+        wanted = ('string', 'string')
+    elif operator in ['==', '!=']:
+        wanted = (left, left)
+    elif operator in ['<', '<=', '>', '>=']:
+        wanted = ('number', 'number') if left != 'string' else (
+                'string', 'string'
+            )
+    else:
+        wanted = ('number', 'number')
+    if (left, right) != wanted:
+        raise ExpressionError('"{}" can\'t combine a {} and a {}'.format(
+                operator, left, right
+            ), position)
+    if operator in ['+', '-', '*', '/']:
+        return 'number'
+    return 'bool'
+
+def to_python(node):
+    """ Translates a type-checked syntax tree into Python source.
+
+        node: syntax tree from parse()
+
+        Return value: Python expression using the variables tweet,
+            available, inside_bid, and inside_ask
+    """
+    kind = node[0]
+    if kind in ['number', 'string']:
+        return repr(node[1])
+    if kind == 'bool':
+        return repr(node[1])
+    if kind == 'variable':
+        return node[1]
+    if kind == 'available':
+        # A currency with no account has nothing available
+        return 'available.get({!r}, 0.0)'.format(node[1])
+    if kind == 'unary':
+        return '({} {})'.format(node[1], to_python(node[2]))
+    if kind == 'call':
+        arguments = [to_python(argument) for argument in node[2]]
+        if node[1] in ['lower', 'upper']:
+            return '{}.{}()'.format(arguments[0], node[1])
+        if node[1] == 'round':
+            return 'round({}, int({}))'.format(*arguments)
+        return '{}({})'.format(node[1], ', '.join(arguments))
+    left, right = to_python(node[2]), to_python(node[3])
+    if node[1] == '/':
+        # Amounts are floats, but be sure of true division on Python 2
+        return '({} / float({}))'.format(left, right)
+    return '({} {} {})'.format(left, node[1], right)
+
+_builtins = {'min' : min, 'max' : max, 'abs' : abs, 'round' : round,
+             'int' : int, 'float' : float}
+
+def compile_expression(expression, variables, currencies, result_type,
+                       description='<rule>'):
+    """ Parses, type-checks, and compiles an expression.
+
+        expression: expression string, or a number
+        variables: dictionary mapping names of variables the expression may
+            use to their types
+        currencies: set of currencies that may be used with "available"
+        result_type: type the expression must have
+        description: filename-like description of the expression's origin,
+            shown in tracebacks
+
+        Return value: tuple (function, set of variables used), where
+            function takes arguments tweet, available, inside_bid, and
+            inside_ask and returns the value of the expression
+    """
+    if isinstance(expression, bool):
+        expression = 'true' if expression else 'false'
+    elif isinstance(expression, (int, float)):
+        expression = repr(float(expression))
+    if not isinstance(expression, _string_types):
+        raise ExpressionError('expected an expression', 0)
+    node = parse(expression)
+    used = set()
+    expression_type = check(node, variables, currencies, used)
+    if expression_type != result_type:
+        raise ExpressionError('expression is a {}, but must be a {}'.format(
+                expression_type, result_type
+            ), 0)
+    return eval(compile(
+            ''.join(['lambda tweet, available, inside_bid, inside_ask: ',
+                     to_python(node)]),
+            description, 'eval'
+        ), {'__builtins__' : _builtins}), used
+
+_condition_variables = {'tweet' : 'string'}
+_money_variables = {'tweet' : 'string', 'inside_bid' : 'number',
+                    'inside_ask' : 'number'}
+
+def _rule_error(rules_file, i, rule, message):
+    return RuntimeError(''.join([
+            'Rule #{} in the file "{}" is invalid: {}'.format(
+                    i+1, rules_file, message
+                ), os.linesep, prettify_dict(rule)
+        ]))
+
+def _expression_error(rules_file, i, rule, where, expression, error):
+    return RuntimeError(''.join([
+            'In the file "{}", {} of rule #{} is invalid: {}'.format(
+                    rules_file, where, i+1, error
+                ), os.linesep, '    ', str(expression), os.linesep,
+            '    ', ' ' * error.position, '^', os.linesep,
+            prettify_dict(rule)
+        ]))
+
+def compile_rules(rules, rules_file='<rules>', products=()):
+    """ Checks and compiles declarative rules.
+
+        rules: list of rule dictionaries as read from a rules file
+        rules_file: name of file from which rules were loaded
+        products: GDAX product IDs allowed in addition to known_products
+
+        Return value: list of compiled rules in the form returned by
+            vickitrix.compile_rules()
+    """
+    products = set(known_products) | set(products)
+    currencies = set()
+    for product_id in products:
+        currencies.update(split_product(product_id))
+    compiled_rules = []
+    for i, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise _rule_error(rules_file, i, rule, 'it isn\'t a mapping')
+        unknown = sorted(key for key in rule if key not in rule_fields)
+        if unknown:
+            raise _rule_error(rules_file, i, rule,
+                              'unknown key(s) {}; use {}'.format(
+                                    ', '.join(unknown), ', '.join(rule_fields)
+                                ))
+        if 'handles' not in rule and 'keywords' not in rule:
+            raise _rule_error(rules_file, i, rule,
+                              'it needs at least one of handles and keywords')
+        for key in ['handles', 'keywords']:
+            if not isinstance(rule.get(key, []), list) or not all(
+                    isinstance(item, _string_types) for item in rule.get(
+                            key, []
+                        )
+                ):
+                raise _rule_error(rules_file, i, rule,
+                                  '{} must be a list of strings'.format(key))
+        execution = rule.get('execution', 'parallel')
+        if execution not in ['parallel', 'sequential']:
+            raise _rule_error(rules_file, i, rule,
+                              'execution must be parallel or sequential')
+        condition = rule.get('condition', 'true')
+        try:
+            condition_function, _ = compile_expression(
+                    condition, _condition_variables, currencies, 'bool',
+                    '<{}: rule #{} condition>'.format(rules_file, i+1)
+                )
+        except ExpressionError as e:
+            raise _expression_error(rules_file, i, rule, 'the condition',
+                                    condition, e)
+        if not isinstance(rule.get('orders'), list) or not rule['orders']:
+            raise _rule_error(rules_file, i, rule,
+                              'it needs a nonempty list of orders')
+        fingerprint = rule_fingerprint(rule)
+        compiled_orders = []
+        for j, order in enumerate(rule['orders']):
+            if not isinstance(order, dict):
+                raise _rule_error(rules_file, i, rule,
+                                  'order #{} isn\'t a mapping'.format(j+1))
+            order = dict(order)
+            order.setdefault('type', 'limit')
+            if 'client_oid' in order:
+                raise _rule_error(
+                        rules_file, i, rule,
+                        ('order #{} sets client_oid, but vickitrix derives '
+                         'it from the status, rule, and order so no order '
+                         'is placed twice').format(j+1)
+                    )
+            for key, value in order.items():
+                if key not in order_fields:
+                    raise _rule_error(
+                            rules_file, i, rule,
+                            'order #{} has unknown key {}; use {}'.format(
+                                    j+1, key, ', '.join(sorted(order_fields))
+                                )
+                        )
+                if order_fields[key] is not None and (
+                        value not in order_fields[key]
+                    ):
+                    raise _rule_error(
+                            rules_file, i, rule,
+                            '{} of order #{} must be one of {}'.format(
+                                    key, j+1, ', '.join(
+                                            str(allowed) for allowed
+                                            in order_fields[key]
+                                        )
+                                )
+                        )
+            for key in ['side', 'product_id']:
+                if key not in order:
+                    raise _rule_error(rules_file, i, rule,
+                                      'order #{} needs a {}'.format(j+1, key))
+            if order['product_id'] not in products:
+                raise _rule_error(
+                        rules_file, i, rule,
+                        ('order #{} has unknown product_id {}; add it to '
+                         'the file\'s "products" if GDAX lists it').format(
+                                j+1, order['product_id']
+                            )
+                    )
+            if order['type'] == 'limit':
+                missing = [key for key in ['price', 'size']
+                           if key not in order]
+                if missing:
+                    raise _rule_error(
+                            rules_file, i, rule,
+                            'limit order #{} needs a {}'.format(
+                                    j+1, ' and a '.join(missing)
+                                )
+                        )
+            elif 'size' not in order and 'funds' not in order:
+                raise _rule_error(
+                        rules_file, i, rule,
+                        '{} order #{} needs a size or funds'.format(
+                                order['type'], j+1
+                            )
+                    )
+            compiled_order = {'static' : {}, 'money' : [],
+                              'needs_book' : False,
+                              'source' : (fingerprint, j)}
+            for key, value in order.items():
+                if key not in money_fields:
+                    compiled_order['static'][key] = value
+                    continue
+                try:
+                    function, used = compile_expression(
+                            value, _money_variables, currencies, 'number',
+                            '<{}: rule #{} order #{} {}>'.format(
+                                    rules_file, i+1, j+1, key
+                                )
+                        )
+                except ExpressionError as e:
+                    raise _expression_error(
+                            rules_file, i, rule,
+                            '{} of order #{}'.format(key, j+1), value, e
+                        )
+                compiled_order['money'].append((key, function))
+                if 'inside_bid' in used or 'inside_ask' in used:
+                    compiled_order['needs_book'] = True
+            compiled_orders.append(compiled_order)
+        compiled_rules.append({
+                'handles' : [
+                        handle.lower() for handle in rule.get('handles', [])
+                    ],
+                'keywords' : [
+                        keyword.lower() for keyword
+                        in rule.get('keywords', [])
+                    ],
+                'condition' : condition_function,
+                'orders' : compiled_orders,
+                'execution' : execution,
+                'rule' : rule
+            })
+    return compiled_rules
+
+def read_rules_file(rules_file):
+    """ Reads a YAML or JSON rules file.
+
+        rules_file: path to file ending in .yaml, .yml, or .json holding
+            either a list of rules or a mapping with key "rules" and,
+            optionally, "products"
+
+        Return value: tuple (list of rules, list of extra products)
+    """
+    try:
+        with open(rules_file) as rules_stream:
+            if rules_file.endswith('.json'):
+                document = json.load(rules_stream)
+            else:
+                if yaml is None:
+                    raise RuntimeError(
+                        'PyYAML is required to read YAML rules files. '
+                        'Install it with "pip install pyyaml", or write '
+                        'rules as JSON.'
+                    )
+                document = yaml.safe_load(rules_stream)
+    except IOError as e:
+        e.message = 'Cannot find or access rules file "{}".'.format(
+                                                                rules_file
+                                                            )
+        raise
+    except _parse_errors as e:
+        raise RuntimeError('Cannot parse rules file "{}": {}'.format(
+                rules_file, e
+            ))
+    products = []
+    if isinstance(document, dict):
+        products = document.get('products', [])
+        document = document.get('rules')
+    if not isinstance(document, list):
+        raise RuntimeError(
+                ('The rules file "{}" must hold a list of rules or a mapping '
+                 'with the key "rules".').format(rules_file)
+            )
+    return document, products
+
+def load_rules(rules_file):
+    """ Loads, checks, and compiles a YAML or JSON rules file.
+
+        rules_file: path to rules file; see read_rules_file()
+
+        Return value: list of compiled rules
+    """
+    rules, products = read_rules_file(rules_file)
+    return compile_rules(rules, rules_file, products)
+
+def convert_template(template):
+    """ Converts a condition or amount from a Python rules file into an
+        expression.
+
+        template: string with {tweet}, {available[<currency>]},
+            {inside_bid}, and/or {inside_ask} fields
+
+        Return value: expression string
+    """
+    if not isinstance(template, _string_types):
+        # Already a number or boolean
+        return template
+    expression = re.sub(r'\{(tweet|inside_bid|inside_ask)\}', r'\1',
+                        template)
+    expression = re.sub(r'\{available\[\'?"?(\w+)\'?"?\]\}',
+                        r'available[\1]', expression)
+    return re.sub(r'\bTrue\b', 'true', re.sub(r'\bFalse\b', 'false',
+                                               expression))
+
+def convert_rules(rules):
+    """ Converts rules from a Python rules file into declarative rules.
+
+        rules: list of rules as loaded from a Python rules file
+
+        Return value: list of declarative rules; compile_rules() should be
+            run on them to check that every expression converted
+    """
+    converted = []
+    for rule in rules:
+        new_rule = {}
+        for key in rule_fields:
+            if key not in rule:
+                continue
+            if key == 'condition':
+                new_rule[key] = convert_template(rule[key])
+            elif key == 'orders':
+                new_rule[key] = [
+                        dict((order_key, convert_template(value)
+                              if order_key in money_fields else value)
+                             for order_key, value in order.items()
+                             # Derived when the order is placed
+                             if order_key != 'client_oid')
+                        for order in rule[key]
+                    ]
+            else:
+                new_rule[key] = rule[key]
+        converted.append(new_rule)
+    return converted
@@ -0,0 +1,258 @@
+"""
+vickitrix.eventlog
+
+Structured log of what vickitrix does while trading: tweets matched,
+orders placed, fills, and errors.
+
+Logging an event only appends a record to a bounded ring buffer. A
+background thread drains the buffer, writes each record as one line of
+compact JSON to a log file that is rotated by size, and optionally prints
+a human-readable view of it, so neither formatting nor flushing happens
+on the order path.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from .display import print_to_screen, prettify_dict
+
+def _dough_text(dough):
+    return ', '.join(['{} {}'.format(amount, currency)
+                      for currency, amount in dough.items()])
+
+def _console_text(record):
+    """ Renders a record for the console.
+
+        record: event record
+
+        Return value: text
+    """
+    stamp = time.strftime('%A, %b %d, %Y at %I:%M:%S %p %Z || ',
+                          time.localtime(record['time']))
+    if 'account' in record:
+        stamp = ''.join([stamp, '[', str(record['account']), '] '])
+    if 'connection' in record:
+        stamp = ''.join([stamp, '[connection ', str(record['connection']),
+                         '] '])
+    event = record['event']
+    if event == 'tweet_matched':
+        return ''.join([stamp, 'TWEET MATCHED || @', record['handle'], ': ',
+                        record['text']])
+    if event == 'balances':
+        return ''.join([stamp, 'Available to trade: ',
+                        _dough_text(record['available'])])
+    if event == 'order_placing':
+        return ''.join([stamp, 'PLACING ORDER', os.linesep,
+                        prettify_dict(record['order'])])
+    if event == 'order_skipped':
+        return ''.join([stamp, 'One of {"price", "funds", "size"} is zero! ',
+                        'Order not placed.'])
+    if event == 'order_resending':
+        return ''.join([stamp, 'Order may not have been placed; resending ',
+                        'it with client_oid ', record['order']['client_oid'],
+                        '...'])
+    if event == 'order_placed':
+        return ''.join([stamp, 'Order placed.'])
+    if event == 'order_rejected':
+        return ''.join([stamp, 'Order rejected: ',
+                        str(record['response'])])
+    if event == 'fill':
+        return ''.join([stamp, 'Order {} filled: {} at {}'.format(
+                record['order_id'], record['size'], record['price']
+            )])
+    if event == 'order_done':
+        return ''.join([stamp, 'Order {} done ({}); filled {}.'.format(
+                record['order_id'], record['reason'], record['filled_size']
+            )])
+    if event == 'rules_reloaded':
+        return ''.join([stamp, 'Reloaded {} rule(s) from "{}".'.format(
+                record['rules'], record['rules_file']
+            )])
+    if event == 'rules_rejected':
+        return ''.join([stamp, 'Kept current rules; "{}" is invalid: '.format(
+                record['rules_file']
+            ), record['error']])
+    if event == 'stream_refilter':
+        return ''.join([stamp, 'Followed handles or tracked keywords ',
+                        'changed; reconnecting to Twitter...'])
+    if event == 'stream_rebalanced':
+        return ''.join([stamp, 'Following {} user(s) and tracking {} '.format(
+                record['follow'], record['track']
+            ), 'keyword(s) over {} connection(s) to Twitter.'.format(
+                record['connections']
+            )])
+    if event == 'stream_connected':
+        return stamp + 'Connected to Twitter.'
+    if event == 'stream_disconnected':
+        return ''.join([stamp, 'Disconnected from Twitter ({}{}); '.format(
+                record['reason'],
+                ', HTTP {}'.format(record['status_code'])
+                if record['status_code'] else ''
+            ), 'reconnecting in {} s...'.format(record['wait'])])
+    if event == 'status_duplicate':
+        return stamp + 'Ignored status {} seen before.'.format(
+                record['status_id']
+            )
+    if event == 'status_dropped':
+        return stamp + 'Status queue full; dropped a status.'
+    if event == 'error':
+        return record['traceback']
+    fields = dict(record)
+    del fields['time'], fields['event']
+    fields.pop('account', None)
+    fields.pop('connection', None)
+    return ''.join([stamp, event, ' ', json.dumps(fields, default=str)])
+
+class EventLog(object):
+    """ Buffered JSON-lines event log with an optional console view. """
+
+    def __init__(self, path=None, console=True, capacity=10000,
+                 max_bytes=10 * 1024 * 1024, backups=5, flush_interval=0.25):
+        """
+            path: file to which records are written as JSON lines, or None
+            console: True iff a human-readable view of records should be
+                printed
+            capacity: maximum number of records waiting to be written;
+                once full, the oldest waiting records are dropped
+            max_bytes: size (in bytes) past which the log file is rotated,
+                or None to never rotate
+            backups: number of rotated log files to keep, named path.1
+                (newest) through path.<backups>
+            flush_interval: how often (in s) the writer drains the buffer
+        """
+        self.path = path
+        self.console = console
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        # Nothing to write means nothing to buffer
+        self.enabled = bool(path) or console
+        self.dropped = 0
+        self._records = deque(maxlen=capacity)
+        self._stream = None
+        self._size = 0
+        # Whether the last write to the log file failed
+        self._failing = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def log(self, event, **fields):
+        """ Records an event without waiting on any output.
+
+            event: event name, like "order_placed"
+            fields: JSON-serializable fields of event
+
+            No return value.
+        """
+        if not self.enabled:
+            return
+        fields['time'] = time.time()
+        fields['event'] = event
+        if len(self._records) >= self.capacity:
+            self.dropped += 1
+        self._records.append(fields)
+
+    def _open(self):
+        self._stream = open(self.path, 'a')
+        self._stream.seek(0, os.SEEK_END)
+        self._size = self._stream.tell()
+
+    def _rotate(self):
+        """ Moves path to path.1, path.1 to path.2, and so on. """
+        self._stream.close()
+        # Reopened by the next write if renaming fails
+        self._stream = None
+        for i in range(self.backups - 1, 0, -1):
+            older = '{}.{}'.format(self.path, i)
+            if os.path.exists(older):
+                os.rename(older, '{}.{}'.format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        """ Writes every buffered record; called by the writer thread.
+
+            No return value.
+        """
+        written = False
+        while True:
+            try:
+                record = self._records.popleft()
+            except IndexError:
+                break
+            if self.console:
+                try:
+                    print_to_screen(_console_text(record))
+                except Exception:
+                    # A record missing fields shouldn't stop the writer
+                    print_to_screen(json.dumps(record, default=str))
+            if self.path:
+                line = json.dumps(record, separators=(',', ':'),
+                                  default=str) + '\n'
+                try:
+                    if self._stream is None:
+                        self._open()
+                    if self.max_bytes and self._size and (
+                            self._size + len(line) > self.max_bytes
+                        ):
+                        self._rotate()
+                    self._stream.write(line)
+                    self._size += len(line)
+                    written = True
+                    self._failing = False
+                except (IOError, OSError) as e:
+                    # A full disk shouldn't stop the writer, or the console
+                    self._write_failed(e)
+        if written and self._stream is not None:
+            try:
+                self._stream.flush()
+            except (IOError, OSError) as e:
+                self._write_failed(e)
+
+    def _write_failed(self, error):
+        """ Counts a record that couldn't be written to the log file,
+            reporting the first of a run of failures on stderr. """
+        self.dropped += 1
+        if not self._failing:
+            self._failing = True
+            try:
+                sys.stderr.write(
+                        'Couldn\'t write to event log "{}": {}{}'.format(
+                                self.path, error, os.linesep
+                            )
+                    )
+            except Exception:
+                pass
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        """ Opens the log file and starts the writer thread. """
+        if not self.enabled or self._thread is not None:
+            return
+        if self.path:
+            self._open()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Writes buffered records, then stops the writer thread. """
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
@@ -0,0 +1,206 @@
+"""
+vickitrix.listener
+
+Trades on GDAX based on tweets from the Twitter stream. Kept apart from the
+command-line entry point so subcommands that don't trade never load the
+GDAX and Twitter clients.
+"""
+import threading
+
+try:
+    import gdax
+except ImportError as e:
+    e.message = (
+         'vickitrix requires GDAX-Python. Install it with "pip install gdax".'
+        )
+    raise
+
+from .accounts import AccountRouter
+from .balances import BalanceCache
+from .eventlog import EventLog
+from .metrics import Metrics
+from .matchpool import MatchPool
+from .orders import OrderTracker, UserFeed
+from .pipeline import Pipeline
+from .stream import (ReconnectingStreamer, author_patterns, loads,
+                     max_author_patterns, status_prefix)
+from .trader import Trader
+
+class TradeListener(ReconnectingStreamer):
+    """ Trades on GDAX based on tweets. """
+
+    def __init__(self, rules, gdax_client,
+                 app_key, app_secret, oauth_token, oauth_token_secret,
+                 stall_timeout=90, connect_timeout=10, rate_limit_cap=960,
+                 client_args=None, handlers=None, chunk_size=65536,
+                 sleep_time=0.5, max_staleness=60, refresh_interval=15,
+                 books=None, queue_size=1000, executors=4, order_threads=4,
+                 public_client=None, metrics=None, event_log=None,
+                 accounts=None, seen=None, order_retries=3,
+                 track_fills=True, fill_timeout=10, user_feed=None,
+                 recorder=None, match_processes=0):
+        if metrics is None:
+            metrics = Metrics()
+        # Matches and orders are logged by a background writer
+        if event_log is None:
+            event_log = EventLog()
+        event_log.start()
+        super(TradeListener, self).__init__(
+                app_key, app_secret, oauth_token, oauth_token_secret,
+                stall_timeout=stall_timeout, connect_timeout=connect_timeout,
+                rate_limit_cap=rate_limit_cap, client_args=client_args,
+                handlers=handlers, chunk_size=chunk_size, metrics=metrics,
+                event_log=event_log
+            )
+        # Live order books; public client is fallback if they aren't synced
+        if public_client is None:
+            public_client = gdax.PublicClient()
+        traders = []
+        for name, account_rules, account_client in (
+                accounts or [(None, rules, gdax_client)]
+            ):
+            # Amounts available to trade are cached and kept current locally
+            balances = BalanceCache(account_client,
+                                    max_staleness=max_staleness,
+                                    refresh_interval=refresh_interval,
+                                    metrics=self.metrics,
+                                    event_log=event_log, name=name)
+            balances.start()
+            tracker = None
+            if track_fills:
+                # Fills are credited as they happen
+                tracker = OrderTracker(account_client, balances,
+                                       event_log=event_log,
+                                       metrics=self.metrics, name=name)
+                tracker.start()
+                if user_feed:
+                    UserFeed(tracker, account_client.auth, set(
+                            order['static']['product_id']
+                            for rule in account_rules
+                            for order in rule['orders']
+                        ), url=user_feed).start()
+            traders.append(Trader(account_rules, account_client, balances,
+                                  public_client, books=books,
+                                  sleep_time=sleep_time,
+                                  order_threads=order_threads,
+                                  event_log=event_log,
+                                  metrics=self.metrics, name=name,
+                                  order_retries=order_retries,
+                                  tracker=tracker,
+                                  fill_timeout=fill_timeout,
+                                  recorder=recorder))
+        if accounts:
+            # One stream and one matching pass for every account
+            self.trader = AccountRouter(traders, executors=executors,
+                                        queue_size=queue_size,
+                                        event_log=event_log,
+                                        metrics=self.metrics)
+            self.trader.start()
+        else:
+            self.trader = traders[0]
+        # Matching and order placement happen off the stream's thread
+        self.pipeline = Pipeline(self.trader, queue_size=queue_size,
+                                 executors=executors, metrics=self.metrics,
+                                 seen=seen)
+        self.pipeline.start()
+        self.match_pool = None
+        if match_processes:
+            # Statuses are decoded and matched in other processes
+            self.match_pool = MatchPool(match_processes, self._pool_matched,
+                                        event_log=event_log,
+                                        metrics=self.metrics)
+            self.match_pool.start()
+        # Records every message from the stream, if anything does
+        self.recorder = recorder
+        # Raw statuses are turned away unless they contain one of these
+        self.author_patterns = None
+        # Tuple (user IDs to follow, keywords to track) of the stream filter
+        self.filter_params = None
+        # Set when the filter must be reissued with new filter_params
+        self.refilter = threading.Event()
+        # StreamManager reading the stream for this listener over several
+        # connections, or None if it reads the stream itself
+        self.streams = None
+
+    def use_rules(self, rules, handles_to_user_ids):
+        """ Swaps in rules, reconnecting to Twitter only if they follow or
+            track something different.
+
+            rules: list of compiled rules; when trading for several
+                accounts, from AccountRouter.combined_rules()
+            handles_to_user_ids: dictionary mapping lowercase handle to
+                user ID string, covering handles of rules
+
+            Return value: True iff the stream filter has to be reissued
+        """
+        follow, track = set(), set()
+        for rule in rules:
+            follow.update(handles_to_user_ids[handle]
+                          for handle in rule['handles']
+                          if handle in handles_to_user_ids)
+            track.update(rule['keywords'])
+        if self.streams is not None:
+            # Rules too big for every connection together aren't swapped in
+            self.streams.connections_needed(len(follow), len(track))
+        self.trader.add_user_ids(handles_to_user_ids)
+        self.trader.set_rules(rules)
+        if self.match_pool is not None:
+            # Indexes from workers are into the combined rules
+            self.match_pool.set_rules(self.trader.rule_index.rules,
+                                      handles_to_user_ids)
+        user_ids = self.trader.rule_index.user_ids()
+        if user_ids is not None and len(user_ids) <= max_author_patterns:
+            self.author_patterns = author_patterns(user_ids)
+        else:
+            self.author_patterns = None
+        filter_params = (sorted(follow), sorted(track))
+        if filter_params == self.filter_params:
+            return False
+        refilter = self.filter_params is not None
+        self.filter_params = filter_params
+        if self.streams is not None:
+            # Only connections whose share changed reconnect
+            return self.streams.set_filter(*filter_params)
+        if refilter:
+            # Stream loop sees refilter and reconnects without waiting
+            self.refilter.set()
+            self.trader.event_log.log('stream_refilter',
+                                      follow=filter_params[0],
+                                      track=filter_params[1])
+            self.disconnect()
+        return refilter
+
+    def on_message(self, message):
+        if self.recorder is not None:
+            self.recorder.record_message(message)
+
+    def admits(self, message):
+        """ Turns away statuses by authors no rule applies to before
+            they're decoded, and hands the rest to worker processes if
+            there are any. A followed author's ID is somewhere in the raw
+            status, so this never turns away one that could match.
+
+            message: message from the stream as a byte string
+
+            Return value: True iff message should be decoded here
+        """
+        if not message.startswith(status_prefix):
+            # Notices are always handled
+            return True
+        patterns = self.author_patterns
+        if patterns is not None and not any(pattern in message
+                                            for pattern in patterns):
+            self.metrics.increment('statuses_rejected_raw')
+            return False
+        if self.match_pool is not None:
+            # Decoded and matched in a worker process, in order
+            self.match_pool.submit(message)
+            return False
+        return True
+
+    def _pool_matched(self, message, candidates):
+        """ Queues a status a worker process found rules for. """
+        self.pipeline.submit(loads(message), candidates)
+
+    def on_success(self, status):
+        self.pipeline.submit(status)
@@ -0,0 +1,190 @@
+"""
+vickitrix.matching
+
+Indexes compiled rules by handle and keyword so each status is checked
+against only the rules that could apply to it.
+"""
+from collections import deque
+
+class KeywordAutomaton(object):
+    """ Aho-Corasick automaton finding every keyword contained in a text.
+
+        A text is scanned once no matter how many keywords there are, so
+        matching costs O(length of text + number of matches) rather than
+        O(number of keywords * length of text).
+    """
+
+    def __init__(self, keywords):
+        """
+            keywords: iterable of keywords; they should already be lowercase
+                if matching is to be case-insensitive
+        """
+        # Node 0 is the root; each node has transitions, a failure link, and
+        # the set of keywords ending there
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [frozenset()]
+        outputs = [set()]
+        for keyword in keywords:
+            if not keyword:
+                continue
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append(set())
+                node = next_node
+            outputs[node].add(keyword)
+        # Breadth-first pass sets failure links and merges outputs, so the
+        # output of a node includes keywords that are suffixes of its path
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_node] = fail
+                outputs[next_node].update(outputs[fail])
+        self._output = [frozenset(output) for output in outputs]
+
+    def search(self, text):
+        """ Finds keywords contained in text.
+
+            text: text to search
+
+            Return value: set of keywords found in text
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+class RuleIndex(object):
+    """ Finds rules that apply to a status by handle and keyword.
+
+        A rule applies to a status if its "handles" list is empty or contains
+        the status's author, and its "keywords" list is empty or has a
+        keyword found in the lowercased status text. The rule's condition is
+        left to the caller.
+
+        Authors are matched by user ID once handles' IDs are known, and by
+        lowercased screen name only while some handle's ID isn't.
+    """
+
+    def __init__(self, rules):
+        """
+            rules: list of compiled rules from compile_rules(), whose handles
+                and keywords are lowercase
+        """
+        self.rules = rules
+        self._by_handle, self._by_user_id, self._by_keyword = {}, {}, {}
+        self._any_handle, self._any_keyword = set(), set()
+        for i, rule in enumerate(rules):
+            if rule['handles']:
+                for handle in rule['handles']:
+                    self._by_handle.setdefault(handle, set()).add(i)
+            else:
+                self._any_handle.add(i)
+            if rule['keywords']:
+                for keyword in rule['keywords']:
+                    self._by_keyword.setdefault(keyword, set()).add(i)
+            else:
+                self._any_keyword.add(i)
+        self._automaton = KeywordAutomaton(self._by_keyword)
+        self.handles = set(self._by_handle)
+        self.keywords = set(self._by_keyword)
+        self._unresolved = set(self._by_handle)
+
+    def add_user_ids(self, handles_to_user_ids):
+        """ Lets statuses be matched to handles by user ID.
+
+            handles_to_user_ids: dictionary mapping lowercase handle to
+                user ID string
+
+            No return value.
+        """
+        for handle, user_id in handles_to_user_ids.items():
+            if handle in self._by_handle:
+                self._by_user_id[user_id] = self._by_handle[handle]
+                self._unresolved.discard(handle)
+
+    def _handle_candidates(self, user):
+        """ Gets indexes of rules whose handles admit a status's author.
+
+            user: "user" dictionary from status
+
+            Return value: set of rule indexes
+        """
+        rule_indexes = self._by_user_id.get(user.get('id_str'))
+        if rule_indexes is None and self._unresolved:
+            handle = user.get('screen_name', '').lower()
+            if handle in self._unresolved:
+                rule_indexes = self._by_handle[handle]
+        if rule_indexes is None:
+            return self._any_handle
+        return self._any_handle | rule_indexes
+
+    def user_ids(self):
+        """ Gets user IDs of every author some rule could apply to.
+
+            Return value: frozenset of user ID strings, or None if a rule
+                applies to any author or some handle's ID isn't known
+        """
+        if self._any_handle or self._unresolved:
+            return None
+        return frozenset(self._by_user_id)
+
+    def admits(self, status):
+        """ Checks cheaply whether the author of a status is one some rule
+            could apply to, before its text is searched.
+
+            status: status dictionary from Twitter
+
+            Return value: False iff no rule can apply to status
+        """
+        if 'text' not in status:
+            return False
+        if 'user' in status:
+            return bool(self._handle_candidates(status['user']))
+        return bool(self._any_handle)
+
+    def match(self, status):
+        """ Finds rules whose handles and keywords apply to a status.
+
+            status: status dictionary from Twitter
+
+            Return value: list of compiled rules in the order in which they
+                appear in the rules file
+        """
+        if 'text' not in status:
+            # Not a status; could be a delete or limit notice
+            return []
+        if 'user' in status:
+            candidates = self._handle_candidates(status['user'])
+        else:
+            candidates = self._any_handle
+        if not candidates:
+            return []
+        if candidates <= self._any_keyword:
+            # Keywords can't rule anything out
+            rule_indexes = candidates
+        else:
+            rule_indexes = candidates & self._any_keyword
+            for keyword in self._automaton.search(status['text'].lower()):
+                rule_indexes = rule_indexes | (
+                        candidates & self._by_keyword[keyword]
+                    )
+        return [self.rules[i] for i in sorted(rule_indexes)]
@@ -0,0 +1,323 @@
+"""
+vickitrix.matchpool
+
+Matches statuses against rules in worker processes, so decoding and
+matching a busy stream can use more than one core.
+
+The stream is read in one process, which hands each raw status to one of
+the workers in turn as the bytes it arrived as, prefixed with a sequence
+number; nothing is pickled per status. A worker decodes the status,
+turns it away if it's a retweet, a reply, or by an author no rule
+follows, and sends back the indexes of rules whose handles and keywords
+apply. Workers are handed statuses rather than rules because keyword
+matching scans a status once however many keywords there are: every
+worker holding a share of the rules would still have to decode and scan
+every status, so only spreading statuses spreads the work.
+
+Results are released in the order statuses arrived. Statuses that match
+are decoded again in the reading process and queued with their matched
+rules, so conditions are evaluated and orders placed against the one
+copy of each account's balances. Statuses a worker took but never
+answered because it exited, and statuses no worker could take, are
+matched in the reading process, still in order.
+"""
+import pickle
+import struct
+import threading
+from array import array
+from multiprocessing import Pipe, Process
+from traceback import format_exc
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+from .eventlog import EventLog
+from .metrics import Metrics
+
+_sequence = struct.Struct('!Q')
+
+def _rule_index(rules, user_ids):
+    """ Indexes rules by handle and keyword for matching raw statuses.
+
+        rules: list of tuples (handles, keywords), one per rule
+        user_ids: dictionary mapping lowercase handle to user ID string
+
+        Return value: instance of RuleIndex whose rules have their indexes
+            under the key "index"
+    """
+    # Imported here so workers load only what they use
+    from .matching import RuleIndex
+    rule_index = RuleIndex([{'handles' : handles,
+                             'keywords' : keywords,
+                             'index' : i}
+                            for i, (handles, keywords) in enumerate(rules)])
+    rule_index.add_user_ids(user_ids)
+    return rule_index
+
+def _match(rule_index, raw_status):
+    """ Finds indexes of rules whose handles and keywords apply to a raw
+        status.
+
+        rule_index: RuleIndex from _rule_index()
+        raw_status: status from the stream as a byte string
+
+        Return value: array of rule indexes
+    """
+    from .stream import loads
+    from .trader import is_retweet_or_reply
+    indexes = array('I')
+    try:
+        status = loads(raw_status)
+    except ValueError:
+        status = None
+    if isinstance(status, dict) and rule_index.admits(status) and (
+            not is_retweet_or_reply(status)
+        ):
+        indexes.extend(rule['index'] for rule in rule_index.match(status))
+    return indexes
+
+def _work(inbox, outbox):
+    """ Worker loop: matches statuses from inbox, sending indexes of rules
+        that apply to outbox, until told to quit.
+
+        inbox: Connection from which statuses and rules are received
+        outbox: Connection to which results are sent
+
+        No return value.
+    """
+    rule_index = _rule_index([], {})
+    while True:
+        try:
+            message = inbox.recv_bytes()
+        except (EOFError, IOError):
+            return
+        if message == b'Q':
+            return
+        if message[:1] == b'R':
+            # Rules: list of tuples (handles, keywords) and user IDs
+            rule_index = _rule_index(*pickle.loads(message[1:]))
+            continue
+        indexes = _match(rule_index, message[1 + _sequence.size:])
+        outbox.send_bytes(message[1:1 + _sequence.size] + (
+                indexes.tobytes() if hasattr(indexes, 'tobytes')
+                # Python 2
+                else indexes.tostring()
+            ))
+
+class MatchPool(object):
+    """ Worker processes finding rules whose handles and keywords apply to
+        raw statuses. """
+
+    def __init__(self, processes, on_match, event_log=None, metrics=None):
+        """
+            processes: number of worker processes
+            on_match: function called with a raw status and the list of
+                compiled rules whose handles and keywords apply to it, for
+                statuses some rule applies to, in the order in which they
+                were submitted
+            event_log: instance of EventLog to which workers' exits are
+                logged, or None to log nothing
+            metrics: instance of Metrics in which to record match
+                latencies, or None for a private registry
+        """
+        self.processes = processes
+        self.on_match = on_match
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._lock = threading.Lock()
+        # Held while handing workers statuses and rules, so each worker
+        # gets them in the order they're registered; never taken while
+        # _lock is held, so results are collected while a send blocks
+        self._send_lock = threading.Lock()
+        # Held while results are handed to on_match, so they stay in order
+        self._release_lock = threading.Lock()
+        self._collectors = []
+        self._alive = []
+        self._rules = []
+        self._rules_message = None
+        # What workers build their RuleIndex from: tuple (list of tuples
+        # (handles, keywords), user IDs)
+        self._rule_spec = ([], {})
+        # RuleIndex matching statuses here when no worker can, or None
+        # until one's needed
+        self._local_index = None
+        self._next_sequence = 0
+        self._next_release = 0
+        # Sequence number mapped to list [status, rules, worker, submitted
+        # at, indexes or None until the worker answers]
+        self._pending = {}
+        self.metrics.gauge('match_pool_pending', lambda: len(self._pending))
+
+    def set_rules(self, rules, handles_to_user_ids):
+        """ Hands workers new rules; statuses submitted from now on are
+            matched against them.
+
+            rules: list of compiled rules, as in a RuleIndex
+            handles_to_user_ids: dictionary mapping lowercase handle to
+                user ID string
+
+            No return value.
+        """
+        rule_spec = ([(rule['handles'], rule['keywords']) for rule in rules],
+                     dict(handles_to_user_ids))
+        message = b'R' + pickle.dumps(rule_spec, 2)
+        with self._send_lock:
+            with self._lock:
+                self._rules = rules
+                self._rules_message = message
+                self._rule_spec = rule_spec
+                self._local_index = None
+                alive = list(self._alive)
+            for worker in alive:
+                try:
+                    worker[1].send_bytes(message)
+                except (IOError, OSError):
+                    # Exited; its collector cleans up
+                    pass
+
+    def _match_here(self, entry):
+        """ Matches a pending status in this process, with the rules it
+            was submitted under; call with lock held. """
+        if entry[1] is not self._rules:
+            # Rules changed since; it's rare enough not to cache
+            entry[4] = _match(_rule_index(
+                    [(rule['handles'], rule['keywords'])
+                     for rule in entry[1]], self._rule_spec[1]
+                ), entry[0])
+            return
+        if self._local_index is None:
+            self._local_index = _rule_index(*self._rule_spec)
+        entry[4] = _match(self._local_index, entry[0])
+
+    def submit(self, message):
+        """ Hands a raw status to the next worker, or matches it here if
+            no worker can take it; either way, on_match gets it in order.
+
+            message: status from the stream as a byte string
+
+            No return value.
+        """
+        with self._send_lock:
+            with self._lock:
+                sequence = self._next_sequence
+                self._next_sequence += 1
+                worker = (self._alive[sequence % len(self._alive)]
+                          if self._alive else None)
+                entry = [message, self._rules, worker, monotonic(), None]
+                self._pending[sequence] = entry
+                if worker is None:
+                    self._match_here(entry)
+            if worker is not None:
+                try:
+                    worker[1].send_bytes(b'S' + _sequence.pack(sequence)
+                                         + message)
+                    return
+                except (IOError, OSError):
+                    # The worker exited; its collector may have handled
+                    # its pending statuses already
+                    with self._lock:
+                        if entry[4] is None:
+                            self._match_here(entry)
+        self._release()
+
+    def _release(self):
+        """ Hands answered statuses to on_match in the order submitted. """
+        with self._release_lock:
+            while True:
+                with self._lock:
+                    entry = self._pending.get(self._next_release)
+                    if entry is None or entry[4] is None:
+                        return
+                    del self._pending[self._next_release]
+                    self._next_release += 1
+                message, rules, _, submitted_at, indexes = entry
+                self.metrics.observe('match_pool_seconds',
+                                     monotonic() - submitted_at)
+                if indexes:
+                    try:
+                        self.on_match(message, [rules[i] for i in indexes])
+                    except Exception:
+                        self.event_log.log('error', traceback=format_exc())
+
+    def _collect(self, worker):
+        """ Receives a worker's results until it exits. """
+        outbox = worker[2]
+        while True:
+            try:
+                result = outbox.recv_bytes()
+            except (EOFError, IOError):
+                break
+            sequence, = _sequence.unpack(result[:_sequence.size])
+            indexes = array('I')
+            if hasattr(indexes, 'frombytes'):
+                indexes.frombytes(result[_sequence.size:])
+            else:
+                # Python 2
+                indexes.fromstring(result[_sequence.size:])
+            with self._lock:
+                self._pending[sequence][4] = indexes
+            self._release()
+        with self._lock:
+            if worker not in self._alive:
+                # Stopped
+                return
+            self._alive.remove(worker)
+            # Statuses it never answered are matched here instead
+            rematched = 0
+            for entry in self._pending.values():
+                if entry[2] is worker and entry[4] is None:
+                    self._match_here(entry)
+                    rematched += 1
+        self.metrics.increment('match_pool_rematched', rematched)
+        self.event_log.log('error', traceback=''.join([
+                'Match worker ', str(worker[0].pid), ' exited; ',
+                str(len(self._alive)), ' left. Matched the ',
+                str(rematched), ' status(es) it hadn\'t answered in the ',
+                'main process.'
+            ]))
+        self._release()
+
+    def start(self):
+        """ Starts worker processes and threads collecting their results. """
+        for _ in range(self.processes):
+            inbox, to_worker = Pipe(duplex=False)
+            from_worker, outbox = Pipe(duplex=False)
+            process = Process(target=_work, args=(inbox, outbox))
+            process.daemon = True
+            process.start()
+            # The worker's ends belong to the worker now
+            inbox.close()
+            outbox.close()
+            worker = (process, to_worker, from_worker)
+            if self._rules_message is not None:
+                to_worker.send_bytes(self._rules_message)
+            self._alive.append(worker)
+            collector = threading.Thread(target=self._collect,
+                                         args=(worker,))
+            collector.daemon = True
+            collector.start()
+            self._collectors.append(collector)
+
+    def stop(self):
+        """ Stops worker processes once they've matched what they were
+            handed. """
+        with self._send_lock:
+            with self._lock:
+                alive, self._alive = self._alive, []
+            for _, to_worker, _ in alive:
+                # Closing isn't enough: workers forked later hold copies of
+                # earlier workers' pipes
+                try:
+                    to_worker.send_bytes(b'Q')
+                except (IOError, OSError):
+                    pass
+                to_worker.close()
+        for process, _, _ in alive:
+            process.join()
+        for collector in self._collectors:
+            collector.join()
+        self._release()
@@ -0,0 +1,339 @@
+"""
+vickitrix.metrics
+
+Counters, gauges, and latency histograms for the tweet-to-order path,
+with pluggable sinks: a Prometheus text endpoint, a StatsD-style UDP
+sink, and an in-memory sink that stands in for either locally.
+
+Every status gets a Trace when it arrives from the stream. Stages it
+passes through (rule match, condition evaluation, balance and order book
+reads, order submission, order acknowledgment) are marked with a
+monotonic clock, and the time from receipt to each stage is recorded in
+the histogram "stage_seconds" labeled by stage.
+"""
+import socket
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds (in s) of histogram buckets; an order's life is ms to s
+_default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram(object):
+    """ Counts of observations in fixed buckets, with their sum. """
+
+    def __init__(self, buckets=_default_buckets):
+        self.buckets = buckets
+        # Last count is for observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """ Estimates a quantile as the upper bound of its bucket.
+
+            fraction: quantile between 0 and 1
+
+            Return value: bucket upper bound, inf if above every bucket, or
+                None if there are no observations
+        """
+        if not self.count:
+            return None
+        rank, seen = fraction * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+class Metrics(object):
+    """ Registry of counters, gauges, and histograms.
+
+        Names are given without the "vickitrix_" prefix, which sinks add.
+    """
+
+    def __init__(self, buckets=_default_buckets):
+        """
+            buckets: upper bounds (in s) of histogram buckets
+        """
+        self.buckets = buckets
+        # Buckets of histograms that don't use the default ones, by name
+        self._named_buckets = {}
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def add_sink(self, sink):
+        """ Sends every future increment and observation to a sink.
+
+            sink: object with increment(name, value, labels) and
+                observe(name, value, labels) methods
+
+            No return value.
+        """
+        self.sinks.append(sink)
+
+    def increment(self, name, value=1, **labels):
+        """ Adds value to a counter. """
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.increment(name, value, labels)
+
+    def set_buckets(self, name, buckets):
+        """ Sets buckets of histograms by the name of name, for values
+            the default buckets don't fit; call before any are observed.
+
+            name: histogram name
+            buckets: upper bounds (in s) of histogram buckets
+
+            No return value.
+        """
+        with self._lock:
+            self._named_buckets[name] = buckets
+
+    def observe(self, name, value, **labels):
+        """ Records a value (in s) in a histogram. """
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(
+                        self._named_buckets.get(name, self.buckets)
+                    )
+            histogram.observe(value)
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    def gauge(self, name, function, **labels):
+        """ Registers a gauge read whenever metrics are collected.
+
+            name: gauge name
+            function: function of no arguments returning gauge's value
+
+            No return value.
+        """
+        with self._lock:
+            self._gauges[_key(name, labels)] = function
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Records how long the body of a with statement takes. """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def counter(self, name, **labels):
+        """ Gets a counter's value. """
+        return self._counters.get(_key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        """ Gets a histogram, or None if nothing has been observed. """
+        return self._histograms.get(_key(name, labels))
+
+    def collect(self):
+        """ Gets current values of every metric.
+
+            Return value: tuple (counters, gauges, histograms), each a list
+                of tuples (name, labels tuple, value), where values of
+                histograms are copies of Histogram instances
+        """
+        with self._lock:
+            counters = sorted(
+                    (name, labels, value) for (name, labels), value
+                    in self._counters.items()
+                )
+            gauges = sorted(self._gauges.items())
+            histograms = []
+            for (name, labels), histogram in sorted(
+                    self._histograms.items(), key=lambda item: item[0]
+                ):
+                copied = Histogram(histogram.buckets)
+                copied.counts = list(histogram.counts)
+                copied.sum, copied.count = histogram.sum, histogram.count
+                histograms.append((name, labels, copied))
+        gauges = [(name, labels, function())
+                  for (name, labels), function in gauges]
+        return counters, gauges, histograms
+
+class Trace(object):
+    """ Times one status's trip from the stream to GDAX. """
+
+    __slots__ = ['metrics', 'start']
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = monotonic()
+
+    def mark(self, stage):
+        """ Records the time from receipt to a stage. """
+        self.metrics.observe('stage_seconds', monotonic() - self.start,
+                             stage=stage)
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+            '{}="{}"'.format(name, str(value).replace('"', '\\"'))
+            for name, value in labels
+        ) + '}'
+
+def render_prometheus(metrics, prefix='vickitrix_'):
+    """ Renders metrics in the Prometheus text exposition format.
+
+        metrics: instance of Metrics
+        prefix: prefix for metric names
+
+        Return value: text
+    """
+    counters, gauges, histograms = metrics.collect()
+    lines, typed = [], set()
+    def declare(name, metric_type):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+    for name, labels, value in counters:
+        declare(prefix + name + '_total', 'counter')
+        lines.append('{}{} {}'.format(prefix + name + '_total',
+                                      _format_labels(labels), value))
+    for name, labels, value in gauges:
+        declare(prefix + name, 'gauge')
+        lines.append('{}{} {}'.format(prefix + name,
+                                      _format_labels(labels), value))
+    for name, labels, histogram in histograms:
+        full_name = prefix + name
+        declare(full_name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                    full_name,
+                    _format_labels(labels, [('le', repr(float(bound)))]),
+                    cumulative
+                ))
+        lines.append('{}_bucket{} {}'.format(
+                full_name, _format_labels(labels, [('le', '+Inf')]),
+                histogram.count
+            ))
+        lines.append('{}_sum{} {}'.format(full_name, _format_labels(labels),
+                                          histogram.sum))
+        lines.append('{}_count{} {}'.format(full_name, _format_labels(labels),
+                                            histogram.count))
+    return '\n'.join(lines) + '\n'
+
+class PrometheusSink(object):
+    """ Serves metrics in the Prometheus text format over HTTP. """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        """
+            metrics: instance of Metrics
+            port: port on which to serve /metrics
+            host: address on which to listen
+        """
+        self.metrics = metrics
+        sink = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = render_prometheus(sink.metrics).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = HTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    # Scrapes read the registry, so nothing happens per event
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+class StatsdSink(object):
+    """ Sends counters and timings as StatsD UDP datagrams.
+
+        Labels become dot-separated name components, so the histogram
+        stage_seconds with stage="ack" is sent as the timing
+        "vickitrix.stage_seconds.ack" in ms.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='vickitrix'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _name(self, name, labels):
+        return '.'.join([self.prefix, name] + [
+                str(value).replace('.', '_').replace(':', '_')
+                for _, value in sorted(labels.items())
+            ])
+
+    def _send(self, datagram):
+        try:
+            self._socket.sendto(datagram.encode('utf-8'), self.address)
+        except (socket.error, OSError):
+            # Metrics are best effort; never hold up trading for them
+            pass
+
+    def increment(self, name, value, labels):
+        self._send('{}:{}|c'.format(self._name(name, labels), value))
+
+    def observe(self, name, value, labels):
+        self._send('{}:{:.3f}|ms'.format(self._name(name, labels),
+                                         value * 1000))
+
+class MemorySink(object):
+    """ Keeps every increment and observation in memory; stands in for a
+        metrics backend when trying things out locally. """
+
+    def __init__(self):
+        self.events = []
+
+    def increment(self, name, value, labels):
+        self.events.append(('increment', name, value, labels))
+
+    def observe(self, name, value, labels):
+        self.events.append(('observe', name, value, labels))
@@ -0,0 +1,366 @@
+"""
+vickitrix.orders
+
+Follows orders vickitrix places until they're done.
+
+Fills come from the authenticated "user" channel of the GDAX websocket
+feed as they happen. While the feed is down, or for products it isn't
+subscribed to, open orders are polled instead, starting right after they
+are placed and backing off the longer they stay open. Fills are credited
+to the account's BalanceCache as they arrive, and a rule's later orders
+for a product wait until the earlier order is done, with all it filled
+credited, rather than on a fixed sleep.
+"""
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+from .book import WebsocketFeed, gdax_feed_url
+from .eventlog import EventLog
+from .metrics import Metrics
+
+class TrackedOrder(object):
+    """ What's known of an order placed on GDAX. """
+
+    def __init__(self, order_id, order, trace=None):
+        """
+            order_id: GDAX order ID
+            order: dictionary of order parameters passed to GDAX
+            trace: Trace of status order was placed for, or None
+        """
+        self.order_id = order_id
+        self.order = order
+        self.trace = trace
+        self.status = 'pending'
+        self.done_reason = None
+        # Cumulative, as GDAX reports them
+        self.filled_size = 0.0
+        self.executed_value = 0.0
+        self.fees = 0.0
+        self.placed_at = monotonic()
+        # Set on first fill, for latency metrics, and once done
+        self.filled = threading.Event()
+        self.done = threading.Event()
+        self._poll_interval = None
+        self._next_poll = None
+
+    def wait(self, timeout=None):
+        """ Waits for the order to be done, so every fill is credited.
+
+            timeout: most time (in s) to wait, or None to wait forever
+
+            Return value: True iff the order was done in time
+        """
+        return self.done.wait(timeout)
+
+class OrderTracker(object):
+    """ Tracks orders of one GDAX account and credits their fills. """
+
+    def __init__(self, gdax_client, balances, event_log=None, metrics=None,
+                 name=None, poll_interval=0.05, max_poll_interval=2,
+                 feed_grace=30, early_capacity=1000):
+        """
+            gdax_client: instance of gdax.AuthenticatedClient
+            balances: instance of BalanceCache for gdax_client
+            event_log: instance of EventLog to which fills are logged, or
+                None to log nothing
+            metrics: instance of Metrics in which to record fill
+                latencies, or None for a private registry
+            name: name of account, added to events and metrics, or None
+            poll_interval: time (in s) after an order is placed before
+                it's first polled; doubles with each poll
+            max_poll_interval: longest time (in s) between polls
+            feed_grace: time (in s) after which orders still open are
+                polled even though the feed is up, in case it missed
+                something
+            early_capacity: most feed messages kept for orders whose
+                placement hasn't been acknowledged yet
+        """
+        self.gdax_client = gdax_client
+        self.balances = balances
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.name = name
+        self._labels = {'account' : name} if name is not None else {}
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.feed_grace = feed_grace
+        self.early_capacity = early_capacity
+        # Products whose fills the feed is delivering now
+        self.feed_products = frozenset()
+        self._lock = threading.RLock()
+        self._open = {}
+        # Feed messages that beat the response to an order, by order ID
+        self._early = OrderedDict()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.metrics.gauge('orders_open', lambda: len(self._open),
+                           **self._labels)
+
+    def _log(self, event, **fields):
+        if self.name is not None:
+            fields['account'] = self.name
+        self.event_log.log(event, **fields)
+
+    def _schedule(self, tracked, now):
+        """ Sets when an order is next polled; call with lock held. """
+        if tracked.order['product_id'] in self.feed_products and (
+                now < tracked.placed_at + self.feed_grace
+            ):
+            tracked._next_poll = tracked.placed_at + self.feed_grace
+            return
+        # Past the grace period, polls back off as they would without
+        # the feed
+        if tracked._poll_interval is None:
+            tracked._poll_interval = self.poll_interval
+        else:
+            tracked._poll_interval = min(tracked._poll_interval * 2,
+                                         self.max_poll_interval)
+        tracked._next_poll = now + tracked._poll_interval
+
+    def track(self, response, order, trace=None):
+        """ Starts tracking an order GDAX accepted.
+
+            response: GDAX's response to the order
+            order: dictionary of order parameters passed to GDAX
+            trace: Trace of status order was placed for, or None
+
+            Return value: instance of TrackedOrder
+        """
+        tracked = TrackedOrder(response['id'], order, trace)
+        with self._lock:
+            self._open[tracked.order_id] = tracked
+            self._schedule(tracked, tracked.placed_at)
+            early = self._early.pop(tracked.order_id, [])
+        # The order's first report may say it's filled already
+        self._update(tracked, response)
+        for message in early:
+            self.apply_message(message)
+        self._wakeup.set()
+        return tracked
+
+    def _fill(self, tracked, size, value, fees):
+        """ Credits a fill; call with lock held. """
+        if size <= 0:
+            return
+        tracked.filled_size += size
+        tracked.executed_value += value
+        tracked.fees += fees
+        self.balances.apply_fill(tracked.order_id, size, value / size, fees)
+        self._log('fill', order_id=tracked.order_id,
+                  product_id=tracked.order['product_id'], size=size,
+                  price=value / size, fees=fees)
+        if not tracked.filled.is_set():
+            self.metrics.observe('fill_seconds',
+                                 monotonic() - tracked.placed_at,
+                                 side=tracked.order['side'], **self._labels)
+            if tracked.trace is not None:
+                tracked.trace.mark('fill')
+            tracked.filled.set()
+
+    def _finish(self, tracked, reason):
+        """ Marks an order done; call with lock held. """
+        if tracked.done.is_set():
+            return
+        tracked.status = 'done'
+        tracked.done_reason = reason
+        self._open.pop(tracked.order_id, None)
+        self.balances.apply_done(tracked.order_id)
+        self.metrics.increment('orders_done', reason=str(reason),
+                               **self._labels)
+        self._log('order_done', order_id=tracked.order_id, reason=reason,
+                  filled_size=tracked.filled_size)
+        tracked.done.set()
+        # Whoever's waiting on a fill that won't come can stop
+        tracked.filled.set()
+
+    def _update(self, tracked, report):
+        """ Applies an order's report from GDAX's REST API.
+
+            tracked: instance of TrackedOrder
+            report: order dictionary from GDAX
+
+            No return value.
+        """
+        with self._lock:
+            if 'id' not in report:
+                if 'notfound' in str(report.get('message', '')).lower():
+                    # Canceled before anything filled
+                    self._finish(tracked, 'canceled')
+                return
+            # Reports are cumulative; credit only what's new
+            size = float(report.get('filled_size') or 0)
+            value = float(report.get('executed_value') or 0)
+            fees = float(report.get('fill_fees') or 0)
+            self._fill(tracked, size - tracked.filled_size,
+                       value - tracked.executed_value, fees - tracked.fees)
+            if report.get('status') in ['done', 'settled']:
+                self._finish(tracked, report.get('done_reason'))
+            elif report.get('status'):
+                tracked.status = report['status']
+
+    def apply_message(self, message):
+        """ Applies a message from the "user" channel of the feed.
+
+            message: message dictionary
+
+            No return value.
+        """
+        kind = message.get('type')
+        if kind == 'match':
+            order_ids = [message.get('taker_order_id'),
+                         message.get('maker_order_id')]
+        elif kind in ['open', 'done']:
+            order_ids = [message.get('order_id')]
+        else:
+            return
+        with self._lock:
+            for order_id in order_ids:
+                tracked = self._open.get(order_id)
+                if tracked is not None:
+                    break
+            else:
+                # Maybe the order's response hasn't been seen yet
+                for order_id in order_ids:
+                    if order_id is not None:
+                        self._early.setdefault(order_id, []).append(message)
+                while len(self._early) > self.early_capacity:
+                    self._early.popitem(last=False)
+                return
+            if kind == 'match':
+                size = float(message['size'])
+                value = size * float(message['price'])
+                taker = order_id == message.get('taker_order_id')
+                fee_rate = message.get(
+                        'taker_fee_rate' if taker else 'maker_fee_rate'
+                    )
+                self._fill(tracked, size, value,
+                           value * float(fee_rate) if fee_rate else 0.0)
+            elif kind == 'open':
+                tracked.status = 'open'
+            else:
+                self._finish(tracked, message.get('reason'))
+
+    def set_feed_products(self, product_ids):
+        """ Records which products' fills the feed is delivering.
+
+            product_ids: iterable of product IDs; empty when the feed is
+                down, so open orders are polled
+
+            No return value.
+        """
+        with self._lock:
+            self.feed_products = frozenset(product_ids)
+            now = monotonic()
+            for tracked in self._open.values():
+                tracked._poll_interval = None
+                self._schedule(tracked, now)
+        self._wakeup.set()
+
+    def poll(self):
+        """ Polls open orders that are due.
+
+            Return value: time (in s) until the next poll is due, or None
+        """
+        now = monotonic()
+        with self._lock:
+            due = [tracked for tracked in self._open.values()
+                   if tracked._next_poll <= now]
+        for tracked in due:
+            try:
+                report = self.gdax_client.get_order(tracked.order_id)
+            except Exception:
+                report = None
+            if isinstance(report, dict):
+                self._update(tracked, report)
+            with self._lock:
+                self._schedule(tracked, monotonic())
+        with self._lock:
+            if not self._open:
+                return None
+            return max(min(tracked._next_poll
+                           for tracked in self._open.values())
+                       - monotonic(), 0)
+
+    def _run(self):
+        while not self._stopped:
+            wait = self.poll()
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def start(self):
+        """ Starts polling in the background. """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+class UserFeed(WebsocketFeed):
+    """ Background connection to the "user" channel of the GDAX websocket
+        feed, reporting an account's fills to its OrderTracker. """
+
+    def __init__(self, tracker, auth, product_ids, url=gdax_feed_url,
+                 reconnect_wait=1, max_reconnect_wait=60, recv_timeout=10):
+        """
+            tracker: instance of OrderTracker
+            auth: GDAX credentials as the "auth" attribute of
+                gdax.AuthenticatedClient
+            product_ids: products whose orders are tracked
+            url, reconnect_wait, max_reconnect_wait, recv_timeout: see
+                WebsocketFeed
+        """
+        super(UserFeed, self).__init__(
+                url=url, reconnect_wait=reconnect_wait,
+                max_reconnect_wait=max_reconnect_wait,
+                recv_timeout=recv_timeout
+            )
+        self.tracker = tracker
+        self.auth = auth
+        self.product_ids = sorted(product_ids)
+
+    def _subscription(self):
+        """ Gets a signed subscribe message. """
+        timestamp = str(time.time())
+        signature = hmac.new(
+                base64.b64decode(self.auth.secret_key),
+                (timestamp + 'GET/users/self/verify').encode('ascii'),
+                hashlib.sha256
+            )
+        return {
+                'type' : 'subscribe',
+                'product_ids' : self.product_ids,
+                'channels' : ['user', 'heartbeat'],
+                'signature' : base64.b64encode(signature.digest()).decode(),
+                'key' : self.auth.api_key,
+                'passphrase' : self.auth.passphrase,
+                'timestamp' : timestamp
+            }
+
+    def _listen(self):
+        """ Connects, subscribes, and applies messages until disconnect. """
+        try:
+            self._connect(self._subscription())
+            for message in self._messages():
+                if message.get('type') == 'subscriptions':
+                    self.tracker.set_feed_products(self.product_ids)
+                else:
+                    self.tracker.apply_message(message)
+        finally:
+            # Poll until the feed is back
+            self.tracker.set_feed_products([])
+            if self._connection is not None:
+                self._connection.close()
@@ -0,0 +1,185 @@
+"""
+vickitrix.pipeline
+
+Stages between the Twitter stream and GDAX. The stream callback only
+queues statuses; a matcher thread evaluates rules, and executor threads
+place orders, so the stream keeps being read while orders are placed.
+Orders for different products are placed concurrently, and orders for
+the same product one at a time.
+"""
+import threading
+from traceback import format_exc
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from .metrics import Trace
+from .trader import is_retweet_or_reply
+
+_stop = object()
+
+class Pipeline(object):
+    """ Bounded queues and worker threads connecting stream to trader.
+
+        Backpressure is explicit: when executors fall behind, the execution
+        queue fills and the matcher blocks; when the matcher falls behind,
+        the status queue fills and submit() waits up to put_timeout before
+        dropping the status and counting it in "dropped".
+    """
+
+    def __init__(self, trader, queue_size=1000, executors=4,
+                 put_timeout=0.1, metrics=None, seen=None):
+        """
+            trader: instance of Trader
+            queue_size: maximum number of statuses (and, separately, of
+                matched statuses) waiting in a queue
+            executors: number of threads placing orders
+            put_timeout: maximum time (in s) submit() waits for room in
+                the status queue
+            metrics: instance of Metrics in which to count statuses and
+                report queue depths; defaults to the trader's
+            seen: instance of SeenStatuses; statuses whose IDs are in it
+                are counted in "duplicates" and not matched again. None
+                matches every status.
+
+            Retweets, replies, and statuses by authors no rule applies to
+            are counted in "rejected" and never queued.
+        """
+        self.trader = trader
+        self.metrics = metrics if metrics is not None else trader.metrics
+        self.event_log = trader.event_log
+        self.put_timeout = put_timeout
+        self.seen = seen
+        self._statuses = queue.Queue(maxsize=queue_size)
+        self._matched = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+                'received' : 0,
+                'rejected' : 0,
+                'dropped' : 0,
+                'duplicates' : 0,
+                'matched' : 0,
+                'executed' : 0,
+                'errors' : 0,
+                'max_status_queue_depth' : 0,
+                'max_match_queue_depth' : 0
+            }
+        self.metrics.gauge('status_queue_depth', self._statuses.qsize)
+        self.metrics.gauge('match_queue_depth', self._matched.qsize)
+        self._threads = [threading.Thread(target=self._match)] + [
+                threading.Thread(target=self._execute)
+                for _ in range(executors)
+            ]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def _count(self, stat, depth_stat=None, depth=0):
+        self.metrics.increment('statuses_' + stat)
+        with self._stats_lock:
+            self._stats[stat] += 1
+            if depth_stat is not None and depth > self._stats[depth_stat]:
+                self._stats[depth_stat] = depth
+
+    def stats(self):
+        """ Gets pipeline counters and queue depths.
+
+            Return value: dictionary mapping stat name to value
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['status_queue_depth'] = self._statuses.qsize()
+        stats['match_queue_depth'] = self._matched.qsize()
+        return stats
+
+    def submit(self, status, candidates=None):
+        """ Queues a status from the stream for matching.
+
+            status: status dictionary from Twitter
+            candidates: list of compiled rules whose handles and keywords
+                apply to status, as found by a MatchPool, or None to find
+                them on the matcher thread
+
+            Return value: True iff status was queued
+        """
+        if candidates is None and (
+                not self.trader.rule_index.admits(status)
+                or is_retweet_or_reply(status)
+            ):
+            # Nothing would be traded on it; don't spend more on it
+            self._count('rejected')
+            return False
+        trace = Trace(self.metrics)
+        status_id = status.get('id_str')
+        if self.seen is not None and status_id is not None and (
+                not self.seen.add(status_id)
+            ):
+            # Redelivered, say after a reconnect; it was handled already
+            self._count('duplicates')
+            self.event_log.log('status_duplicate', status_id=status_id)
+            return False
+        try:
+            self._statuses.put((status, trace, candidates),
+                               timeout=self.put_timeout)
+        except queue.Full:
+            if self.seen is not None and status_id is not None:
+                # Wasn't handled, so it's welcome if it comes again
+                self.seen.discard(status_id)
+            self._count('dropped')
+            self.event_log.log('status_dropped', status_id=status_id)
+            return False
+        self._count('received', 'max_status_queue_depth',
+                    self._statuses.qsize())
+        return True
+
+    def _match(self):
+        while True:
+            item = self._statuses.get()
+            if item is _stop:
+                for _ in self._threads[1:]:
+                    self._matched.put(_stop)
+                return
+            status, trace, candidates = item
+            try:
+                rules = self.trader.match(status, trace, candidates)
+            except Exception:
+                self._count('errors')
+                self.event_log.log('error', traceback=format_exc())
+                continue
+            if rules:
+                # Blocks when executors are behind
+                self._matched.put((status, rules, trace))
+                self._count('matched', 'max_match_queue_depth',
+                            self._matched.qsize())
+
+    def _execute(self):
+        while True:
+            job = self._matched.get()
+            if job is _stop:
+                return
+            try:
+                self.trader.execute(*job)
+            except Exception:
+                self._count('errors')
+                self.event_log.log('error', traceback=format_exc())
+            else:
+                self._count('executed')
+
+    def start(self):
+        """ Starts matcher and executor threads. """
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, wait=True):
+        """ Stops threads once queued statuses are handled.
+
+            wait: True iff this should block until threads are done
+
+            No return value.
+        """
+        self._statuses.put(_stop)
+        if wait:
+            for thread in self._threads:
+                thread.join()
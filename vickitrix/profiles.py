@@ -0,0 +1,383 @@
+"""
+vickitrix.profiles
+
+Profiles of encrypted GDAX and Twitter credentials, and an agent that
+holds keys derived from profile passwords in memory.
+
+Profiles are kept in ~/.vickitrix/profiles.json as a mapping from
+profile name to profile, so a profile is found by name however many
+there are. Profiles in the config file written by earlier versions of
+vickitrix are imported the first time the store is read.
+
+Deriving a profile's key (PBKDF2) needs its password, so a restarted
+vickitrix would have to wait for someone to type it. An agent started
+once with "vickitrix agent" keeps derived keys in memory and hands them
+out over a Unix socket readable only by the user running it, so a
+supervisor can restart "vickitrix trade" unattended.
+"""
+import base64
+import errno
+import json
+import os
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Protocol import KDF
+    from Crypto import Random
+except ImportError as e:
+    e.message = (
+        'vickitrix requires PyCrypto. Install it with '
+        '"pip install pycrypto".'
+    )
+    raise
+
+key_derivation_iterations = 5000
+
+# Credentials in a profile, in the order clients take them; public keys
+# are stored in plaintext so users can tell which keys are in use
+credential_names = ['GDAX key', 'GDAX secret', 'GDAX passphrase',
+                    'Twitter consumer key', 'Twitter consumer secret',
+                    'Twitter access token key', 'Twitter access token secret']
+
+# Encrypted with a profile's key so a wrong password is caught right away
+_key_check = 'vickitrix'
+
+def is_secret(credential_name):
+    return 'key' not in credential_name
+
+def derive_key(password, salt, iterations=key_derivation_iterations):
+    """ Derives a profile's AES256 key from its password.
+
+        password: profile password
+        salt: profile salt (bytes)
+        iterations: PBKDF2 iterations
+
+        Return value: 32-byte key
+    """
+    return KDF.PBKDF2(password, salt, dkLen=32, count=iterations)
+
+def encrypt(key, plaintext):
+    """ Encrypts text with a profile's key.
+
+        key: key from derive_key()
+        plaintext: text to encrypt
+
+        Return value: base64-encoded IV followed by ciphertext
+    """
+    iv = Random.new().read(AES.block_size)
+    cipher = AES.new(key, AES.MODE_CFB, iv)
+    return base64.b64encode(
+            iv + cipher.encrypt(plaintext.encode('utf-8'))
+        ).decode()
+
+def decrypt(key, encoded):
+    """ Decrypts text encrypted with encrypt().
+
+        key: key from derive_key()
+        encoded: base64-encoded IV followed by ciphertext
+
+        Return value: plaintext
+    """
+    encoded = base64.b64decode(encoded)
+    cipher = AES.new(key, AES.MODE_CFB, encoded[:AES.block_size])
+    # Earlier versions decrypted the whole string and dropped the IV
+    return cipher.decrypt(encoded)[AES.block_size:].decode('utf-8')
+
+def _write_private(path, text):
+    """ Replaces a file with text readable and writable only by the user.
+    """
+    temp_path = path + '.tmp'
+    descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+    with os.fdopen(descriptor, 'w') as temp_stream:
+        temp_stream.write(text)
+    os.rename(temp_path, path)
+
+def read_legacy_config(config_file):
+    """ Reads profiles from a config file written by earlier versions.
+
+        config_file: path to config file
+
+        Return value: dictionary mapping profile name to profile; where a
+            name appears more than once, the last profile wins, as it did
+    """
+    profiles = {}
+    with open(config_file) as config_stream:
+        lines = [line.rstrip('\r\n') for line in config_stream]
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not (line.startswith('[') and line.endswith(']')):
+            i += 1
+            continue
+        profile = {'salt' : lines[i + 1].partition(': ')[2],
+                   'iterations' : key_derivation_iterations}
+        for name, entry in zip(credential_names, lines[i + 2:i + 9]):
+            profile[name] = entry.partition(': ')[2]
+        profiles[line[1:-1]] = profile
+        i += 9
+    return profiles
+
+class ProfileStore(object):
+    """ Profiles indexed by name, persisted as JSON. """
+
+    def __init__(self, path, legacy_config=None):
+        """
+            path: JSON file in which profiles are kept
+            legacy_config: config file written by earlier versions of
+                vickitrix whose profiles are imported if they aren't in the
+                store, or None
+        """
+        self.path = path
+        self.profiles = {}
+        if os.path.exists(path):
+            with open(path) as store_stream:
+                self.profiles = json.load(store_stream)['profiles']
+        if legacy_config is not None and os.path.exists(legacy_config):
+            for name, profile in read_legacy_config(legacy_config).items():
+                self.profiles.setdefault(name, profile)
+
+    def names(self):
+        return sorted(self.profiles)
+
+    def get(self, name):
+        """ Gets a profile.
+
+            name: profile name
+
+            Return value: profile dictionary
+        """
+        try:
+            return self.profiles[name]
+        except KeyError:
+            raise RuntimeError(''.join([
+                    'No profile named "{}" is configured. Use '.format(name),
+                    '"vickitrix configure" to configure it, or choose one ',
+                    'of: ', ', '.join(self.names()) or '(none)'
+                ]))
+
+    def put(self, name, password, credentials):
+        """ Adds or replaces a profile.
+
+            name: profile name
+            password: profile password
+            credentials: dictionary mapping every name in credential_names
+                to its value
+
+            Return value: derived key
+        """
+        salt = Random.new().read(AES.block_size)
+        key = derive_key(password, salt)
+        profile = {'salt' : base64.b64encode(salt).decode(),
+                   'iterations' : key_derivation_iterations,
+                   'check' : encrypt(key, _key_check)}
+        for credential_name in credential_names:
+            value = credentials[credential_name]
+            profile[credential_name] = (
+                    encrypt(key, value) if is_secret(credential_name)
+                    else value
+                )
+        self.profiles[name] = profile
+        return key
+
+    def save(self):
+        _write_private(self.path, json.dumps(
+                {'version' : 1, 'profiles' : self.profiles},
+                indent=4, sort_keys=True
+            ))
+
+def profile_key(profile, password):
+    """ Derives a profile's key from its password, checking it if the
+        profile can be checked.
+
+        profile: profile dictionary
+        password: profile password
+
+        Return value: derived key
+    """
+    key = derive_key(password, base64.b64decode(profile['salt']),
+                     profile.get('iterations', key_derivation_iterations))
+    check_key(profile, key)
+    return key
+
+def check_key(profile, key):
+    """ Raises RuntimeError if key is known not to be a profile's key. """
+    if 'check' in profile:
+        try:
+            right = decrypt(key, profile['check']) == _key_check
+        except UnicodeDecodeError:
+            right = False
+        if not right:
+            raise RuntimeError('Wrong password for profile.')
+
+def decrypt_profile(profile, key):
+    """ Gets a profile's credentials.
+
+        profile: profile dictionary
+        key: derived key
+
+        Return value: list of credentials in the order of credential_names
+    """
+    return [decrypt(key, profile[name]) if is_secret(name)
+            else profile[name] for name in credential_names]
+
+def default_agent_socket(key_dir):
+    return os.path.join(key_dir, 'agent.sock')
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    """ Answers one JSON request per line from a client. """
+
+    def handle(self):
+        if hasattr(socket, 'SO_PEERCRED'):
+            # Linux: refuse other users even if the socket is reachable
+            import struct
+            credentials = self.request.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_PEERCRED,
+                    struct.calcsize('3i')
+                )
+            _, uid, _ = struct.unpack('3i', credentials)
+            if uid != os.getuid():
+                return
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.agent.answer(request)
+            except Exception as e:
+                response = {'error' : str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class KeyAgent(object):
+    """ Holds derived profile keys in memory and serves them over a Unix
+        socket. """
+
+    def __init__(self, socket_path):
+        """
+            socket_path: path of Unix socket on which to listen
+        """
+        self.socket_path = socket_path
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    def add(self, name, salt, key):
+        """ Holds a profile's key.
+
+            name: profile name
+            salt: profile's base64-encoded salt, so a reconfigured profile
+                isn't given its old key
+            key: derived key
+
+            No return value.
+        """
+        with self._lock:
+            self._keys[name] = (salt, key)
+
+    def answer(self, request):
+        """ Answers a request from a client.
+
+            request: dictionary with "op" ("get", "put", or "forget"),
+                "profile", and, for get and put, "salt"; for put, "key"
+
+            Return value: response dictionary
+        """
+        name = request['profile']
+        if request['op'] == 'get':
+            with self._lock:
+                salt, key = self._keys.get(name, (None, None))
+            if key is None or salt != request['salt']:
+                return {'key' : None}
+            return {'key' : base64.b64encode(key).decode()}
+        if request['op'] == 'put':
+            self.add(name, request['salt'], base64.b64decode(request['key']))
+            return {'ok' : True}
+        if request['op'] == 'forget':
+            with self._lock:
+                self._keys.pop(name, None)
+            return {'ok' : True}
+        return {'error' : 'unknown op'}
+
+    def serve_forever(self):
+        """ Listens on the socket until interrupted. """
+        try:
+            os.remove(self.socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        # Socket is created readable and writable only by the user
+        old_umask = os.umask(0o177)
+        try:
+            self.server = _AgentServer(self.socket_path, _AgentHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.agent = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+def _agent_request(socket_path, request, timeout=2):
+    """ Sends a request to a running agent.
+
+        Return value: response dictionary, or None if no agent answered
+    """
+    if not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        return json.loads(response.decode('utf-8'))
+    except (socket.error, OSError, ValueError):
+        return None
+    finally:
+        client.close()
+
+def agent_get_key(socket_path, name, profile):
+    """ Gets a profile's key from a running agent.
+
+        socket_path: path of agent's Unix socket
+        name: profile name
+        profile: profile dictionary
+
+        Return value: derived key, or None if no agent has it
+    """
+    response = _agent_request(socket_path, {
+            'op' : 'get', 'profile' : name, 'salt' : profile['salt']
+        })
+    if not response or not response.get('key'):
+        return None
+    return base64.b64decode(response['key'])
+
+def agent_put_key(socket_path, name, profile, key):
+    """ Gives a profile's key to a running agent.
+
+        Return value: True iff an agent took it
+    """
+    response = _agent_request(socket_path, {
+            'op' : 'put', 'profile' : name, 'salt' : profile['salt'],
+            'key' : base64.b64encode(key).decode()
+        })
+    return bool(response and response.get('ok'))
@@ -0,0 +1,229 @@
+"""
+vickitrix.ratelimit
+
+Keeps requests to GDAX under its rate limits, and schedules them so
+orders go first.
+
+GDAX throttles private endpoints (5 requests/s per account, in bursts of
+up to 10) and public endpoints (3 requests/s per IP, in bursts of up to
+6) and answers requests over the limit with errors. A burst of matched
+tweets that also triggers balance reconciliation and order book requests
+could get an order throttled, and being throttled when a signal fires is
+the worst time. So every request waits on a token bucket for its
+endpoint, and whenever requests are waiting, a token goes to the one with
+the highest priority: orders, then balances, then order books, then
+keep-alive requests. Lower-priority requests also leave a token in the
+bucket for orders, and identical ones waiting at the same time are sent
+once and share the response.
+"""
+import heapq
+import itertools
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+# Request priorities; lower goes first
+ORDER, BALANCE, BOOK, KEEPALIVE = range(4)
+
+priority_names = ['order', 'balance', 'book', 'keepalive']
+
+class _Coalesced(object):
+    """ A low-priority request waiting for a token, shared by callers. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class RateLimiter(object):
+    """ Token bucket granting tokens to waiting requests by priority. """
+
+    def __init__(self, rate, burst=None, reserve=1, metrics=None,
+                 name=None):
+        """
+            rate: tokens (requests) added per second
+            burst: most tokens the bucket holds; defaults to twice rate,
+                and is at least 1
+            reserve: tokens that only orders may take, so an order never
+                waits on requests that could have waited
+            metrics: instance of Metrics in which to record waits and
+                coalesced requests, or None
+            name: label for metrics, like "private" or "public"
+        """
+        self.rate = float(rate)
+        # Below one token, no request could ever go
+        self.burst = max(float(burst if burst is not None else 2 * rate), 1)
+        self.reserve = max(min(reserve, self.burst - 1), 0)
+        self.metrics = metrics
+        self.name = name
+        self._tokens = self.burst
+        self._updated = monotonic()
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._coalesced = {}
+
+    def _refill(self, now):
+        """ Adds tokens accrued since last refill; call with lock held. """
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=ORDER):
+        """ Waits for a token.
+
+            priority: one of ORDER, BALANCE, BOOK, and KEEPALIVE; among
+                waiting requests, the lowest priority value goes first,
+                then the one that's waited longest
+
+            Return value: time (in s) spent waiting
+        """
+        start = monotonic()
+        needed = 1 if priority == ORDER else 1 + self.reserve
+        with self._condition:
+            waiter = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, waiter)
+            while True:
+                now = monotonic()
+                self._refill(now)
+                if self._waiters[0] == waiter:
+                    if self._tokens >= needed:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        # Next in line may be able to go too
+                        self._condition.notify_all()
+                        break
+                    timeout = (needed - self._tokens) / self.rate
+                else:
+                    # Woken when whoever's ahead gets a token
+                    timeout = None
+                self._condition.wait(timeout)
+        waited = monotonic() - start
+        if self.metrics is not None:
+            self.metrics.observe('ratelimit_wait_seconds', waited,
+                                 limiter=self.name,
+                                 priority=priority_names[priority])
+        return waited
+
+    def drain(self):
+        """ Empties the bucket, as when GDAX says the limit was exceeded
+            anyway, for example because of requests from elsewhere.
+
+            No return value.
+        """
+        with self._condition:
+            self._refill(monotonic())
+            self._tokens = min(self._tokens, 0)
+
+    def call(self, priority, function, args=(), kwargs=None, key=None):
+        """ Makes a request once a token is granted.
+
+            priority: see acquire()
+            function: function making the request
+            args, kwargs: arguments of function
+            key: hashable identifying requests with the same response, or
+                None; a request with a key joins an identical request
+                still waiting for a token rather than waiting for its own.
+                Orders are never joined.
+
+            Return value: function's return value
+        """
+        if key is None or priority == ORDER:
+            self.acquire(priority)
+            return self._checked(function(*args, **(kwargs or {})))
+        with self._condition:
+            coalesced = self._coalesced.get(key)
+            leader = coalesced is None
+            if leader:
+                coalesced = self._coalesced[key] = _Coalesced()
+        if not leader:
+            if self.metrics is not None:
+                self.metrics.increment('requests_coalesced',
+                                       limiter=self.name,
+                                       priority=priority_names[priority])
+            coalesced.done.wait()
+            if coalesced.error is not None:
+                raise coalesced.error
+            return coalesced.result
+        try:
+            self.acquire(priority)
+        finally:
+            # Requests from here on want a response at least this fresh
+            with self._condition:
+                del self._coalesced[key]
+        try:
+            coalesced.result = self._checked(
+                    function(*args, **(kwargs or {}))
+                )
+        except Exception as e:
+            coalesced.error = e
+            raise
+        finally:
+            coalesced.done.set()
+        return coalesced.result
+
+    def _checked(self, response):
+        """ Drains the bucket if a response says GDAX throttled us. """
+        if isinstance(response, dict) and (
+                'rate limit' in str(response.get('message', '')).lower()
+            ):
+            self.drain()
+            if self.metrics is not None:
+                self.metrics.increment('requests_throttled',
+                                       limiter=self.name)
+        return response
+
+class ScheduledClient(object):
+    """ GDAX client whose requests wait on rate limiters by priority.
+
+        Stands in for gdax.AuthenticatedClient or gdax.PublicClient.
+    """
+
+    # Methods vickitrix calls while trading: (priority, public endpoint?)
+    _schedule = {
+        'buy' : (ORDER, False),
+        'sell' : (ORDER, False),
+        'cancel_order' : (ORDER, False),
+        'get_order' : (BALANCE, False),
+        'get_accounts' : (BALANCE, False),
+        'get_account' : (BALANCE, False),
+        'get_product_order_book' : (BOOK, True),
+        'get_time' : (KEEPALIVE, True)
+    }
+
+    def __init__(self, client, limiter, public_limiter=None):
+        """
+            client: instance of gdax.AuthenticatedClient or
+                gdax.PublicClient
+            limiter: instance of RateLimiter for client's private
+                endpoints, kept per account
+            public_limiter: instance of RateLimiter for public endpoints,
+                shared by every client; defaults to limiter
+        """
+        self.client = client
+        self.limiter = limiter
+        self.public_limiter = (public_limiter if public_limiter is not None
+                               else limiter)
+
+    def _request(self, name, args, kwargs):
+        priority, public = self._schedule[name]
+        limiter = self.public_limiter if public else self.limiter
+        key = None
+        if name in ['get_accounts', 'get_product_order_book']:
+            # Everyone waiting on the same balances or book can share them
+            key = (id(self.client), name, args,
+                   tuple(sorted(kwargs.items())))
+        return limiter.call(priority, getattr(self.client, name), args,
+                            kwargs, key=key)
+
+    def __getattr__(self, name):
+        if name not in self._schedule:
+            # Other methods and attributes, like session, are the client's
+            return getattr(self.client, name)
+        def request(*args, **kwargs):
+            return self._request(name, args, kwargs)
+        return request
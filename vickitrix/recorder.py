@@ -0,0 +1,313 @@
+"""
+vickitrix.recorder
+
+Records what vickitrix saw and did while trading: every raw message from
+the Twitter stream, statuses and notices alike; the inside bid and ask
+each order was filled in with; and every order with GDAX's response.
+Recordings are for post-mortems and, through "vickitrix extract", for
+trying rules out on real data with "vickitrix backtest".
+
+Recording mustn't slow trading down, so the live path only appends to a
+buffer; a writer thread encodes and compresses. A recording is a
+directory of segments, each a gzip file of JSON lines that's only ever
+appended to and is replaced by a new segment once it's big or old
+enough. Every flush of the buffer is written as its own gzip member, so
+a segment is still an ordinary gzip file, and a line per member is
+appended to the segment's index:
+
+    {"offset": ..., "length": ..., "records": ..., "start": ...,
+     "end": ..., "first_status_id": ..., "last_status_id": ...}
+
+where offset and length locate the member in the segment, start and end
+are the earliest and latest times (in s since the epoch) of its records,
+and the status IDs are the lowest and highest among them. Reading a
+window decompresses only the members the index says overlap it.
+"""
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+
+from .metrics import Metrics
+
+# Twitter puts a status's own ID ahead of those of statuses it embeds
+_status_id = re.compile(br'"id_str":"(\d+)"')
+
+def _segment_paths(directory):
+    """ Gets paths of a recording's segments, oldest first. """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.startswith('segment-') and name.endswith('.jsonl.gz')]
+
+def read_index(segment_path):
+    """ Reads a segment's index.
+
+        segment_path: path to segment
+
+        Return value: list of index entries, in the order in which their
+            members were written
+    """
+    entries = []
+    try:
+        with open(segment_path + '.idx') as index_stream:
+            for line in index_stream:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Cut off by a crash mid-write; its member is unindexed
+                    break
+    except IOError:
+        pass
+    return entries
+
+def read_recording(directory, start=None, end=None, types=None):
+    """ Reads records from a recording, decompressing only what's needed.
+
+        directory: directory of recording
+        start: earliest time (in s since the epoch) of records to read, or
+            None for no bound
+        end: latest time (in s since the epoch) of records to read, or
+            None for no bound
+        types: list of record types to read among "message", "quote", and
+            "order", or None for all
+
+        Yield value: record dictionary with keys "type", "time", and
+            "message" (a status or notice from the Twitter stream, for type
+            "message"); "status_id", "product_id", "bid", and "ask" (for
+            type "quote"); or
+            "status_id", "account", "order", and "response" (for type
+            "order")
+    """
+    for segment_path in _segment_paths(directory):
+        entries = [entry for entry in read_index(segment_path)
+                   if (start is None or entry['end'] >= start)
+                   and (end is None or entry['start'] <= end)]
+        if not entries:
+            continue
+        with open(segment_path, 'rb') as segment_stream:
+            for entry in entries:
+                segment_stream.seek(entry['offset'])
+                block = zlib.decompress(segment_stream.read(entry['length']),
+                                        31)
+                for line in block.splitlines():
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Twitter sent something that wasn't JSON
+                        continue
+                    if (start is not None and record['time'] < start) or (
+                            end is not None and record['time'] > end
+                        ) or (types is not None
+                              and record['type'] not in types):
+                        continue
+                    yield record
+
+class Recorder(object):
+    """ Buffered recorder writing compressed, indexed segments. """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 segment_seconds=3600, capacity=100000, flush_interval=1,
+                 compression=6, metrics=None):
+        """
+            directory: directory to which segments are written; created if
+                it doesn't exist
+            segment_bytes: size (in bytes, uncompressed) past which a new
+                segment is started
+            segment_seconds: age (in s) past which a new segment is started
+            capacity: maximum number of records waiting to be written;
+                once full, the oldest waiting records are dropped
+            flush_interval: how often (in s) the writer compresses the
+                buffer into a new member
+            compression: zlib compression level, from 1 (fastest) to 9
+            metrics: instance of Metrics in which to count records, or None
+                for a private registry
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.dropped = 0
+        self._records = deque(maxlen=capacity)
+        self._segment = None
+        self._index = None
+        self._segment_started = None
+        self._segment_size = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self.metrics.gauge('recorder_queue_depth',
+                           lambda: len(self._records))
+
+    def _record(self, record):
+        if len(self._records) >= self.capacity:
+            self.dropped += 1
+            self.metrics.increment('recorder_dropped')
+        self._records.append(record)
+
+    def record_message(self, message):
+        """ Records a raw message from the Twitter stream.
+
+            message: message as a byte string
+
+            No return value.
+        """
+        self._record(('message', time.time(), message))
+
+    def record_quote(self, product_id, bid, ask, status_id=None):
+        """ Records the inside bid and ask an order was filled in with.
+
+            product_id: GDAX product ID
+            bid: inside bid
+            ask: inside ask
+            status_id: ID string of status order was for, or None
+
+            No return value.
+        """
+        self._record(('quote', time.time(), {
+                'status_id' : status_id,
+                'product_id' : product_id,
+                'bid' : bid,
+                'ask' : ask
+            }))
+
+    def record_order(self, order, response, status_id=None, account=None):
+        """ Records an order and GDAX's response to it.
+
+            order: dictionary of order parameters passed to GDAX
+            response: GDAX's response
+            status_id: ID string of status order was for, or None
+            account: name of account order was placed for, or None
+
+            No return value.
+        """
+        self._record(('order', time.time(), {
+                'status_id' : status_id,
+                'account' : account,
+                'order' : order,
+                'response' : response
+            }))
+
+    def _encode(self, record):
+        """ Encodes a record as a JSON line.
+
+            Return value: tuple (line as byte string, status ID or None)
+        """
+        kind, when, payload = record
+        head = ('{"type":"' + kind + '","time":' + repr(when)).encode('ascii')
+        if kind == 'message':
+            # Kept as they came, without decoding
+            match = _status_id.search(payload)
+            return (head + b',"message":' + payload + b'}\n',
+                    match.group(1).decode('ascii') if match else None)
+        line = json.dumps(payload, separators=(',', ':'), default=str)
+        return (head + b',' + line[1:].encode('utf-8') + b'\n',
+                payload['status_id'])
+
+    def _open(self, now):
+        """ Starts a new segment. """
+        self._close_segment()
+        path = os.path.join(self.directory, 'segment-{:016d}.jsonl.gz'.format(
+                int(now * 1000)
+            ))
+        self._segment = open(path, 'ab')
+        self._index = open(path + '.idx', 'a')
+        self._segment_started = now
+        self._segment_size = 0
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def flush(self):
+        """ Writes buffered records as a member of the current segment;
+            called by the writer thread.
+
+            No return value.
+        """
+        records = []
+        while True:
+            try:
+                records.append(self._records.popleft())
+            except IndexError:
+                break
+        if not records:
+            return
+        lines, times, status_ids = [], [], []
+        for record in records:
+            try:
+                line, status_id = self._encode(record)
+            except Exception:
+                # A record that can't be encoded shouldn't stop the writer
+                self.metrics.increment('recorder_dropped')
+                continue
+            lines.append(line)
+            times.append(record[1])
+            if status_id is not None:
+                status_ids.append(int(status_id))
+            self.metrics.increment('recorder_records', type=record[0])
+        if not lines:
+            return
+        now = time.time()
+        if self._segment is None or (
+                self._segment_size >= self.segment_bytes
+            ) or now - self._segment_started >= self.segment_seconds:
+            self._open(now)
+        block = b''.join(lines)
+        compressor = zlib.compressobj(self.compression, zlib.DEFLATED, 31)
+        member = compressor.compress(block) + compressor.flush()
+        offset = self._segment.tell()
+        self._segment.write(member)
+        self._segment.flush()
+        self._segment_size += len(block)
+        # Indexed only once the member is written, so the index never
+        # points past the end of a segment
+        self._index.write(json.dumps({
+                'offset' : offset,
+                'length' : len(member),
+                'records' : len(lines),
+                'start' : min(times),
+                'end' : max(times),
+                'first_status_id' : (str(min(status_ids)) if status_ids
+                                     else None),
+                'last_status_id' : (str(max(status_ids)) if status_ids
+                                    else None)
+            }, sort_keys=True) + '\n')
+        self._index.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        """ Creates the recording's directory and starts the writer
+            thread. """
+        if self._thread is not None:
+            return
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Writes buffered records, then stops the writer thread. """
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self._close_segment()
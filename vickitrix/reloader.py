@@ -0,0 +1,93 @@
+"""
+vickitrix.reloader
+
+Watches a rules file and hands each new version to a callback once it
+loads, checks, and compiles cleanly, so rules can be changed while
+trading without restarting (and without prompting for a password,
+deriving keys, or reconnecting to Twitter again).
+
+The file is polled rather than watched with inotify, which isn't in the
+standard library and doesn't exist off Linux; a stat() every couple of
+seconds costs nothing next to a tweet.
+"""
+import os
+import threading
+from traceback import format_exc
+
+class RulesWatcher(object):
+    """ Reloads a rules file in the background when it changes. """
+
+    def __init__(self, rules_file, load, on_change, interval=2,
+                 event_log=None):
+        """
+            rules_file: path to rules file
+            load: function taking rules_file and returning compiled rules,
+                raising an exception if they're invalid
+            on_change: function taking newly compiled rules; called from
+                the watcher's thread
+            interval: time (in s) between checks of the file
+            event_log: instance of EventLog to which reloads and rejected
+                rules files are logged, or None
+        """
+        self.rules_file = rules_file
+        self.load = load
+        self.on_change = on_change
+        self.interval = interval
+        self.event_log = event_log
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        """ Gets what identifies a version of the rules file.
+
+            Return value: tuple (modification time, size, inode), or None
+                if the file can't be read; editors that save by renaming
+                change the inode even when time and size look the same
+        """
+        try:
+            stat = os.stat(self.rules_file)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def _log(self, event, **fields):
+        if self.event_log is not None:
+            self.event_log.log(event, rules_file=self.rules_file, **fields)
+
+    def check(self):
+        """ Reloads the rules file if it changed since it was last checked.
+
+            Return value: True iff new rules were handed to on_change
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            # A missing file is likely mid-save; keep the current rules
+            return False
+        self._signature = signature
+        try:
+            rules = self.load(self.rules_file)
+        except Exception as e:
+            self._log('rules_rejected',
+                      error=getattr(e, 'message', None) or str(e))
+            return False
+        try:
+            self.on_change(rules)
+        except Exception:
+            self._log('error', traceback=format_exc())
+            return False
+        self._log('rules_reloaded', rules=len(rules))
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """ Starts checking the rules file in the background. """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
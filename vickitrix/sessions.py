@@ -0,0 +1,159 @@
+"""
+vickitrix.sessions
+
+GDAX clients that share one pool of keep-alive HTTPS connections.
+
+GDAX-Python opens a new connection (and does a new TLS handshake) for
+every request. The clients here send the requests vickitrix makes on the
+trading path through a shared requests.Session instead, warm the pool at
+startup, and keep its connections alive while no trades are happening.
+"""
+import json
+import threading
+
+import gdax
+import requests
+from requests.adapters import HTTPAdapter
+
+class PooledSession(requests.Session):
+    """ Session with a bounded connection pool and a default timeout. """
+
+    def __init__(self, pool_size=4, timeout=10):
+        """
+            pool_size: maximum number of connections kept per host
+            timeout: timeout (in s) for requests that don't specify one
+        """
+        super(PooledSession, self).__init__()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, pool_block=False)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+class PooledPublicClient(gdax.PublicClient):
+    """ gdax.PublicClient sending requests through a PooledSession. """
+
+    def __init__(self, session, api_url='https://api.gdax.com'):
+        """
+            session: instance of PooledSession shared by clients
+            api_url: GDAX API URL
+        """
+        super(PooledPublicClient, self).__init__(api_url)
+        self.session = session
+
+    def get_product_order_book(self, product_id, level=1):
+        return self.session.get(
+                self.url + '/products/{}/book'.format(product_id),
+                params={'level' : level}
+            ).json()
+
+    def get_time(self):
+        return self.session.get(self.url + '/time').json()
+
+class PooledAuthenticatedClient(gdax.AuthenticatedClient):
+    """ gdax.AuthenticatedClient sending requests vickitrix makes while
+        trading through a PooledSession. """
+
+    def __init__(self, key, b64secret, passphrase, session,
+                 api_url='https://api.gdax.com'):
+        """
+            key, b64secret, passphrase: GDAX API credentials
+            session: instance of PooledSession shared by clients
+            api_url: GDAX API URL
+        """
+        super(PooledAuthenticatedClient, self).__init__(
+                key, b64secret, passphrase, api_url
+            )
+        self.session = session
+
+    def get_product_order_book(self, product_id, level=1):
+        return self.session.get(
+                self.url + '/products/{}/book'.format(product_id),
+                params={'level' : level}
+            ).json()
+
+    def get_time(self):
+        return self.session.get(self.url + '/time').json()
+
+    def get_account(self, account_id):
+        return self.session.get(self.url + '/accounts/' + account_id,
+                                auth=self.auth).json()
+
+    def buy(self, **kwargs):
+        kwargs['side'] = 'buy'
+        return self.session.post(self.url + '/orders',
+                                 data=json.dumps(kwargs),
+                                 auth=self.auth).json()
+
+    def sell(self, **kwargs):
+        kwargs['side'] = 'sell'
+        return self.session.post(self.url + '/orders',
+                                 data=json.dumps(kwargs),
+                                 auth=self.auth).json()
+
+    def get_order(self, order_id):
+        return self.session.get(self.url + '/orders/' + order_id,
+                                auth=self.auth).json()
+
+    def cancel_order(self, order_id):
+        return self.session.delete(self.url + '/orders/' + order_id,
+                                   auth=self.auth).json()
+
+class ConnectionWarmer(object):
+    """ Opens pooled connections ahead of use and keeps them alive. """
+
+    def __init__(self, client, connections=None, interval=30):
+        """
+            client: pooled client whose session is to be kept warm
+            connections: number of connections to keep open; defaults to
+                the session's pool size
+            interval: time (in s) between keep-alive requests; should be
+                shorter than the server's idle timeout
+        """
+        self.client = client
+        self.connections = connections or client.session.pool_size
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def warm(self):
+        """ Makes concurrent lightweight requests so the pool opens (or
+            reuses) that many connections.
+
+            Return value: number of requests that succeeded
+        """
+        succeeded = []
+        def ping():
+            try:
+                self.client.get_time()
+            except Exception:
+                return
+            succeeded.append(True)
+        threads = [threading.Thread(target=ping)
+                   for _ in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(succeeded)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.warm()
+
+    def start(self):
+        """ Warms connections now and again every interval in the
+            background. """
+        self.warm()
+        if self.interval:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
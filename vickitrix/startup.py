@@ -0,0 +1,85 @@
+"""
+vickitrix.startup
+
+Times vickitrix's startup stage by stage for "vickitrix --profile-startup",
+noting which third-party packages each stage loads, so it's easy to tell
+when a subcommand that doesn't trade starts loading the GDAX or Twitter
+clients.
+"""
+from __future__ import print_function
+
+import sys
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+# Third-party packages worth calling out when a stage loads them
+watched_packages = ['Crypto', 'gdax', 'requests', 'twython', 'websocket',
+                    'yaml']
+
+class StartupProfile(object):
+    """ Time spent and modules loaded in each stage of startup. """
+
+    def __init__(self, started=None, modules=None):
+        """
+            started: monotonic() time at which startup began, or None for
+                now
+            modules: names of modules already loaded when startup began, or
+                None for those loaded now
+        """
+        self._last = self.started = (started if started is not None
+                                     else monotonic())
+        self._modules = set(sys.modules if modules is None else modules)
+        # Tuples (stage, time (in s), names of modules loaded)
+        self.stages = []
+
+    def mark(self, stage):
+        """ Ends a stage.
+
+            stage: name of stage that just ended
+
+            No return value.
+        """
+        now = monotonic()
+        modules = set(sys.modules)
+        self.stages.append((stage, now - self._last,
+                            sorted(modules - self._modules)))
+        self._last, self._modules = now, modules
+
+    def packages(self):
+        """ Gets watched packages loaded during startup.
+
+            Return value: sorted list of package names
+        """
+        return sorted(set(
+                module.partition('.')[0] for _, _, modules in self.stages
+                for module in modules
+            ) & set(watched_packages))
+
+    def report(self, stream=None):
+        """ Prints time taken and modules loaded by each stage.
+
+            stream: where to print; default is stderr, so reports don't mix
+                with a subcommand's output
+
+            No return value.
+        """
+        stream = stream if stream is not None else sys.stderr
+        print('Startup profile:', file=stream)
+        print('    {:<14}{:>10}{:>9}  {}'.format('stage', 'ms', 'modules',
+                                                 'packages'), file=stream)
+        for stage, seconds, modules in self.stages:
+            packages = sorted(set(
+                    module.partition('.')[0] for module in modules
+                ) & set(watched_packages))
+            print('    {:<14}{:>10.1f}{:>9}  {}'.format(
+                    stage, seconds * 1000, len(modules), ', '.join(packages)
+                ), file=stream)
+        print('    {:<14}{:>10.1f}{:>9}'.format(
+                'total', (self._last - self.started) * 1000,
+                sum(len(modules) for _, _, modules in self.stages)
+            ), file=stream)
+        stream.flush()
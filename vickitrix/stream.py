@@ -0,0 +1,358 @@
+"""
+vickitrix.stream
+
+Keeps a Twitter stream connected.
+
+Twython's streamer reconnects right away after an HTTP error, lets
+network errors escape, and leaves stalls to a long read timeout, so
+vickitrix used to sit out a fixed 15 minutes whenever the stream ended,
+losing every signal in between. The streamer here tells disconnects
+apart and waits as Twitter asks clients to before reconnecting:
+
+    network errors and stalls: linearly, from 0.25 s up to 16 s
+    HTTP errors: exponentially, from 5 s up to 320 s
+    rate limiting (HTTP 420 or 429): exponentially, from 1 minute
+
+Waits reset once a connection is accepted. Twitter sends a blank line
+every 30 s while a stream is idle, so a stream with nothing to read for
+90 s has stalled and is reconnected.
+
+The stream is read in large chunks as they arrive and split into messages
+on newlines. Subclasses can turn raw messages away in admits() before
+they're decoded, and messages are decoded with orjson or ujson when either
+is installed.
+"""
+import json
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
+
+import requests
+
+try:
+    from twython import TwythonStreamer
+    from twython.helpers import _transparent_params
+except ImportError as e:
+    e.message = (
+            'vickitrix requires Twython. Install it with '
+            '"pip install twython".'
+        )
+    raise
+
+from .eventlog import EventLog
+from .metrics import Metrics
+
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        def loads(message):
+            return json.loads(message.decode('utf-8'))
+
+# Twitter's statuses start with this, unlike its notices
+status_prefix = b'{"created_at"'
+
+# Past this many followed users, looking for each in raw messages costs
+# more than decoding them
+max_author_patterns = 50
+
+# Retrying requests Twitter refused with these won't help
+fatal_status_codes = [401, 403, 404, 406, 413, 416]
+
+# Upper bounds (in s) of histogram buckets for how long connections last,
+# seconds to days, and how long reconnecting waits, from the first wait
+# after a network error to the longest after being rate-limited
+_connection_buckets = (1, 10, 30, 60, 300, 900, 1800, 3600, 4 * 3600,
+                       12 * 3600, 24 * 3600, 7 * 24 * 3600)
+_backoff_buckets = (0.25, 0.5, 1, 2, 4, 8, 16, 30, 60, 120, 320, 960, 3600)
+
+class Backoff(object):
+    """ Successive waits before reconnecting, growing until reset. """
+
+    def __init__(self, start, cap, factor=None, step=None):
+        """
+            start: first wait (in s)
+            cap: longest wait (in s)
+            factor: each wait is the last times factor, or None
+            step: each wait is the last plus step, if factor is None
+        """
+        self.start = start
+        self.cap = cap
+        self.factor = factor
+        self.step = step
+        self.reset()
+
+    def reset(self):
+        self._next = self.start
+
+    def next(self):
+        """ Gets the next wait.
+
+            Return value: time (in s) to wait
+        """
+        wait = min(self._next, self.cap)
+        if self.factor is not None:
+            self._next = wait * self.factor
+        else:
+            self._next = wait + self.step
+        return wait
+
+def split_messages(chunks):
+    """ Splits chunks read from a stream into newline-delimited messages.
+
+        chunks: iterable of byte strings, split anywhere
+
+        Return value: generator of messages as byte strings, without
+            trailing newlines and carriage returns; blank keep-alives are
+            empty strings
+    """
+    pending = b''
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        start = 0
+        end = chunk.find(b'\n')
+        while end >= 0:
+            if chunk[end - 1:end] == b'\r':
+                yield chunk[start:end - 1]
+            else:
+                yield chunk[start:end]
+            start = end + 1
+            end = chunk.find(b'\n', start)
+        # Only the incomplete message is carried over
+        pending = chunk[start:]
+    if pending:
+        yield pending
+
+def author_patterns(user_ids):
+    """ Gets byte strings, one of which is in the raw JSON of any status by
+        the given users.
+
+        user_ids: iterable of user ID strings
+
+        Return value: list of byte strings
+    """
+    return [('"id_str":"' + user_id + '"').encode('ascii')
+            for user_id in sorted(user_ids)]
+
+class ReconnectingStreamer(TwythonStreamer):
+    """ TwythonStreamer that reconnects with Twitter's backoff until
+        disconnect() is called. """
+
+    def __init__(self, app_key, app_secret, oauth_token, oauth_token_secret,
+                 stall_timeout=90, connect_timeout=10, rate_limit_cap=960,
+                 client_args=None, handlers=None, chunk_size=65536,
+                 metrics=None, event_log=None, name=None):
+        """
+            app_key, app_secret, oauth_token, oauth_token_secret: Twitter
+                credentials
+            stall_timeout: time (in s) without so much as a keep-alive
+                after which the stream has stalled
+            connect_timeout: time (in s) to wait for a connection
+            rate_limit_cap: longest wait (in s) after Twitter rate-limits
+                connections
+            client_args, handlers: see TwythonStreamer
+            chunk_size: most bytes read at once; reads return as soon as
+                anything arrives, so this doesn't delay messages
+            metrics: instance of Metrics in which to record connections,
+                or None for a private registry
+            event_log: instance of EventLog to which connections and
+                disconnects are logged, or None to log nothing
+            name: name of connection in metrics and logged events, when
+                there are several, or None
+        """
+        super(ReconnectingStreamer, self).__init__(
+                app_key, app_secret, oauth_token, oauth_token_secret,
+                timeout=(connect_timeout, stall_timeout),
+                client_args=client_args, handlers=handlers,
+                chunk_size=chunk_size
+            )
+        self.stall_timeout = stall_timeout
+        self.name = name
+        self._labels = {'connection' : name} if name is not None else {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self.backoffs = {
+                'network' : Backoff(0.25, 16, step=0.25),
+                'http' : Backoff(5, 320, factor=2),
+                'rate_limit' : Backoff(60, rate_limit_cap, factor=2)
+            }
+        # Stalls are network errors as far as Twitter is concerned
+        self.backoffs['stall'] = self.backoffs['network']
+        self._wakeup = threading.Event()
+        self._response = None
+        self._connected_at = None
+        self._retry_after = None
+        self.metrics.gauge('stream_connected',
+                           lambda: int(self._connected_at is not None),
+                           **self._labels)
+        self.metrics.gauge('stream_uptime_seconds', self.uptime,
+                           **self._labels)
+        self.metrics.set_buckets('stream_connection_seconds',
+                                 _connection_buckets)
+        self.metrics.set_buckets('stream_backoff_seconds', _backoff_buckets)
+
+    def uptime(self):
+        """ Gets how long the stream has been connected.
+
+            Return value: time (in s), or 0 if it isn't connected
+        """
+        connected_at = self._connected_at
+        if connected_at is None:
+            return 0
+        return monotonic() - connected_at
+
+    def _request(self, url, method='GET', params=None):
+        """ Reads a stream, reconnecting until disconnect() is called. """
+        self.connected = True
+        self._wakeup.clear()
+        method = method.lower()
+        params, _ = _transparent_params(params)
+        requests_args = dict((name, value)
+                             for name, value in self.client_args.items()
+                             if name in ['timeout', 'allow_redirects',
+                                         'verify'])
+        requests_args['params' if method == 'get' else 'data'] = params
+        request = getattr(self.client, method)
+        while self.connected:
+            reason, status_code = self._read(request, url, requests_args)
+            if not self.connected:
+                break
+            wait = self.backoffs[reason].next()
+            if self._retry_after is not None:
+                wait = max(wait, self._retry_after)
+                self._retry_after = None
+            self.metrics.increment('stream_disconnects', reason=reason,
+                                   **self._labels)
+            self.metrics.observe('stream_backoff_seconds', wait,
+                                 reason=reason, **self._labels)
+            self.event_log.log('stream_disconnected', reason=reason,
+                               status_code=status_code, wait=wait,
+                               **self._labels)
+            # disconnect() cuts this short
+            self._wakeup.wait(wait)
+
+    def _read(self, request, url, requests_args):
+        """ Connects once and reads the stream until it ends.
+
+            Return value: tuple (why the stream ended, one of "network",
+                "stall", "http", and "rate_limit"; HTTP status code or None)
+        """
+        try:
+            response = request(url, **requests_args)
+        except requests.exceptions.RequestException:
+            return 'network', None
+        if response.status_code != 200:
+            self.on_error(response.status_code, response.content,
+                          response.headers)
+            response.close()
+            if response.status_code in fatal_status_codes:
+                self.connected = False
+                raise RuntimeError(''.join([
+                        'Twitter refused to stream with HTTP status ',
+                        str(response.status_code), '; check credentials ',
+                        'and the handles and keywords in rules.'
+                    ]))
+            if response.status_code in [420, 429]:
+                return 'rate_limit', response.status_code
+            return 'http', response.status_code
+        for backoff in self.backoffs.values():
+            backoff.reset()
+        self._response = response
+        if not self.connected:
+            # disconnect() came while connecting
+            response.close()
+            self._response = None
+            return None, None
+        self._connected_at = last_read = monotonic()
+        self.event_log.log('stream_connected', **self._labels)
+        try:
+            for message in split_messages(
+                    response.iter_content(self.chunk_size)
+                ):
+                # Blank keep-alives count; they show the stream is moving
+                last_read = monotonic()
+                if not self.connected:
+                    break
+                if message:
+                    self.on_message(message)
+                    if self.admits(message):
+                        self._dispatch(response, message)
+            reason = 'network'
+        except Exception:
+            if not self.connected:
+                # disconnect() closed the response mid-read
+                reason = None
+            elif monotonic() - last_read >= self.stall_timeout:
+                reason = 'stall'
+            else:
+                reason = 'network'
+        finally:
+            self.metrics.observe('stream_connection_seconds', self.uptime(),
+                                 **self._labels)
+            self._connected_at = None
+            self._response = None
+            response.close()
+        return reason, None
+
+    def on_message(self, message):
+        """ Called with every message from the stream before admits().
+
+            message: message from the stream as a byte string
+
+            No return value; does nothing here, for subclasses to override
+        """
+        pass
+
+    def admits(self, message):
+        """ Checks whether a raw message should be decoded and handled.
+
+            message: message from the stream as a byte string
+
+            Return value: True iff message should be handled; always True
+                here, for subclasses to override
+        """
+        return True
+
+    def _dispatch(self, response, message):
+        """ Hands a message from the stream to on_success() and handlers. """
+        try:
+            data = loads(message)
+        except ValueError:
+            self.on_error(response.status_code,
+                          'Unable to decode response, not valid JSON.')
+            return
+        if self.on_success(data):
+            for message_type in self.handlers:
+                if message_type in data:
+                    handler = getattr(self, 'on_' + message_type, None)
+                    if handler and callable(handler) and not handler(
+                            data.get(message_type)
+                        ):
+                        break
+
+    def on_error(self, status_code, data, headers=None):
+        retry_after = (headers or {}).get('Retry-After')
+        if retry_after:
+            try:
+                self._retry_after = float(retry_after)
+            except ValueError:
+                pass
+
+    def disconnect(self):
+        """ Stops reading the stream now rather than at the next line. """
+        self.connected = False
+        self._wakeup.set()
+        response = self._response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
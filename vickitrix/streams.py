@@ -0,0 +1,376 @@
+"""
+vickitrix.streams
+
+Reads the Twitter stream over several connections once rules follow or
+track more than one connection can.
+
+A connection to Twitter's filter endpoint can follow at most 5000 users
+and track at most 400 keywords, and each set of credentials can hold only
+one connection open. A StreamManager shares followed users and tracked
+keywords out among as few connections as hold them, each with its own
+credentials, and hands every connection's messages to one listener. A
+status that passes more than one connection's filter arrives on each of
+them, so while there are several connections a status is handed on only
+the first time its ID is seen.
+
+When rules change, users and keywords stay on the connections they're
+already on wherever they can, and only connections whose share changed
+reconnect. Each connection's lag, the time from a status's timestamp_ms
+to its arrival, is kept as a metric.
+"""
+import re
+import threading
+import time
+from traceback import format_exc
+
+from .dedup import SeenStatuses
+from .stream import ReconnectingStreamer, status_prefix
+
+# Most users and keywords one connection can follow and track
+max_follow = 5000
+max_track = 400
+
+# Twitter puts a status's own ID ahead of those of statuses it embeds, and
+# its timestamp_ms after them; embedded statuses have none
+_status_id = re.compile(br'"id_str":"(\d+)"')
+_timestamp = b'"timestamp_ms":"'
+
+# Twitter's notice that a connection's filter matched more than it sent
+_limit_prefix = b'{"limit"'
+
+def connections_needed(follows, tracks, max_follow=max_follow,
+                       max_track=max_track):
+    """ Gets how many connections it takes to follow and track so much.
+
+        follows: number of users to follow
+        tracks: number of keywords to track
+        max_follow: most users a connection can follow
+        max_track: most keywords a connection can track
+
+        Return value: number of connections, at least 1
+    """
+    return max(1, -(-follows // max_follow), -(-tracks // max_track))
+
+def partition(items, previous, count):
+    """ Shares items out among connections, leaving each on the connection
+        it was on if that connection is still there.
+
+        items: iterable of items, like user IDs
+        previous: list of sets of items connections had before
+        count: number of connections
+
+        Return value: list of count sets of items; items that weren't on
+            a connection go to whichever has fewest, so none gets more
+            than its share
+    """
+    items = set(items)
+    parts = [set(part) & items for part in previous[:count]]
+    parts.extend(set() for _ in range(count - len(parts)))
+    placed = set()
+    for part in parts:
+        placed.update(part)
+    for item in sorted(items - placed):
+        min(parts, key=len).add(item)
+    return parts
+
+class StreamConnection(ReconnectingStreamer):
+    """ One of a StreamManager's connections, handing messages to the
+        manager. """
+
+    def __init__(self, manager, name, credentials):
+        """
+            manager: StreamManager the connection belongs to
+            name: name of connection in metrics and logged events
+            credentials: tuple (app_key, app_secret, oauth_token,
+                oauth_token_secret) of Twitter credentials
+        """
+        app_key, app_secret, oauth_token, oauth_token_secret = credentials
+        super(StreamConnection, self).__init__(
+                app_key, app_secret, oauth_token, oauth_token_secret,
+                stall_timeout=manager.stall_timeout,
+                connect_timeout=manager.connect_timeout,
+                rate_limit_cap=manager.rate_limit_cap,
+                chunk_size=manager.chunk_size, metrics=manager.metrics,
+                event_log=manager.event_log, name=name
+            )
+        self.manager = manager
+        # Tuple (user IDs to follow, keywords to track) of the filter
+        self.filter_params = ([], [])
+        # Set when the filter must be reissued with new filter_params
+        self.refilter = threading.Event()
+        # Time (in s) from the last status's timestamp_ms to its arrival
+        self.lag = None
+        self.thread = None
+        self.metrics.gauge('stream_last_lag_seconds',
+                           lambda: self.lag or 0, **self._labels)
+
+    def run(self):
+        """ Reads the stream, reissuing the filter whenever it changes,
+            until stop() is called.
+
+            No return value.
+        """
+        while True:
+            self.refilter.clear()
+            follow, track = self.filter_params
+            params = {}
+            if follow:
+                params['follow'] = follow
+            if track:
+                params['track'] = track
+            # Reconnects on its own until disconnected
+            self.statuses.filter(**params)
+            if not self.refilter.is_set():
+                return
+
+    def _read(self, request, url, requests_args):
+        if self.refilter.is_set():
+            # set_filter() came after run() read the filter, and connecting
+            # may have undone its disconnect; reissue the filter first
+            self.connected = False
+            return None, None
+        return super(StreamConnection, self)._read(request, url,
+                                                   requests_args)
+
+    def set_filter(self, follow, track):
+        """ Reconnects with a new filter.
+
+            follow: list of user ID strings to follow
+            track: list of keywords to track
+
+            No return value.
+        """
+        self.filter_params = (follow, track)
+        self.refilter.set()
+        self.disconnect()
+
+    def stop(self):
+        """ Stops reading the stream for good. """
+        self.refilter.clear()
+        self.disconnect()
+
+    def admits(self, message):
+        return self.manager._admits(self, message)
+
+    def on_success(self, data):
+        return self.manager.listener.on_success(data)
+
+class StreamManager(object):
+    """ Connections to Twitter sharing out followed users and tracked
+        keywords, all feeding one listener. """
+
+    def __init__(self, listener, credentials, max_follow=max_follow,
+                 max_track=max_track, stall_timeout=90, connect_timeout=10,
+                 rate_limit_cap=960, chunk_size=65536, dedup_capacity=10000,
+                 metrics=None, event_log=None):
+        """
+            listener: ReconnectingStreamer, like a TradeListener, whose
+                on_message(), admits(), and on_success() are handed every
+                connection's messages; it never connects itself
+            credentials: list of tuples (app_key, app_secret, oauth_token,
+                oauth_token_secret), one for each connection that can be
+                opened, in the order they're opened
+            max_follow: most users a connection can follow
+            max_track: most keywords a connection can track
+            stall_timeout, connect_timeout, rate_limit_cap, chunk_size: see
+                ReconnectingStreamer
+            dedup_capacity: most IDs of recent statuses remembered to turn
+                away copies arriving on other connections
+            metrics: instance of Metrics in which to record connections and
+                lag, or None for listener's
+            event_log: instance of EventLog to which connections and
+                rebalancing are logged, or None for listener's
+        """
+        self.listener = listener
+        self.credentials = [tuple(keys) for keys in credentials]
+        self.max_follow = max_follow
+        self.max_track = max_track
+        self.stall_timeout = stall_timeout
+        self.connect_timeout = connect_timeout
+        self.rate_limit_cap = rate_limit_cap
+        self.chunk_size = chunk_size
+        self.metrics = metrics if metrics is not None else listener.metrics
+        self.event_log = (event_log if event_log is not None
+                          else listener.event_log)
+        self.connections = []
+        # Tuples (set of user IDs, set of keywords), one per connection
+        self._shares = []
+        self._seen = SeenStatuses(capacity=dedup_capacity)
+        self._lock = threading.Lock()
+        self._started = False
+        self._finished = threading.Event()
+        # What a connection that failed for good raised
+        self.failure = None
+        self.metrics.gauge('stream_connections',
+                           lambda: len(self.connections))
+        # The listener's own gauges would always read 0
+        self.metrics.gauge('stream_connected', lambda: sum(
+                int(connection.uptime() > 0)
+                for connection in list(self.connections)
+            ))
+        self.metrics.gauge('stream_uptime_seconds', lambda: min(
+                [connection.uptime()
+                 for connection in list(self.connections)] or [0]
+            ))
+
+    def connections_needed(self, follows, tracks):
+        """ Gets how many connections it takes to follow and track so much,
+            checking there are credentials for that many.
+
+            follows: number of users to follow
+            tracks: number of keywords to track
+
+            Return value: number of connections
+        """
+        count = connections_needed(follows, tracks, self.max_follow,
+                                   self.max_track)
+        if count > len(self.credentials):
+            raise RuntimeError(''.join([
+                    'Following ', str(follows), ' user(s) and tracking ',
+                    str(tracks), ' keyword(s) takes ', str(count),
+                    ' connections to Twitter, but only ',
+                    str(len(self.credentials)), ' profile(s) have Twitter ',
+                    'credentials to connect with; pass more with ',
+                    '--stream-profile.'
+                ]))
+        return count
+
+    def set_filter(self, follow, track):
+        """ Shares out users and keywords among connections, opening,
+            closing, and reconnecting only connections whose share
+            changed.
+
+            follow: list of user ID strings to follow
+            track: list of keywords to track
+
+            Return value: True iff a connection already reading the stream
+                reconnects with a new filter
+        """
+        count = self.connections_needed(len(follow), len(track))
+        with self._lock:
+            if self._finished.is_set():
+                # Stopped
+                return False
+            follows = partition(follow, [share[0] for share in self._shares],
+                                count)
+            tracks = partition(track, [share[1] for share in self._shares],
+                               count)
+            changed = count != len(self.connections)
+            refiltered = False
+            for i, (share_follow, share_track) in enumerate(zip(follows,
+                                                                tracks)):
+                filter_params = (sorted(share_follow), sorted(share_track))
+                if i < len(self.connections):
+                    connection = self.connections[i]
+                    if connection.filter_params == filter_params:
+                        continue
+                    changed = True
+                    if self._started:
+                        refiltered = True
+                        self.event_log.log('stream_refilter',
+                                           follow=filter_params[0],
+                                           track=filter_params[1],
+                                           connection=connection.name)
+                    connection.set_filter(*filter_params)
+                    continue
+                connection = StreamConnection(self, i, self.credentials[i])
+                connection.filter_params = filter_params
+                self.connections.append(connection)
+                if self._started:
+                    self._start(connection)
+            for connection in self.connections[count:]:
+                connection.stop()
+            del self.connections[count:]
+            self._shares = list(zip(follows, tracks))
+        if changed:
+            self.event_log.log('stream_rebalanced', connections=count,
+                               follow=len(follow), track=len(track))
+        return refiltered
+
+    def _admits(self, connection, message):
+        """ Measures a connection's lag and turns away statuses that came
+            on another connection before handing a message to the
+            listener.
+
+            connection: StreamConnection message arrived on
+            message: message from the stream as a byte string
+
+            Return value: True iff message should be decoded
+        """
+        if message.startswith(status_prefix):
+            start = message.rfind(_timestamp)
+            if start >= 0:
+                start += len(_timestamp)
+                try:
+                    connection.lag = time.time() - int(
+                            message[start:message.find(b'"', start)]
+                        ) / 1000.0
+                except ValueError:
+                    pass
+                else:
+                    self.metrics.observe('stream_lag_seconds',
+                                         connection.lag,
+                                         connection=connection.name)
+            if len(self.connections) > 1:
+                match = _status_id.search(message)
+                if match is not None and not self._seen.add(match.group(1)):
+                    self.metrics.increment('stream_duplicates',
+                                           connection=connection.name)
+                    return False
+        elif message.startswith(_limit_prefix):
+            # Statuses matched the filter but weren't sent
+            self.metrics.increment('stream_limit_notices',
+                                   connection=connection.name)
+        self.listener.on_message(message)
+        return self.listener.admits(message)
+
+    def _read(self, connection):
+        """ Reads a connection's stream, giving up on every connection if
+            it fails for good. """
+        try:
+            connection.run()
+        except Exception as e:
+            self.event_log.log('error', traceback=format_exc())
+            if self.failure is None:
+                self.failure = e
+            self._finished.set()
+
+    def _start(self, connection):
+        connection.thread = threading.Thread(target=self._read,
+                                             args=(connection,))
+        connection.thread.daemon = True
+        connection.thread.start()
+
+    def start(self):
+        """ Opens connections. """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for connection in self.connections:
+                self._start(connection)
+
+    def run(self):
+        """ Opens connections and reads the stream until stop() is called
+            or a connection fails for good.
+
+            No return value; raises what a failed connection raised.
+        """
+        self.start()
+        # Waits in steps so CTRL+C gets through on Python 2
+        while not self._finished.wait(1):
+            pass
+        if self.failure is not None:
+            raise self.failure
+
+    def stop(self):
+        """ Closes every connection. """
+        with self._lock:
+            self._finished.set()
+            connections, self.connections = self.connections, []
+            self._shares = []
+        for connection in connections:
+            connection.stop()
+        for connection in connections:
+            if connection.thread is not None:
+                connection.thread.join(self.connect_timeout)
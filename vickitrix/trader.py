@@ -0,0 +1,427 @@
+"""
+vickitrix.trader
+
+Matches statuses to compiled rules and places the rules' orders on GDAX.
+Kept apart from the Twitter stream so matching and execution can run in
+their own stages, or without a stream at all.
+"""
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .dedup import client_oid
+from .eventlog import EventLog
+from .matching import RuleIndex
+from .metrics import Metrics
+
+def is_retweet_or_reply(status):
+    """ Checks whether a status is a retweet or a reply.
+
+        status: status dictionary from Twitter
+
+        Return value: True iff status is a retweet or reply
+    """
+    return bool(('retweeted_status' in status
+                 and status['retweeted_status'])
+                 or status.get('in_reply_to_status_id')
+                 or status.get('in_reply_to_status_id_str')
+                 or status.get('in_reply_to_user_id')
+                 or status.get('in_reply_to_user_id_str')
+                 or status.get('in_reply_to_screen_name'))
+
+# Parts of GDAX error messages saying an order may go through if resent
+_retryable_messages = ['rate limit', 'internal server error',
+                       'service unavailable', 'timeout', 'try again']
+
+def _retryable(response):
+    """ Checks whether GDAX's response to an order says to resend it. """
+    if not isinstance(response, dict):
+        return True
+    if 'id' in response:
+        return False
+    message = str(response.get('message', '')).lower()
+    return any(part in message for part in _retryable_messages)
+
+class Trader(object):
+    """ Trades on GDAX based on statuses. """
+
+    def __init__(self, rules, gdax_client, balances, public_client,
+                 books=None, sleep_time=0.5, order_threads=4, event_log=None,
+                 metrics=None, name=None, order_retries=3, retry_wait=0.25,
+                 tracker=None, fill_timeout=10, recorder=None):
+        """
+            rules: list of compiled rules from compile_rules()
+            gdax_client: instance of gdax.AuthenticatedClient
+            balances: instance of BalanceCache for gdax_client
+            public_client: instance of gdax.PublicClient for order books
+                that aren't being kept live
+            books: instance of OrderBooks kept live, or None
+            sleep_time: how long (in s) to wait after an order is placed
+                when there's no tracker to say when it fills
+            order_threads: maximum number of a rule's orders placed at
+                once; 0 places every rule's orders one at a time
+            event_log: instance of EventLog to which matches, orders, and
+                balances are logged, or None to log nothing
+            metrics: instance of Metrics in which to record latencies and
+                counts, or None for a private registry
+            name: name of account trader trades for, added to its events
+                and metrics when several accounts trade at once, or None
+            order_retries: most times an order is resent after GDAX was
+                unreachable, overloaded, or throttling requests, provided
+                it's confirmed not to have been placed
+            retry_wait: time (in s) before the first resend; doubles with
+                each resend
+            tracker: instance of OrderTracker following gdax_client's
+                orders, or None
+            fill_timeout: most time (in s) a rule's order waits for the
+                order before it to be done when there's a tracker
+            recorder: instance of Recorder to which quotes used and orders
+                placed are recorded, or None
+        """
+        self.rule_index = RuleIndex(rules)
+        self.gdax_client = gdax_client
+        self.balances = balances
+        self.public_client = public_client
+        self.books = books
+        self.sleep_time = sleep_time
+        self.event_log = (event_log if event_log is not None
+                          else EventLog(console=False))
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.name = name
+        self._labels = {'account' : name} if name is not None else {}
+        self.order_retries = order_retries
+        self.retry_wait = retry_wait
+        self.tracker = tracker
+        self.fill_timeout = fill_timeout
+        self.recorder = recorder
+        self._order_pool = ThreadPool(order_threads) if order_threads else None
+        # Orders for the same product are placed one at a time
+        self._product_locks = {}
+        self._add_product_locks(rules)
+        self.user_ids = {}
+
+    def _add_product_locks(self, rules):
+        for rule in rules:
+            for compiled_order in rule['orders']:
+                self._product_locks.setdefault(
+                        compiled_order['static']['product_id'],
+                        threading.Lock()
+                    )
+
+    def add_user_ids(self, handles_to_user_ids):
+        """ Lets statuses be matched to handles by user ID, now and after
+            rules are swapped.
+
+            handles_to_user_ids: dictionary mapping lowercase handle to
+                user ID string
+
+            No return value.
+        """
+        self.user_ids.update(handles_to_user_ids)
+        self.rule_index.add_user_ids(handles_to_user_ids)
+
+    def set_rules(self, rules):
+        """ Swaps in a new rule set.
+
+            The new index is built aside and replaces the old one in a
+            single assignment, so a status is matched against either the
+            old rules or the new ones, never a mix; orders already matched
+            are placed under the rules they matched.
+
+            rules: list of compiled rules from compile_rules()
+
+            No return value.
+        """
+        rule_index = RuleIndex(rules)
+        rule_index.add_user_ids(self.user_ids)
+        self._add_product_locks(rules)
+        self.rule_index = rule_index
+
+    def match(self, status, trace=None, candidates=None):
+        """ Finds rules whose handles, keywords, and conditions apply.
+
+            status: status dictionary from Twitter
+            trace: Trace for status, or None
+            candidates: list of compiled rules whose handles and keywords
+                are already known to apply, or None to look them up
+
+            Return value: list of compiled rules whose orders should be
+                placed, in the order in which they appear in the rules file
+        """
+        if candidates is None:
+            candidates = self.rule_index.match(status)
+        if trace is not None:
+            trace.mark('match')
+        if not candidates:
+            return candidates
+        matched = self.check(status, candidates)
+        if trace is not None:
+            trace.mark('condition')
+        return matched
+
+    def check(self, status, rules):
+        """ Evaluates conditions of rules whose handles and keywords apply.
+
+            status: status dictionary from Twitter
+            rules: list of compiled rules
+
+            Return value: list of rules whose orders should be placed
+        """
+        if is_retweet_or_reply(status):
+            # This is an RT or reply; don't do anything
+            return []
+        matched = []
+        for rule in rules:
+            if rule['condition'](status['text'], self.balances.available(),
+                                 None, None):
+                matched.append(rule)
+        return matched
+
+    def _log(self, event, **fields):
+        if self.name is not None:
+            fields['account'] = self.name
+        self.event_log.log(event, **fields)
+
+    def inside(self, product_id):
+        """ Gets inside bid and ask for a product.
+
+            product_id: GDAX product ID
+
+            Return value: tuple (inside bid, inside ask) as floats
+        """
+        inside = None
+        if self.books is not None:
+            inside = self.books.inside(product_id)
+        if inside is None:
+            # Book isn't being kept or isn't synced; ask GDAX
+            order_book = self.public_client.get_product_order_book(
+                    product_id
+                )
+            inside = (
+                    float(order_book['bids'][0][0]),
+                    float(order_book['asks'][0][0])
+                )
+        return inside
+
+    def place(self, status, compiled_order, trace=None):
+        """ Fills in and places an order for a matched status.
+
+            status: status dictionary from Twitter
+            compiled_order: compiled order from a compiled rule
+            trace: Trace for status, or None
+
+            Return value: False if the order wasn't placed; otherwise, the
+                TrackedOrder of the order if GDAX accepted it and there's a
+                tracker, or True
+        """
+        with self._product_locks[compiled_order['static']['product_id']]:
+            with self.metrics.timer('balance_seconds', **self._labels):
+                available = self.balances.available()
+            if trace is not None:
+                trace.mark('balance')
+            self._log('balances', available=available)
+            order = dict(compiled_order['static'])
+            if 'source' in compiled_order and 'id_str' in status:
+                # Same status, rule, and order always get the same ID,
+                # whatever client_oid a Python rules file gave
+                order['client_oid'] = client_oid(
+                        status['id_str'], *compiled_order['source']
+                    )
+            if compiled_order['needs_book']:
+                with self.metrics.timer('book_seconds', **self._labels):
+                    inside_bid, inside_ask = self.inside(order['product_id'])
+                if trace is not None:
+                    trace.mark('book')
+                if self.recorder is not None:
+                    self.recorder.record_quote(order['product_id'],
+                                               inside_bid, inside_ask,
+                                               status.get('id_str'))
+            else:
+                inside_bid, inside_ask = None, None
+            for money, expression in compiled_order['money']:
+                order[money] = str(expression(
+                        status['text'], available, inside_bid, inside_ask
+                    ))
+            # If the hundredths of the last of these the order has rounds
+            # down to zero, ain't enough; a limit order's size can be small
+            not_enough = False
+            for money in ['size', 'funds', 'price']:
+                if money in order:
+                    not_enough = int(float(order[money]) * 100) == 0
+            self._log('order_placing', status_id=status.get('id_str'),
+                      order=order)
+            if not_enough:
+                self._log('order_skipped', status_id=status.get('id_str'),
+                          order=order)
+                self.metrics.increment('orders_skipped',
+                                       product_id=order['product_id'],
+                                       **self._labels)
+                return False
+            if trace is not None:
+                trace.mark('submit')
+            with self.metrics.timer('order_seconds', side=order['side'],
+                                   **self._labels):
+                response = self.submit(order)
+            if trace is not None:
+                trace.mark('ack')
+            outcome = ('order_placed' if isinstance(response, dict)
+                       and 'id' in response else 'order_rejected')
+            self.metrics.increment(outcome.replace('order_', 'orders_'),
+                                   product_id=order['product_id'],
+                                   side=order['side'], **self._labels)
+            self.balances.apply_order(order, response, inside_bid, inside_ask)
+            self._log(outcome, status_id=status.get('id_str'), order=order,
+                      response=response)
+            if self.recorder is not None:
+                self.recorder.record_order(order, response,
+                                           status.get('id_str'), self.name)
+            if self.tracker is None:
+                # Give the order time to fill
+                time.sleep(self.sleep_time)
+            elif outcome == 'order_placed':
+                return self.tracker.track(response, order, trace)
+        return True
+
+    def _find(self, client_oid, wait):
+        """ Looks an order up by client_oid, retrying lookups that fail.
+
+            client_oid: client_oid of order
+            wait: time (in s) before the first retry; doubles with each
+
+            Return value: GDAX's report of the order if it was placed;
+                None if GDAX says it has no such order; False if GDAX
+                couldn't say either way
+        """
+        for attempt in range(self.order_retries + 1):
+            try:
+                report = self.gdax_client.get_order('client:' + client_oid)
+            except Exception:
+                # Network error, or an error page that isn't JSON
+                report = None
+            if isinstance(report, dict):
+                if 'id' in report:
+                    return report
+                if 'notfound' in str(report.get('message', '')).lower():
+                    return None
+            if attempt < self.order_retries:
+                time.sleep(wait)
+                wait *= 2
+        return False
+
+    def submit(self, order):
+        """ Sends an order to GDAX, resending it if sending it failed in a
+            way that might not happen again and GDAX says it has no order
+            with its client_oid.
+
+            order: dictionary of order parameters
+
+            Return value: GDAX's response
+        """
+        assert order['side'] in ['buy', 'sell']
+        send = (self.gdax_client.buy if order['side'] == 'buy'
+                else self.gdax_client.sell)
+        wait = self.retry_wait
+        for attempt in range(self.order_retries + 1):
+            retry = attempt < self.order_retries and 'client_oid' in order
+            try:
+                response = send(**order)
+            except Exception:
+                # Network error, or an error page that isn't JSON
+                if not retry:
+                    raise
+            else:
+                if not retry or not _retryable(response):
+                    return response
+            time.sleep(wait)
+            wait *= 2
+            # The order may have been placed even though sending failed
+            placed = self._find(order['client_oid'], wait)
+            if placed:
+                return placed
+            if placed is False:
+                # Resending could place the order twice
+                return {'message' : ''.join([
+                        'Order with client_oid ', order['client_oid'],
+                        ' may have been placed, but GDAX couldn\'t be asked ',
+                        'whether it was; not resending it.'
+                    ])}
+            self.metrics.increment('orders_resent',
+                                   product_id=order['product_id'],
+                                   **self._labels)
+            self._log('order_resending', order=order)
+
+    def place_all(self, status, compiled_orders, trace=None):
+        """ Places orders one after another, stopping if one isn't placed.
+            With a tracker, each order waits for the one before it to be
+            done, so what it filled is available.
+
+            status: status dictionary from Twitter
+            compiled_orders: list of compiled orders
+            trace: Trace for status, or None
+
+            Return value: True iff every order was placed
+        """
+        previous = None
+        for compiled_order in compiled_orders:
+            if previous is not None and not previous.wait(self.fill_timeout):
+                self.metrics.increment('fill_timeouts', **self._labels)
+            placed = self.place(status, compiled_order, trace)
+            if not placed:
+                return False
+            previous = placed if placed is not True else None
+        return True
+
+    def place_rule(self, status, rule, trace=None):
+        """ Places a matched rule's orders.
+
+            Unless the rule's "execution" is "sequential", orders for
+            different products don't depend on one another and are placed
+            concurrently; orders for the same product are still placed in
+            the order they're listed.
+
+            status: status dictionary from Twitter
+            rule: compiled rule
+            trace: Trace for status, or None
+
+            Return value: True iff every order was placed
+        """
+        lanes = []
+        if rule['execution'] == 'parallel' and self._order_pool is not None:
+            by_product = {}
+            for compiled_order in rule['orders']:
+                product_id = compiled_order['static']['product_id']
+                if product_id not in by_product:
+                    by_product[product_id] = []
+                    lanes.append(by_product[product_id])
+                by_product[product_id].append(compiled_order)
+        if len(lanes) < 2:
+            return self.place_all(status, rule['orders'], trace)
+        results = [
+                self._order_pool.apply_async(
+                        self.place_all, (status, compiled_orders, trace)
+                    ) for compiled_orders in lanes
+            ]
+        # get() reraises any exception from placing a lane's orders
+        return all([result.get() for result in results])
+
+    def execute(self, status, rules, trace=None):
+        """ Places orders of rules matched by a status, in order.
+
+            status: status dictionary from Twitter
+            rules: list of compiled rules from match()
+            trace: Trace for status, or None
+
+            No return value.
+        """
+        for rule in rules:
+            # Condition satisfied! Perform action
+            self._log('tweet_matched', status_id=status.get('id_str'),
+                      handle=status['user']['screen_name'],
+                      text=status['text'])
+            if not self.place_rule(status, rule, trace):
+                return
+            if self.event_log.enabled:
+                self._log('balances', available=self.balances.available())
+            if self.tracker is None:
+                # Fills aren't reflected locally yet; check with GDAX soon
+                self.balances.request_reconcile(delay=self.sleep_time)
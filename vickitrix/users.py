@@ -0,0 +1,140 @@
+"""
+vickitrix.users
+
+Resolves Twitter handles in rules to user IDs, which is what the stream
+is filtered and statuses are matched by.
+
+Resolved IDs are cached on disk, so a restart with the same rules makes
+no requests to Twitter at all; handles that aren't cached (or whose
+entries are older than the cache's TTL, since handles can be renamed and
+reused) are looked up through users/lookup, up to 100 per request.
+"""
+import json
+import os
+import time
+
+from twython import TwythonError
+
+from .display import print_to_screen
+
+# Most screen names users/lookup accepts per request
+lookup_batch_size = 100
+
+class UserIdCache(object):
+    """ Handle-to-user-ID mapping persisted as JSON. """
+
+    def __init__(self, path, ttl=86400):
+        """
+            path: file in which cache is kept
+            ttl: time (in s) for which a resolved handle is trusted, or
+                None to trust it forever
+        """
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}
+        try:
+            with open(path) as cache_stream:
+                self._entries = json.load(cache_stream)
+        except (IOError, OSError, ValueError):
+            # Missing or corrupt cache; everything gets looked up again
+            self._entries = {}
+
+    def get(self, handles):
+        """ Looks up handles in the cache.
+
+            handles: iterable of lowercase handles
+
+            Return value: tuple (dictionary mapping handles found to user
+                ID strings, list of handles not found or expired)
+        """
+        found, missing = {}, []
+        now = time.time()
+        for handle in handles:
+            entry = self._entries.get(handle)
+            if entry is None or (
+                    self.ttl is not None and now - entry[1] > self.ttl
+                ):
+                missing.append(handle)
+            else:
+                found[handle] = entry[0]
+        return found, missing
+
+    def update(self, handles_to_user_ids):
+        """ Adds newly resolved handles to the cache.
+
+            handles_to_user_ids: dictionary mapping lowercase handle to
+                user ID string
+
+            No return value.
+        """
+        now = time.time()
+        for handle, user_id in handles_to_user_ids.items():
+            self._entries[handle] = [user_id, now]
+
+    def save(self):
+        """ Writes the cache, replacing the file only once it's complete.
+
+            No return value.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as cache_stream:
+            json.dump(self._entries, cache_stream, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+def lookup_user_ids(twitter_client, handles):
+    """ Looks up user IDs of handles with users/lookup.
+
+        twitter_client: instance of Twython
+        handles: list of lowercase handles
+
+        Return value: dictionary mapping every handle found to its user ID
+            string
+    """
+    handles_to_user_ids = {}
+    for i in range(0, len(handles), lookup_batch_size):
+        batch = handles[i:i + lookup_batch_size]
+        try:
+            users = twitter_client.lookup_user(screen_name=','.join(batch))
+        except TwythonError as e:
+            if getattr(e, 'error_code', None) == 404:
+                # None of the batch's handles exist
+                continue
+            raise
+        for user in users:
+            handles_to_user_ids[user['screen_name'].lower()] = user['id_str']
+    return handles_to_user_ids
+
+def resolve_handles(twitter_client, handles, cache=None, known=None):
+    """ Gets user IDs of handles from known IDs, the cache, or Twitter.
+
+        twitter_client: instance of Twython
+        handles: iterable of lowercase handles
+        cache: instance of UserIdCache, or None
+        known: dictionary mapping handles already resolved in this process
+            to user IDs, or None
+
+        Return value: dictionary mapping every handle found to its user ID
+            string
+    """
+    handles_to_user_ids = dict(known or {})
+    handles = sorted(set(handles) - set(handles_to_user_ids))
+    if cache is not None:
+        found, handles = cache.get(handles)
+        handles_to_user_ids.update(found)
+    if not handles:
+        return handles_to_user_ids
+    looked_up = lookup_user_ids(twitter_client, handles)
+    for handle in handles:
+        if handle not in looked_up:
+            print_to_screen(
+                    'Handle {} not found; skipping rule...'.format(handle)
+                )
+    handles_to_user_ids.update(looked_up)
+    if cache is not None and looked_up:
+        cache.update(looked_up)
+        try:
+            cache.save()
+        except (IOError, OSError):
+            # Not worth failing over; IDs are looked up again next time
+            pass
+    return handles_to_user_ids